@@ -2,17 +2,26 @@
 # version = 2.0.8 date = 2026/01/17
 # ==========================================
 
+import os
+import time
+import functools
 import streamlit as st
 import pandas as pd
-import math
+import pyarrow as pa
 import gspread
 import altair as alt
 from google.oauth2.service_account import Credentials
 from datetime import datetime
 from zoneinfo import ZoneInfo
 from streamlit_gsheets import GSheetsConnection
-from streamlit_autorefresh import st_autorefresh
 import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from race_format import fmt_time, fmt_lap, fmt_time_ms, fmt_lap_ms, fmt_gap_ms
+from race_engine import (build_analysis_frame, compute_race, content_version, drop_double_taps, edit_ops, prepare_log, resolve_ops,
+                         CpuMeter, EventSequence, RaceState, RaceHub, RaceIndex, predict_next_passing, refresh_interval, stamp_times, tap_interval_ms, memory_report, OP_UNDO, OP_REDO, RECORD_COLUMNS)
+from race_archive import ArchiveStore, RaceCatalog
+from standings_feed import StandingsFeed
+from storage import ApiScheduler, GSheetsStorage, LogFollower, QuotaThrottled, SheetsClientPool, SQLiteStorage, WriteBehindQueue
 
 # ==========================================
 # 設定・定数
@@ -20,18 +29,42 @@ import streamlit.components.v1 as components
 VERSION = "ver 2.0.8"
 
 SHEET_URL = "https://docs.google.com/spreadsheets/d/1-GSNYQYulO-83vdMOn7Trqv4l6eCjo9uzaP20KQgSS4/edit" # 【要修正】URL確認
-WORKSHEET_LOG = "latest-log"
-WORKSHEET_CONFIG = "config"
-WORKSHEET_INDEX = "race_index"
+# 保存先: "gsheets" (Googleスプレッドシート) / "sqlite" (ローカルファイル。オフライン運営用)
+STORAGE_BACKEND = os.environ.get("EKIDEN_STORAGE", "gsheets")
+SQLITE_PATH = os.environ.get("EKIDEN_SQLITE_PATH", "ekiden.db")
+# 記録の書き込みは後回しキューでまとめて送る (未送信分はジャーナルに残し、再起動時に送り直す)
+JOURNAL_PATH = os.environ.get("EKIDEN_JOURNAL_PATH", "ekiden_journal.jsonl")
+# 終了したレースは計算結果ごとローカルにも保存し、過去のレースはそこから開く (Arrow ファイル)
+ARCHIVE_DIR = os.environ.get("EKIDEN_ARCHIVE_DIR", "archives")
+WRITE_FLUSH_SEC = 1.0 # 最初のタップからこの秒数だけ待ち、その間のタップを1回で送る
+WRITE_BATCH_MAX = 100
+# 同じチームの同じ地点の記録が、直前の記録からこの秒数以内なら二重タップとして1件にまとめる (0でまとめない)
+DOUBLE_TAP_SEC = float(os.environ.get("EKIDEN_DOUBLE_TAP_SEC", "10"))
+# Sheets API の割り当て (1分あたりのリクエスト数)。記録係の書き込みを観戦側の読み込みより優先して出す
+SHEETS_READ_PER_MIN = 60
+SHEETS_WRITE_PER_MIN = 60
 JST = ZoneInfo("Asia/Tokyo")
 
 # 軽量化: キャッシュと更新間隔を長めにとる
 CACHE_TTL_SEC = 15.0 
-AUTOREFRESH_INTERVAL = 15000 # 15秒
+# 最新ログを読み直す間隔と観戦モードのパネルを部分更新する間隔は、観戦中のチームの次の通過予想から決める
+# (予想の前後は WATCH_REFRESH_MIN_SEC。それ以外は長く、部分更新は CACHE_TTL_SEC まで)
+WATCH_REFRESH_MIN_SEC = 2.0
+WATCH_REFRESH_MAX_SEC = 60.0
+LIVE_READ_CAP_PER_MIN = 30 # 最新ログの読み込みはプロセス全体でこの回数/分まで
+LOG_VERIFY_SEC = 60.0 # 最新ログは差分で読み、この間隔で行数とハッシュを照合する (合わなければ全体を読み直す)
+RACE_INDEX_TTL_SEC = 300.0 # アーカイブ一覧の読み直し間隔 (別のプロセスでのアーカイブ・削除に追いつくため)
+# 順位フィード (読み取り専用の JSON / SSE。standings_feed.py)。認証が無いので既定では出さない
+#   EKIDEN_FEED_PORT: 出すポート (未設定・0 で起動しない)
+#   EKIDEN_FEED_HOST: 待ち受けるアドレス (既定は 127.0.0.1 = 同じマシンからだけ。会場LANに出すときは 0.0.0.0 などを明示する)
+FEED_PORT = int(os.environ.get("EKIDEN_FEED_PORT") or 0)
+FEED_HOST = os.environ.get("EKIDEN_FEED_HOST") or "127.0.0.1"
+ANALYSIS_CACHE_ENTRIES = 8 # 分析データを保持するレース(ログの版)数。超えたら古いものから破棄
 
 ADMIN_PASSWORD = "0000"
 
 st.set_page_config(page_title="えきでんくん", page_icon="🎽", layout="wide")
+RUN_CPU_START = time.thread_time()  # このスクリプト実行の CPU 時間 (観戦1人あたりの負荷の計測用)
 
 # ==========================================
 # CSSデザイン
@@ -74,129 +107,129 @@ def get_gspread_client():
 
 def get_time_str(dt): return dt.strftime("%H:%M:%S.%f")[:10]
 
-def parse_time_str(time_str):
-    now = datetime.now(JST)
-    if not isinstance(time_str, str) or not time_str: return now
-    try:
-        if "." in time_str: t = datetime.strptime(time_str + "00000", "%H:%M:%S.%f").time()
-        else: t = datetime.strptime(time_str, "%H:%M:%S").time()
-        return datetime.combine(now.date(), t).replace(tzinfo=JST)
-    except: return now
-
-def fmt_time(sec):
-    sec = math.ceil(sec)
-    m, s = divmod(int(sec), 60)
-    h, m = divmod(m, 60)
-    return f"{h:01}:{m:02}:{s:02}"
-
-def fmt_lap(sec):
-    total_tenths = math.ceil(sec * 10)
-    rem_tenths = total_tenths % 10
-    total_sec = total_tenths // 10
-    m, s = divmod(total_sec, 60)
-    return f"{m:02}:{s:02}.{rem_tenths}"
-
-def str_to_sec(time_str):
-    if not isinstance(time_str, str) or not time_str: return 0.0
-    try:
-        parts = time_str.split(':')
-        if len(parts) == 3: return int(parts[0])*3600 + int(parts[1])*60 + float(parts[2])
-        elif len(parts) == 2: return int(parts[0])*60 + float(parts[1])
-        return 0.0
-    except: return 0.0
-
-def fmt_diff(sec):
-    if sec is None or math.isnan(sec): return "-"
-    sign = "+" if sec > 0 else "-" if sec < 0 else "±"
-    return f"{sign}{fmt_time(abs(sec))}"
-
-def load_data(conn, sheet_name):
+@st.cache_resource
+def get_storage():
+    # 保存先はプロセス全体で1つ (STORAGE_BACKEND で切り替え)
+    if STORAGE_BACKEND == "sqlite": return SQLiteStorage(SQLITE_PATH)
+    # gspread の認証・Spreadsheet/Worksheet の取得はプロセスで1回だけ (SheetsClientPool で使い回す)
+    # API の呼び出しはすべて1つの ApiScheduler を通し、割り当てを読み込み・書き込みで分けて管理する
+    scheduler = ApiScheduler(SHEETS_READ_PER_MIN, SHEETS_WRITE_PER_MIN)
+    pool = SheetsClientPool(get_gspread_client, SHEET_URL, scheduler)
+    return GSheetsStorage(st.connection("gsheets", type=GSheetsConnection), pool, SHEET_URL, scheduler)
+
+@st.cache_resource
+def get_write_queue():
+    return WriteBehindQueue(get_storage(), JOURNAL_PATH, WRITE_FLUSH_SEC, WRITE_BATCH_MAX)
+
+@st.cache_resource
+def get_archive_store():
+    return ArchiveStore(ARCHIVE_DIR)
+
+@st.cache_resource
+def get_race_catalog():
+    # アーカイブ一覧 (race_index) はメタデータだけを読む。アーカイブ・削除のときに invalidate する
+    return RaceCatalog(lambda: get_storage().read_index(ttl=0), RACE_INDEX_TTL_SEC, get_archive_store())
+
+def build_race_frame(raw):
+    # 生ログ → 派生フレーム (取り消しの解決・二重記録の除外を含む)
+    return compute_race(drop_double_taps(stamp_times(resolve_ops(prepare_log(raw))), DOUBLE_TAP_SEC * 1000))
+
+def load_data(storage, sheet_name=None, state=None):
     """
     データを読み込み、アプリ側でラップ・スプリット・順位・前後差を全自動計算して付与する。
+    state (RaceState) を渡すと、前回から追記された行だけを計算する。
+    最新ログは load_live_race (全セッション共有) を使うこと。
     """
     try:
-        df = conn.read(spreadsheet=SHEET_URL, worksheet=sheet_name, ttl=CACHE_TTL_SEC)
+        df = storage.read_log(sheet_name, ttl=CACHE_TTL_SEC)
         if df.empty: return pd.DataFrame()
-        
-        # 数値変換など
-        for col in df.columns:
-            df[col] = df[col].astype(str).str.replace(r'\.0$', '', regex=True)
-        
-        # --- 自動計算ロジック (v2.0.7) ---
-        df['dt'] = df['Time'].apply(parse_time_str)
-        df = df.sort_values('dt')
-        
-        df['SplitSeconds'] = 0.0
-        df['SectionSeconds'] = 0.0
-        df['PointSeconds'] = 0.0
-        
-        try:
-            start_time = df[df['Location'] == 'Start']['dt'].min()
-        except:
-            start_time = datetime.now(JST)
-
-        team_groups = df.groupby('TeamID')
-        calculated_rows = []
-        
-        for tid, group in team_groups:
-            group = group.sort_values('dt')
-            group['SplitSeconds'] = (group['dt'] - start_time).dt.total_seconds()
-            
-            # Point Lap (直前との差)
-            group['PointSeconds'] = group['SplitSeconds'].diff().fillna(0)
-            
-            # Section Lap (簡易ロジック: Start/Relayからの差)
-            sec_laps = []
-            last_relay_time = start_time
-            
-            for _, row in group.iterrows():
-                current_time = row['dt']
-                sec_val = (current_time - last_relay_time).total_seconds()
-                sec_laps.append(sec_val)
-                if row['Location'] == 'Relay' or row['Location'] == 'Start':
-                    last_relay_time = current_time 
-            
-            group['SectionSeconds'] = sec_laps
-            calculated_rows.append(group)
-            
-        if calculated_rows:
-            df_calc = pd.concat(calculated_rows)
-            df_calc['Split'] = df_calc['SplitSeconds'].apply(fmt_time)
-            df_calc['KM-Lap'] = df_calc['PointSeconds'].apply(fmt_lap) # KM-Lapカラムを再利用
-            df_calc['SEC-Lap'] = df_calc['SectionSeconds'].apply(fmt_lap)
-            
-            # 順位計算 (通過順)
-            df_calc['Rank'] = df_calc.groupby(['Section', 'Location'])['dt'].rank(method='first').astype(int)
-            
-            # 前との差 (PrevDiff) 計算: 地点ごとにソートしてdiffをとる
-            df_calc = df_calc.sort_values(['Section', 'Location', 'SplitSeconds'])
-            df_calc['PrevDiff'] = df_calc.groupby(['Section', 'Location'])['SplitSeconds'].diff()
-            
-            return df_calc.sort_index() # Time順に戻す
-            
-        return df
+        # --- 自動計算ロジック (race_engine でベクトル計算) ---
+        if state is not None: return state.update(df)
+        return build_race_frame(df)
     except Exception:
         return pd.DataFrame()
 
-def fetch_config_from_sheet(conn, sheet_name=WORKSHEET_CONFIG):
+@st.cache_resource
+def get_race_hub():
+    # 最新ログの派生状態はプロセス全体で1つだけ持ち、全セッションで共有する
+    return RaceHub(RaceState(prepare_log, DOUBLE_TAP_SEC * 1000), CACHE_TTL_SEC, 60 / LIVE_READ_CAP_PER_MIN)
+
+@st.cache_resource
+def get_log_follower():
+    # 最新ログは新しい行だけを読む。編集・削除を見つけて全体を読み直したときは、派生状態も作り直す
+    return LogFollower(get_storage(), LOG_VERIFY_SEC, on_resync=get_race_hub().state.invalidate)
+
+def load_live_race():
+    """
+    最新ログ(latest-log)の共有スナップショット (frame / index / version) を返す。
+    frame は全セッション共通なので、加工するときは必ず .copy() すること。
+    """
+    ctx = get_script_run_ctx()
+    return get_race_hub().get(read_live_log, ctx.session_id if ctx else None)
+
+def read_live_log():
+    # 未送信の記録も足して見せる (押した直後から現在地が進むように)
+    return get_write_queue().overlay(get_log_follower().read())
+
+@st.cache_resource
+def get_standings_feed():
+    # 外部 (電光掲示板・LINE bot など) 向けの順位フィード。観戦画面と同じ共有スナップショットを使う
+    if not FEED_PORT: return None
+    # 別スレッドから呼ばれるので、cache_resource のオブジェクトはここで取り出しておく
+    queue, follower, storage = get_write_queue(), get_log_follower(), get_storage()
+    feed = StandingsFeed(get_race_hub(), lambda: queue.overlay(follower.read()), lambda: fetch_config_from_sheet(storage))
+    try: feed.serve(FEED_HOST, FEED_PORT)
+    except OSError: return None  # ポートが使用中 (別のプロセスが出している) なら出さない
+    return feed
+
+@st.cache_resource
+def get_cpu_meter():
+    return CpuMeter()
+
+def clear_race_cache():
+    # シート書き込み後: 読み込みキャッシュを捨て、共有スナップショットも次回読み直す
+    st.cache_data.clear()
+    get_storage().clear_cache()
+    get_race_hub().mark_stale()
+
+def show_my_writes():
+    # 記録係の書き込み直後: 受け付けた行を今のスナップショットに足して見せる (シートは読み直さず、次の読み直しは通常の間隔で)
+    raw = get_log_follower().cached()
+    if raw is None: get_race_hub().mark_stale()  # まだ一度も読んでいない: 次のアクセスで読む
+    else: get_race_hub().apply(get_write_queue().overlay(raw))
+
+def reset_live_log():
+    # 最新ログを空にした後 (レース作成・アーカイブ・リセット): 差分読み込みも派生状態も最初から作り直す
+    get_log_follower().reset()
+    get_race_hub().invalidate()
+
+def clear_my_events():
+    # 元に戻す/やり直す の履歴と EventID の採番は今のレース限り (前のレースの記録を取り消したり、二度押し判定に使わない)
+    for key in ("my_events", "my_redo", "event_seq"): st.session_state.pop(key, None)
+
+def fetch_config_from_sheet(storage, sheet_name=None):
+    # 設定が無い (None) とレース作成に進むので、割り当て待ちで読めなかったときは QuotaThrottled のまま返す
     try:
-        df = conn.read(spreadsheet=SHEET_URL, worksheet=sheet_name, ttl=0)
+        df = storage.read_config(sheet_name, ttl=0)
         if df.empty: return None
         config = {}
         for _, row in df.iterrows():
             config[str(row['Key'])] = str(row['Value'])
         return config
+    except QuotaThrottled: raise
     except: return None
 
 # --- UI描画ロジック (グラフ強調 + 完全インタラクティブ版) ---
-def render_analysis_dashboard(df, teams_info):
-    analysis_data = []
-    points_order = df[['Section', 'Location']].drop_duplicates().reset_index(drop=True)
+@st.cache_resource(max_entries=ANALYSIS_CACHE_ENTRIES, show_spinner=False)
+def build_analysis_bundle(version, teams_items, main_team_name, _df, _race_index):
+    """
+    分析ダッシュボードのデータとグラフを、ログの内容バージョンごとに1回だけ作る。
+    タブ切替・グラフ種類・チーム選択などのUI操作では作り直さない (戻り値は書き換え禁止)。
+    """
+    teams_info = dict(teams_items)
+    points_order = pd.DataFrame(_race_index.points, columns=['Section', 'Location'])
     points_order = points_order[points_order['Location'] != 'Start']
     
-    # ポイントIDマップ
-    point_map = {f"{row['Section']}_{row['Location']}": i for i, row in points_order.iterrows()}
-    
     # 直近5区間
     all_sections = points_order['Section'].unique().tolist()
     recent_sections = all_sections[-5:] if len(all_sections) > 5 else all_sections
@@ -207,79 +240,66 @@ def render_analysis_dashboard(df, teams_info):
             domain_min = recent_mask.idxmax()
             domain_max = len(points_order)
 
-    for _, pt in points_order.iterrows():
-        sec, loc = pt['Section'], pt['Location']
-        pt_label = f"{sec} {loc}"
-        pt_key = f"{sec}_{loc}"
-        pt_id = point_map.get(pt_key, 0)
-        
-        p_df = df[(df['Section'] == sec) & (df['Location'] == loc)].copy()
-        if p_df.empty: continue
-        
-        if 'SplitSeconds' not in p_df.columns:
-             p_df['SplitSeconds'] = p_df['Split'].apply(str_to_sec)
-        
-        p_df = p_df.sort_values('SplitSeconds')
-        top_time = p_df.iloc[0]['SplitSeconds']
-        p_df['TrueRank'] = range(1, len(p_df) + 1)
-        
-        for _, row in p_df.iterrows():
-            tid = row['TeamID']
-            analysis_data.append({
-                "TeamID": tid, "Team": teams_info.get(tid, tid), "PointLabel": pt_label, "PointID": pt_id,
-                "Section": sec, "Location": loc, "Rank": row['TrueRank'],
-                "Split": row['Split'], "SplitSeconds": row['SplitSeconds'], 
-                "GapSeconds": row['SplitSeconds'] - top_time, 
-                "LapStr": row['SEC-Lap'], "KMLapStr": row.get('KM-Lap', '-'),
-            })
-    ana_df = pd.DataFrame(analysis_data)
+    ana_df = build_analysis_frame(_df, teams_info, _race_index)
+    if ana_df.empty: return None
+
+    max_rank = len(teams_info) if len(teams_info) > 0 else 1
+    rank_ticks = list(range(1, max_rank + 1))
     
-    if ana_df.empty:
-        st.warning("データ不足のため表示できません")
-        return
+    x_axis = alt.X('PointID', title='地点 (操作: ドラッグ移動/ホイール拡大)', 
+                   scale=alt.Scale(domain=[domain_min, domain_max]),
+                   axis=alt.Axis(tickMinStep=1, labels=False))
+
+    # --- 強調表示の設定 ---
+    color_cond = alt.condition(alt.datum.Team == main_team_name, alt.value('#FF4B4B'), alt.value('#CCCCCC'))
+    size_cond = alt.condition(alt.datum.Team == main_team_name, alt.value(3), alt.value(1))
+    opacity_cond = alt.condition(alt.datum.Team == main_team_name, alt.value(1.0), alt.value(0.5))
+
+    charts = {
+        "順位変動(通過順)": alt.Chart(ana_df).mark_line(point=True).encode(
+            x=x_axis,
+            y=alt.Y('Rank', scale=alt.Scale(domain=[1, max_rank], zero=False, nice=False), 
+                    axis=alt.Axis(values=rank_ticks, format='d'), title='通過順').scale(reverse=True),
+            color=color_cond, size=size_cond, opacity=opacity_cond,
+            tooltip=['Team', 'PointLabel', 'Rank', 'Split']
+        ).properties(height=500).interactive(), # 修正: 縦横自由にズーム可能に
+        "トップ差": alt.Chart(ana_df).mark_line(point=True).encode(
+            x=x_axis,
+            y=alt.Y('GapSeconds', scale=alt.Scale(reverse=True, nice=True), title='トップ差(秒)'),
+            color=color_cond, size=size_cond, opacity=opacity_cond,
+            tooltip=['Team', 'PointLabel', 'Rank', 'GapSeconds']
+        ).properties(height=500).interactive(), # 修正: 縦横自由にズーム可能に
+    }
+
+    # チーム比較用 (チームごと、地点ラベルで引ける表) と地点別詳細用の表
+    by_team = {tid: g.set_index('PointLabel') for tid, g in ana_df.groupby('TeamID', sort=False)}
+    by_point = {}
+    for label, pdf in ana_df.groupby('PointLabel', sort=False):
+        ddf = pdf[['Rank', 'Team', 'Split', 'GapSeconds', 'LapStr']].sort_values('Rank')
+        ddf.columns = ["通過順", "チーム", "タイム", "トップ差", "区間タイム"]
+        ddf['トップ差'] = fmt_gap_ms(pdf.loc[ddf.index, 'GapMs'].where(ddf['トップ差'] > 0))
+        by_point[label] = ddf
+    return {"charts": charts, "by_team": by_team, "by_point": by_point}
+
+def render_analysis_dashboard(df, teams_info, race_index=None, key="live"):
+    if race_index is None: race_index = RaceIndex(df)
 
     # メインチーム情報
-    config = st.session_state.get("race_config", {})
+    config = st.session_state.get("race_config") or {}
     main_tid = config.get("MainTeamID", "1")
     main_team_name = teams_info.get(str(main_tid), str(main_tid))
 
+    bundle = build_analysis_bundle(content_version(df), tuple(teams_info.items()), main_team_name, df, race_index)
+    if bundle is None:
+        st.warning("データ不足のため表示できません")
+        return
+
     tab1, tab2, tab3 = st.tabs(["📈 レース推移", "⚔️ チーム比較", "📍 地点別詳細"])
     
     with tab1:
-        graph_type = st.radio("グラフ種類", ["順位変動(通過順)", "トップ差"], horizontal=True, key=f"gtype_{len(df)}")
-        max_rank = len(teams_info) if len(teams_info) > 0 else 1
-        rank_ticks = list(range(1, max_rank + 1))
-        
-        x_axis = alt.X('PointID', title='地点 (操作: ドラッグ移動/ホイール拡大)', 
-                       scale=alt.Scale(domain=[domain_min, domain_max]),
-                       axis=alt.Axis(tickMinStep=1, labels=False))
-
-        # --- 強調表示の設定 ---
-        color_cond = alt.condition(alt.datum.Team == main_team_name, alt.value('#FF4B4B'), alt.value('#CCCCCC'))
-        size_cond = alt.condition(alt.datum.Team == main_team_name, alt.value(3), alt.value(1))
-        opacity_cond = alt.condition(alt.datum.Team == main_team_name, alt.value(1.0), alt.value(0.5))
-
-        if graph_type == "順位変動(通過順)":
-            chart = alt.Chart(ana_df).mark_line(point=True).encode(
-                x=x_axis,
-                y=alt.Y('Rank', scale=alt.Scale(domain=[1, max_rank], zero=False, nice=False), 
-                        axis=alt.Axis(values=rank_ticks, format='d'), title='通過順').scale(reverse=True),
-                color=color_cond, size=size_cond, opacity=opacity_cond,
-                tooltip=['Team', 'PointLabel', 'Rank', 'Split']
-            ).properties(height=500).interactive() # 修正: 縦横自由にズーム可能に
-            
-            st.altair_chart(chart, use_container_width=True)
-            st.caption("※グラフ操作: ドラッグでスクロール、ホイール/ピンチで拡大縮小。赤色がメインチームです。")
-        else:
-            chart = alt.Chart(ana_df).mark_line(point=True).encode(
-                x=x_axis,
-                y=alt.Y('GapSeconds', scale=alt.Scale(reverse=True, nice=True), title='トップ差(秒)'),
-                color=color_cond, size=size_cond, opacity=opacity_cond,
-                tooltip=['Team', 'PointLabel', 'Rank', 'GapSeconds']
-            ).properties(height=500).interactive() # 修正: 縦横自由にズーム可能に
-            
-            st.altair_chart(chart, use_container_width=True)
-            st.caption("※グラフ操作: ドラッグでスクロール、ホイール/ピンチで拡大縮小。赤色がメインチームです。")
+        graph_type = st.radio("グラフ種類", list(bundle["charts"].keys()), horizontal=True, key=f"gtype_{key}")
+        st.altair_chart(bundle["charts"][graph_type], use_container_width=True)
+        st.caption("※グラフ操作: ドラッグでスクロール、ホイール/ピンチで拡大縮小。赤色がメインチームです。")
 
     with tab2:
         cols = st.columns(2)
@@ -287,47 +307,36 @@ def render_analysis_dashboard(df, teams_info):
         try: main_idx = tl.index(main_team_name)
         except: main_idx = 0
         if tl:
-            with cols[0]: ta = st.selectbox("チームA", tl, index=main_idx, key=f"ta_{len(df)}")
-            with cols[1]: tb = st.selectbox("チームB", tl, index=(main_idx + 1) % len(tl) if len(tl) > 1 else 0, key=f"tb_{len(df)}")
+            with cols[0]: ta = st.selectbox("チームA", tl, index=main_idx, key=f"ta_{key}")
+            with cols[1]: tb = st.selectbox("チームB", tl, index=(main_idx + 1) % len(tl) if len(tl) > 1 else 0, key=f"tb_{key}")
             
             if ta and tb:
                 tid_a = [k for k, v in teams_info.items() if v == ta][0]
                 tid_b = [k for k, v in teams_info.items() if v == tb][0]
-                da, db = ana_df[ana_df['TeamID']==tid_a].set_index('PointLabel'), ana_df[ana_df['TeamID']==tid_b].set_index('PointLabel')
-                cp = da.index.intersection(db.index)
-                if not cp.empty:
-                    rr = []
-                    for pt in cp:
-                        ra, rb = da.loc[pt], db.loc[pt]
-                        ds = ra['SplitSeconds'] - rb['SplitSeconds']
-                        rr.append({
-                            "地点": pt, 
-                            f"{ta} 通過順": f"{ra['Rank']}", 
-                            f"{tb} 通過順": f"{rb['Rank']}", 
-                            "タイム差": fmt_time(abs(ds)), 
-                            f"{ta} P-Lap": ra['KMLapStr'], 
-                            f"{tb} P-Lap": rb['KMLapStr']
-                        })
-                    st.dataframe(pd.DataFrame(rr), use_container_width=True, hide_index=True)
+                da, db = bundle["by_team"].get(tid_a), bundle["by_team"].get(tid_b)
+                if da is not None and db is not None:
+                    cp = da.join(db, how='inner', lsuffix='_a', rsuffix='_b')
+                    if not cp.empty:
+                        st.dataframe(pd.DataFrame({
+                            "地点": cp.index,
+                            f"{ta} 通過順": cp['Rank_a'].astype(str).to_numpy(),
+                            f"{tb} 通過順": cp['Rank_b'].astype(str).to_numpy(),
+                            "タイム差": fmt_time_ms((cp['GapMs_a'] - cp['GapMs_b']).abs()).to_numpy(),
+                            f"{ta} P-Lap": cp['KMLapStr_a'].to_numpy(),
+                            f"{tb} P-Lap": cp['KMLapStr_b'].to_numpy(),
+                        }), use_container_width=True, hide_index=True)
 
     with tab3:
-        popts = ana_df['PointLabel'].unique()
-        tpt = st.selectbox("地点", popts, key=f"tpt_{len(df)}")
-        if tpt:
-            pdf = ana_df[ana_df['PointLabel']==tpt].copy()
-            ddf = pdf[['Rank','Team','Split','GapSeconds','LapStr']].sort_values('Rank')
-            ddf.columns = ["通過順","チーム","タイム","トップ差","区間タイム"]
-            ddf['トップ差'] = ddf['トップ差'].apply(lambda x: f"+{fmt_time(x)}" if x>0 else "-")
-            st.dataframe(ddf, use_container_width=True, hide_index=True)
-
-def render_result_list(df):
-    finish_df = df[df['Location'] == 'Finish'].copy()
+        tpt = st.selectbox("地点", list(bundle["by_point"].keys()), key=f"tpt_{key}")
+        if tpt: st.dataframe(bundle["by_point"][tpt], use_container_width=True, hide_index=True)
+
+def render_result_list(df, race_index=None):
+    if race_index is None: race_index = RaceIndex(df)
+    finish_df = race_index.location('Finish')
     if finish_df.empty:
         st.warning("完走したチームはありません")
         return
-    if 'SplitSeconds' not in finish_df.columns:
-        finish_df['SplitSeconds'] = finish_df['Split'].apply(str_to_sec)
-    finish_df = finish_df.sort_values('SplitSeconds').reset_index(drop=True)
+    finish_df = finish_df.reset_index(drop=True)
     
     for idx, row in finish_df.iterrows():
         rank = idx + 1
@@ -339,27 +348,11 @@ def render_result_list(df):
                 border-left: 10px solid {bg}; box-shadow: 0 2px 5px rgba(0,0,0,0.1);">
                 <div style="font-size: 24px; font-weight: bold; width: 60px;">{medal}</div>
                 <div style="flex-grow: 1; font-size: 20px; font-weight: bold;">{row['TeamName']}</div>
-                <div style="font-size: 24px; font-family: monospace; font-weight: bold;">{row['Split']}</div>
+                <div style="font-size: 24px; font-family: monospace; font-weight: bold;">{fmt_time(row['SplitMs'] / 1000)}</div>
             </div>
         """, unsafe_allow_html=True)
 
 def initialize_race(race_name, section_count, teams_dict, main_team_id):
-    gc = get_gspread_client()
-    sh = gc.open_by_url(SHEET_URL)
-    try: sh.worksheet(WORKSHEET_INDEX)
-    except: 
-        ws_idx = sh.add_worksheet(title=WORKSHEET_INDEX, rows=100, cols=10)
-        ws_idx.append_row(["RaceID", "RaceName", "Date", "LogSheet", "ConfigSheet", "Note"])
-    try: 
-        ws_log = sh.worksheet(WORKSHEET_LOG)
-        ws_log.clear()
-        ws_log.append_row(["TeamID", "TeamName", "Section", "Location", "Time", "Race"])
-    except: pass
-    try: 
-        ws_conf = sh.worksheet(WORKSHEET_CONFIG)
-        ws_conf.clear()
-        ws_conf.append_row(["Key", "Value"])
-    except: pass
     config_data = [
         ["RaceName", race_name],
         ["SectionCount", str(section_count)],
@@ -368,64 +361,249 @@ def initialize_race(race_name, section_count, teams_dict, main_team_id):
     ]
     for tid, tname in teams_dict.items():
         config_data.append([f"TeamName_{tid}", tname])
-    ws_conf.append_rows(config_data)
-    st.cache_data.clear()
+    get_write_queue().flush()
+    get_storage().start_race(config_data)
+    reset_live_log()
+    clear_my_events()
+    clear_race_cache()
     new_config = {}
     for item in config_data: new_config[item[0]] = item[1]
     st.session_state["race_config"] = new_config
 
-# ▼▼▼ JSタイマー (Point Lap表記) ▼▼▼
-def show_js_timer(km_sec, sec_sec, split_sec):
-    km_ms, sec_ms, split_ms = int(km_sec * 1000), int(sec_sec * 1000), int(split_sec * 1000)
-    html_code = f"""
-    <!DOCTYPE html><html><head><style>
-        @import url('https://fonts.googleapis.com/css2?family=Chakra+Petch:wght@600&display=swap');
-        body {{ margin: 0; background-color: transparent; font-family: sans-serif; }}
-        .timer-container {{ display: flex; justify-content: space-between; align-items: center; background-color: #262730; padding: 10px 5px; border-radius: 12px; border: 1px solid #444; color: white; box-sizing: border-box; width: 100%; margin-bottom: 5px; overflow: hidden; }}
-        .timer-box {{ text-align: center; flex: 1; min-width: 0; }}
-        label {{ font-size: 11px; color: #ccc; margin-bottom: 4px; letter-spacing: 0.5px; white-space: nowrap; }}
-        .value {{ font-family: 'Chakra Petch', sans-serif; font-weight: 600; font-style: italic; font-size: 26px; line-height: 1.1; letter-spacing: 1px; }}
-        .separator {{ width: 1px; height: 35px; background-color: #555; }}
-        .decimal {{ font-size: 0.6em; opacity: 0.7; }}
-        .color-km {{ color: #4bd6ff; }} .color-sec {{ color: #ff4b4b; }} .color-total {{ color: #ffffff; }}
-        @media (max-width: 480px) {{ .value {{ font-size: 20px; letter-spacing: 0; }} .label {{ font-size: 9px; }} .timer-container {{ padding: 8px 2px; }} }}
-    </style></head><body>
-    <div class="timer-container">
-        <div class="timer-box"><div class="label">Point Lap</div><div id="km-val" class="value color-km">--:--.--</div></div>
-        <div class="separator"></div>
-        <div class="timer-box"><div class="label">Section Lap</div><div id="sec-val" class="value color-sec">--:--.--</div></div>
-        <div class="separator"></div>
-        <div class="timer-box"><div class="label">Total</div><div id="split-val" class="value color-total">--:--:--</div></div>
-    </div>
-    <script>
-        const now = Date.now();
-        const startKm = now - {km_ms}; const startSec = now - {sec_ms}; const startSplit = now - {split_ms};
-        function fmt(ms, isSplit) {{
-            if (ms < 0) return "--:--.--";
-            const totalTenths = Math.floor(ms / 100); const totalSec = Math.floor(ms / 1000);
-            const h = Math.floor(totalSec / 3600); const m = Math.floor((totalSec % 3600) / 60); const s = totalSec % 60; const dec = Math.floor((ms % 1000) / 100); 
-            const mStr = String(m).padStart(2,'0'); const sStr = String(s).padStart(2,'0');
-            if (isSplit) {{ return `${{h}}:${{mStr}}:${{sStr}}`; }} else {{ return `${{mStr}}:${{sStr}}<span class="decimal">.${{dec}}</span>`; }}
-        }}
-        function update() {{
-            const cur = Date.now();
-            document.getElementById("km-val").innerHTML = fmt(cur - startKm, false);
-            document.getElementById("sec-val").innerHTML = fmt(cur - startSec, false);
-            document.getElementById("split-val").innerHTML = fmt(cur - startSplit, true);
-        }}
-        setInterval(update, 100); update();
-    </script></body></html>
+# ▼▼▼ ライブタイマー (Point Lap表記) ▼▼▼
+# カスタムコンポーネント (frontend/live_timer)。iframe は key ごとに1回だけ読み込まれ、
+# 再実行のたびに送るのは基準時刻だけ (フォント・CSS の読み直しやタイマーの作り直しをしない)
+_live_timer = components.declare_component("live_timer", path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "frontend", "live_timer"))
+
+def team_timer(race_index, tid, label):
+    # 1チーム分のタイマーの基準時刻 (エポックミリ秒)。フィニッシュ済みならゴールタイムだけ
+    t_df = race_index.team(tid)
+    if t_df.empty or pd.isna(race_index.start_ms): return None
+    last = t_df.iloc[-1]
+    timer = {"id": tid, "label": label, "start": int(race_index.start_ms)}
+    if last['Location'] == 'Finish': return {**timer, "finish": int(last['SplitMs'])}
+    sec_start_ms = race_index.start_ms
+    if last['Section'] != "1区":
+        prev_relay = t_df[(t_df['Section'] == f"{int(last['Section'].replace('区',''))-1}区") & (t_df['Location'] == 'Relay')]
+        if not prev_relay.empty: sec_start_ms = prev_relay.iloc[0]['TimeMs']
+    return {**timer, "point": int(last['TimeMs']), "section": int(sec_start_ms)}
+
+def live_timer(timers, key="live_timer"):
+    """
+    timers: team_timer のリスト (先頭は大きく、2件目以降は1行で表示)。
+    行が押されたら、そのチームの id を返す (1回の押下につき1回だけ)。
+    """
+    timers = [t for t in timers if t]
+    if not timers: return None
+    clicked = _live_timer(timers=timers, server_ms=int(time.time() * 1000), key=key, default=None)
+    if not clicked or clicked.get("seq") == st.session_state.get(f"{key}_seq"): return None
+    st.session_state[f"{key}_seq"] = clicked.get("seq")
+    return clicked.get("id")
+
+# ==========================================
+# 📣 観戦モードのパネル
+# ==========================================
+# 観戦画面のパネルは3つの fragment (現在地・タイマー / 前後差 / 通過履歴) に分け、それぞれ watch_poll_sec ごとに
+# 自分の部分だけを再実行する (アプリ全体は再実行しない)。記録・編集のたびに RaceHub の変更カウンタが増えるので、
+# カウンタが変わらずスナップショットも新しいうちは前回の内容 (watch_view) を使う。
+# 各パネルは自分の表示に関わる部分 (パネルごとの key) が変わったときだけ表示内容を作り直し、変わらなければ
+# 前回作った表示内容 (HTML・整形済みの表) をそのまま出し直す
+# (fragment は出し直さなかった要素を消すので、何も出さずに戻ることはできない)
+def measure_fragment(kind):
+    # 部分更新1回分の CPU 時間を記録する (全体の再実行の中で呼ばれたときは全体の分に含まれるので数えない)
+    def deco(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            ctx = get_script_run_ctx()
+            if not (ctx and ctx.fragment_ids_this_run): return fn(*args, **kwargs)
+            with get_cpu_meter().measure(kind, ctx.session_id): return fn(*args, **kwargs)
+        return run
+    return deco
+
+def watch_team(tid):
+    # 表示中チームの記録と、そのチームの最後の通過 (タイマーの基準)
+    race_index = load_live_race().index
+    t_df = race_index.team(tid)
+    anchor = None if t_df.empty else (t_df.iloc[-1]['Section'], t_df.iloc[-1]['Location'], int(t_df.iloc[-1]['TimeMs']))
+    return race_index, t_df, anchor
+
+def watch_view_key(race_index, t_df, anchor, extra_tids=()):
+    # 観戦画面に出る内容の要約: 最後の通過・各通過の順位・その地点を通過したチーム数 (前後差)・並べたチームの最後の通過
+    if anchor is None: return None
+    extra = tuple(None if race_index.latest(tid) is None else int(race_index.latest(tid)['TimeMs']) for tid in extra_tids)
+    return anchor, tuple(t_df['Rank'].tolist()), len(race_index.point(anchor[0], anchor[1])), extra
+
+def watch_view(tid, extra_tids):
+    # 表示する内容。変更カウンタが動いたか TTL が切れたときだけスナップショットを引き直し、
+    # 表示中のチームに関わる変更 (watch_view_key) があったときだけ作り直す
+    hub = get_race_hub()
+    view = st.session_state.get("watch_view")
+    if view is not None and view["tids"] == (tid, extra_tids) and hub.changes == view["changes"] and hub.is_fresh(): return view
+    changes = hub.changes
+    race_index, t_df, anchor = watch_team(tid)
+    key = watch_view_key(race_index, t_df, anchor, extra_tids)
+    if view is None or view["tids"] != (tid, extra_tids) or key != view["key"]:
+        preds = {t: predict_next_passing(race_index, t) for t in (tid, *extra_tids)}
+        view = {"tids": (tid, extra_tids), "key": key, "index": race_index, "t_df": t_df, "preds": preds,
+                "eta": min((p[1] for p in preds.values() if p), default=None)}
+    st.session_state["watch_view"] = {**view, "changes": changes}
+    return st.session_state["watch_view"]
+
+def watch_poll_sec(view):
+    # (パネルを部分更新する間隔, 共有スナップショットを読み直してほしい間隔 (None なら既定))
+    # 次の通過予想の前後は短く、それ以外は全体を再実行していたころと同じ CACHE_TTL_SEC ごと
+    interval = refresh_interval(view["eta"], time.time() * 1000, WATCH_REFRESH_MIN_SEC, WATCH_REFRESH_MAX_SEC)
+    return min(interval or CACHE_TTL_SEC, CACHE_TTL_SEC), interval
+
+def watch_part(name, key, build):
+    # パネルごとの表示内容。key が前回と同じなら作り直さない
+    parts = st.session_state.setdefault("watch_parts", {})
+    if name not in parts or parts[name][0] != key: parts[name] = (key, build())
+    return parts[name][1]
+
+# 3つのパネルは呼び出し側で st.fragment(..., run_every=watch_poll_sec) として出す (間隔はアプリ全体の再実行ごとに決め直す)
+@measure_fragment("watch_info")
+def watch_info_fragment(tid, extra_tids, team_options):
+    view = watch_view(tid, extra_tids)
+    # 表示中のチームの次の通過予想が近いほど短い間隔で読み直してもらう
+    poll, interval = watch_poll_sec(view)
+    get_race_hub().want(get_script_run_ctx().session_id, interval)
+    # 部分更新の間隔が変わったら (予想の前後に入った・通過した)、間隔を付け直すためにアプリ全体を再実行する (通過1回につき2回ほど)
+    if poll != st.session_state.get("watch_poll_sec"): st.rerun(scope="app")
+    # 現在地・通過順・通過予想は最後の通過と順位、タイマーは表示中と並べたチームの最後の通過で決まる
+    key = None if view["key"] is None else (view["tids"], view["key"][0], view["key"][1][-1], view["key"][3])
+    info = watch_part("info", key, lambda: watch_info_view(view, team_options))
+    if info["html"] is None: st.info("まだ記録がありません"); return
+    st.markdown(info["html"], unsafe_allow_html=True)
+    if info["finish_html"]: st.markdown(info["finish_html"], unsafe_allow_html=True)
+    # 表示中のチームを大きく、並べるチームは1行ずつ (押すとそのチームに切り替え。選択欄も変わるのでアプリ全体を再実行)
+    clicked = live_timer(info["timers"], key="watch_timer")
+    if clicked and clicked != tid: st.session_state["watch_tid"] = clicked; st.rerun(scope="app")
+
+@measure_fragment("watch_gaps")
+def watch_gaps_fragment(tid, extra_tids, teams_info):
+    view = watch_view(tid, extra_tids)
+    if view["key"] is None: return
+    # 直近ラップと前後差は最後の通過と、その地点を通過したチーム数で決まる
+    gaps = watch_part("gaps", (tid, view["key"][0], view["key"][2]), lambda: watch_gap_view(tid, teams_info, view["index"], view["t_df"]))
+    if gaps["lap"]:
+        st.markdown(f"<div style='text-align: center; background-color: #333; padding: 8px; border-radius: 5px; margin-bottom: 10px; margin-top: 10px;'>⏱️ 直近ラップ(P): <span style='font-weight:bold; color:#4bd6ff; font-family: monospace; font-size: 1.1em;'>{gaps['lap']}</span></div>", unsafe_allow_html=True)
+    if gaps["rows"] is None: return
+    (prev_kind, prev_text), (next_kind, next_text) = gaps["rows"]
+    c_prev, c_next = st.columns(2)
+    with c_prev: getattr(st, prev_kind)(prev_text)
+    with c_next: getattr(st, next_kind)(next_text)
+
+@measure_fragment("watch_history")
+def watch_history_fragment(tid, extra_tids):
+    view = watch_view(tid, extra_tids)
+    if view["key"] is None: return
+    # 通過履歴は表示中のチームの通過と順位で決まる
+    history = watch_part("history", (tid, view["key"][0], view["key"][1]), lambda: watch_history_table(view["t_df"]))
+    st.divider()
+    st.write("📝 通過履歴")
+    st.dataframe(history, use_container_width=True, hide_index=True)
+
+def watch_info_view(view, team_options):
+    # 現在地パネル・フィニッシュ表示の HTML と、タイマーの基準時刻
+    tid, extra_tids = view["tids"]
+    race_index, t_df = view["index"], view["t_df"]
+    if t_df.empty: return {"html": None}
+    last = t_df.iloc[-1]
+    loc_raw = last['Location']
+    display_loc = f"{last['Section']} {loc_raw}"
+    if "P" in loc_raw: display_loc = f"🏃‍♂️ 現在地: {last['Section']} {loc_raw} 〜"
+    elif loc_raw == "Start": display_loc = "🏃‍♂️ 現在地: スタート地点"
+    elif loc_raw == "Relay": display_loc = f"🏃‍♂️ 現在地: {last['Section']} 中継所"
+    elif loc_raw == "Finish": display_loc = "🏃‍♂️ 現在地: フィニッシュ"
+    next_html = ""
+    pred = view["preds"][tid]
+    if pred:
+        nxt, eta = pred
+        where = f"{nxt[0]} {nxt[1]}" if nxt else "次の地点"
+        next_html = f'<div class="sub-text">⏳ {where} 通過予想: {datetime.fromtimestamp(eta / 1000, JST).strftime("%H:%M")} ごろ</div>'
+
+    html = f"""
+        <style>
+        .info-panel {{ background-color: #262730; padding: 15px; border-radius: 10px; margin-bottom: 20px; border: 1px solid #4f4f4f; text-align: center; width: 100%; box-sizing: border-box; }}
+        .loc-text {{ font-size: 20px; color: white; font-weight: bold; }}
+        .sub-text {{ font-size: 14px; color: #aaa; margin-top: 5px; }}
+        </style>
+        <div class="info-panel">
+            <div class="loc-text">{display_loc}</div>
+            <div class="sub-text">通過順: {int(last['Rank'])}番目</div>{next_html}
+        </div>
     """
-    components.html(html_code, height=110)
+    finished = loc_raw == 'Finish'
+    finish_html = None
+    if finished:
+        finish_html = f"""
+            <div style="border: 4px solid #FFD700; border-radius: 15px; background: linear-gradient(135deg, #262730, #444); padding: 30px; text-align: center; color: white; margin-bottom: 20px; box-shadow: 0 0 20px rgba(255, 215, 0, 0.4);">
+                <div style="font-size: 16px; color: #FFD700; letter-spacing: 2px;">OFFICIAL FINISHER</div>
+                <h1 style="font-size: 48px; margin: 10px 0; font-family: 'Arial Black', sans-serif;">FINISH!</h1>
+                <hr style="border: 1px solid #777; width: 60%;">
+                <div style="font-size: 24px; font-weight: bold; margin-top: 20px;">TIME: {fmt_time(last['SplitMs'] / 1000)}</div>
+            </div>
+        """
+    timers = ([] if finished else [team_timer(race_index, tid, team_options[tid])]) \
+             + [team_timer(race_index, t, team_options[t]) for t in extra_tids]
+    return {"html": html, "finish_html": finish_html, "timers": timers}
+
+def watch_gap_view(tid, teams_info, race_index, t_df):
+    # 直近ラップと、同じ地点の前後のチームとの差 (表示する文字列)
+    last = t_df.iloc[-1]
+    gaps = {"lap": None, "rows": None}
+    try:
+        last_lap = fmt_lap(last['PointMs'] / 1000)
+        if last_lap and last_lap != "nan": gaps["lap"] = last_lap
+    except: pass
+
+    loc_df = race_index.point(last['Section'], last['Location'])
+    if not loc_df.empty:
+        loc_df = loc_df.reset_index(drop=True)
+        my_indices = loc_df.index[loc_df['TeamID'].astype(str) == str(tid)].tolist()
+        if my_indices:
+            my_idx = my_indices[0]
+            my_split = loc_df.iloc[my_idx]['SplitMs'] / 1000
+            prev, nxt = ("success", "👑 現在トップ！"), ("write", "（後ろはいません）")
+            if my_idx > 0:
+                prev_row = loc_df.iloc[my_idx - 1]
+                diff = my_split - prev_row['SplitMs'] / 1000
+                prev_name = teams_info.get(str(prev_row['TeamID']), prev_row['TeamName'])
+                prev = ("info", f"⬆️ 前: **{prev_name}**\n\n+{fmt_time(diff)}")
+            if my_idx < len(loc_df) - 1:
+                next_row = loc_df.iloc[my_idx + 1]
+                diff = next_row['SplitMs'] / 1000 - my_split
+                next_name = teams_info.get(str(next_row['TeamID']), next_row['TeamName'])
+                nxt = ("warning", f"⬇️ 後ろ: **{next_name}**\n\n-{fmt_time(diff)}")
+            gaps["rows"] = (prev, nxt)
+    return gaps
+
+def watch_history_table(t_df):
+    # --- 履歴テーブル (表示するチームの行だけ整形) ---
+    history_df = t_df[['Section', 'Location', 'Rank', 'SplitMs', 'PointMs', 'PrevDiffMs']].iloc[::-1].copy()
+    history_df['タイム'] = fmt_time_ms(history_df['SplitMs'])
+    history_df['P-Lap'] = fmt_lap_ms(history_df['PointMs'])
+    history_df['前との差'] = fmt_gap_ms(history_df['PrevDiffMs'])
+    history_df = history_df.rename(columns={
+        'Section': '区間', 'Location': '地点', 'Rank': '通過順'
+    })
+    # 毎回の出し直しで DataFrame から Arrow への変換をしないように、Arrow の表にして持っておく
+    return pa.Table.from_pandas(history_df[['区間', '地点', '通過順', 'タイム', 'P-Lap', '前との差']], preserve_index=False)
 
 # ==========================================
 # アプリのモード管理 & Configロード
 # ==========================================
-conn = st.connection("gsheets", type=GSheetsConnection)
+storage = get_storage()
+get_standings_feed()
 
 if "race_config" not in st.session_state: st.session_state["race_config"] = None
 if st.session_state["race_config"] is None:
-    loaded_conf = fetch_config_from_sheet(conn)
+    try: loaded_conf = fetch_config_from_sheet(storage)
+    except QuotaThrottled:
+        st.warning("アクセスが集中していて設定を読み込めませんでした。少し待ってから再読み込みしてください。")
+        st.button("🔄 再読み込み")
+        st.stop()
     if loaded_conf: st.session_state["race_config"] = loaded_conf
 
 config = st.session_state["race_config"]
@@ -434,7 +612,8 @@ if "app_mode" not in st.session_state: st.session_state["app_mode"] = "📣 観
 if (config is None or "RaceName" not in config) and st.session_state["app_mode"] not in ["📂 過去のレース", "⚙️ 管理者モード"]:
     st.session_state["app_mode"] = "🏁 レース作成"
 
-df_for_check = load_data(conn, WORKSHEET_LOG)
+race_snap = load_live_race()
+df_for_check = race_snap.frame
 is_race_started = not df_for_check.empty
 
 # サイドバー
@@ -507,6 +686,7 @@ if current_mode == "🏁 レース作成":
 elif current_mode in ["⏱️ 記録点モード", "🎽 中継点モード", "📣 観戦モード", "📈 分析モード", "🏆 最終結果"]:
     if not config: st.error("設定が読み込めません。"); st.stop()
     df = df_for_check
+    race_index = race_snap.index
     teams_info = {}
     team_ids_ordered = []
     main_team_id = config.get("MainTeamID", "1")
@@ -522,12 +702,9 @@ elif current_mode in ["⏱️ 記録点モード", "🎽 中継点モード", "
     finish_count = 0
     if not df.empty:
         for tid in team_ids_ordered:
-            t_df = df[df['TeamID'] == tid]
-            if not t_df.empty:
-                last_row = t_df.iloc[-1]
-                team_status[tid] = last_row
-                if last_row['Location'] == "Finish": finish_count += 1
-            else: team_status[tid] = None
+            last_row = race_index.latest(tid)
+            team_status[tid] = last_row
+            if last_row is not None and last_row['Location'] == "Finish": finish_count += 1
 
     # ⏱️ 記録点 & 🎽 中継点
     if current_mode in ["⏱️ 記録点モード", "🎽 中継点モード"]:
@@ -535,21 +712,32 @@ elif current_mode in ["⏱️ 記録点モード", "🎽 中継点モード", "
             st.info("レース前")
             if st.button("🔫 スタート", type="primary", use_container_width=True):
                 now = datetime.now(JST)
-                start_rows = []
-                for tid in team_ids_ordered:
-                    start_rows.append([tid, teams_info[tid], "1区", "Start", get_time_str(now), config["RaceName"]])
-                gc = get_gspread_client()
-                gc.open_by_url(SHEET_URL).worksheet(WORKSHEET_LOG).append_rows(start_rows)
-                st.cache_data.clear()
+                event_seq = st.session_state.setdefault("event_seq", EventSequence())
+                start_rows = [[tid, teams_info[tid], "1区", "Start", get_time_str(now), config["RaceName"], event_seq.next(), "", ""]
+                              for tid in team_ids_ordered]
+                get_write_queue().enqueue(start_rows)
+                st.session_state.setdefault("my_events", []).append(start_rows)
+                st.session_state["my_redo"] = []
+                show_my_writes()
                 st.rerun()
             st.stop()
         
         def record_point(tid, section, location, is_finish=False):
             now = datetime.now(JST)
-            new_row = [tid, teams_info[tid], section, location, get_time_str(now), config["RaceName"]]
-            gc = get_gspread_client()
-            gc.open_by_url(SHEET_URL).worksheet(WORKSHEET_LOG).append_row(new_row)
-            st.cache_data.clear()
+            # 回線が悪いと結果が出るまでに同じボタンを2回押しがち。この端末の直前の記録と同じなら送らない
+            last = (st.session_state.get("my_events") or [[]])[-1]
+            gap = tap_interval_ms(last[0][4], get_time_str(now)) if len(last) == 1 and last[0][:4] == [tid, teams_info[tid], section, location] else None
+            if gap is not None and gap <= DOUBLE_TAP_SEC * 1000:
+                st.toast(f"{teams_info[tid]}: {location} は記録済みです (二重タップ)")
+                return
+            new_row = [tid, teams_info[tid], section, location, get_time_str(now), config["RaceName"],
+                       st.session_state.setdefault("event_seq", EventSequence()).next(), "", ""]
+            # 時刻はタップした瞬間のもの。シートへの送信は裏でまとめて行う
+            # この端末で記録した行を覚えておき、元に戻す/やり直すはその EventID への操作行を追記する
+            get_write_queue().enqueue([new_row])
+            st.session_state.setdefault("my_events", []).append([new_row])
+            st.session_state["my_redo"] = []
+            show_my_writes()
             st.toast(f"{teams_info[tid]}: {location} 記録完了")
 
         target_point = 1
@@ -592,18 +780,26 @@ elif current_mode in ["⏱️ 記録点モード", "🎽 中継点モード", "
                         st.rerun()
         
         st.markdown("<hr style='margin: 15px 0;'>", unsafe_allow_html=True)
-        if st.button("↩️ 元に戻す", use_container_width=True, type="secondary"):
-            try:
-                gc = get_gspread_client()
-                ws = gc.open_by_url(SHEET_URL).worksheet(WORKSHEET_LOG)
-                all_vals = ws.get_all_values()
-                if len(all_vals) > 1: ws.delete_rows(len(all_vals)); st.cache_data.clear(); st.toast("削除しました"); st.rerun()
-            except Exception as e: st.error(f"Undoエラー: {e}")
+        # 元に戻す/やり直す: 行は消さず、この端末の記録の EventID に対する操作行を追記する (何段でも可)
+        def apply_op(rows, op):
+            now_str = get_time_str(datetime.now(JST))
+            event_seq = st.session_state.setdefault("event_seq", EventSequence())
+            get_write_queue().enqueue([[*r[:4], now_str, r[5], event_seq.next(), op, r[6]] for r in rows])
+            show_my_writes()
+
+        my_events, my_redo = st.session_state.setdefault("my_events", []), st.session_state.setdefault("my_redo", [])
+        col_undo, col_redo = st.columns(2)
+        with col_undo:
+            if st.button(f"↩️ 元に戻す ({len(my_events)})", use_container_width=True, type="secondary", disabled=not my_events):
+                rows = my_events.pop(); apply_op(rows, OP_UNDO); my_redo.append(rows)
+                st.toast(f"{rows[0][1]}: {rows[0][3]} を取り消しました" if len(rows) == 1 else "スタートを取り消しました"); st.rerun()
+        with col_redo:
+            if st.button(f"↪️ やり直す ({len(my_redo)})", use_container_width=True, type="secondary", disabled=not my_redo):
+                rows = my_redo.pop(); apply_op(rows, OP_REDO); my_events.append(rows)
+                st.toast(f"{rows[0][1]}: {rows[0][3]} を戻しました" if len(rows) == 1 else "スタートを戻しました"); st.rerun()
 
     # 📣 観戦モード (v2.0.7)
     elif current_mode == "📣 観戦モード":
-        st_autorefresh(interval=AUTOREFRESH_INTERVAL, key="watch_refresh")
-        
         if "watch_tid" not in st.session_state: st.session_state["watch_tid"] = main_team_id
         team_options = {tid: f"No.{tid} {teams_info.get(tid, '')}" for tid in team_ids_ordered}
         curr_idx = 0
@@ -611,128 +807,68 @@ elif current_mode in ["⏱️ 記録点モード", "🎽 中継点モード", "
         selected_tid = st.selectbox("チーム選択", options=team_ids_ordered, format_func=lambda x: team_options[x], index=curr_idx)
         st.session_state["watch_tid"] = selected_tid
 
-        t_df = df[df['TeamID'] == selected_tid]
-        if t_df.empty: st.info("まだ記録がありません")
-        else:
-            last = t_df.iloc[-1]
-            last_time = last['dt']
-            now = datetime.now(JST)
-            try: start_time = df[df['Location'] == 'Start'].iloc[0]['dt']
-            except: start_time = now
-            sec_start_time = start_time
-            if last['Section'] != "1区":
-                prev_relay = t_df[(t_df['Section'] == f"{int(last['Section'].replace('区',''))-1}区") & (t_df['Location'] == 'Relay')]
-                if not prev_relay.empty: sec_start_time = prev_relay.iloc[0]['dt']
-            
-            elapsed_km, elapsed_sec, elapsed_split = (now - last_time).total_seconds(), (now - sec_start_time).total_seconds(), (now - start_time).total_seconds()
-            
-            loc_raw = last['Location']
-            display_loc = f"{last['Section']} {loc_raw}"
-            if "P" in loc_raw: display_loc = f"🏃‍♂️ 現在地: {last['Section']} {loc_raw} 〜"
-            elif loc_raw == "Start": display_loc = "🏃‍♂️ 現在地: スタート地点"
-            elif loc_raw == "Relay": display_loc = f"🏃‍♂️ 現在地: {last['Section']} 中継所"
-            elif loc_raw == "Finish": display_loc = "🏃‍♂️ 現在地: フィニッシュ"
-
-            st.markdown(f"""
-                <style>
-                .info-panel {{ background-color: #262730; padding: 15px; border-radius: 10px; margin-bottom: 20px; border: 1px solid #4f4f4f; text-align: center; width: 100%; box-sizing: border-box; }}
-                .loc-text {{ font-size: 20px; color: white; font-weight: bold; }}
-                .sub-text {{ font-size: 14px; color: #aaa; margin-top: 5px; }}
-                </style>
-                <div class="info-panel">
-                    <div class="loc-text">{display_loc}</div>
-                    <div class="sub-text">通過順: {int(last['Rank'])}番目</div>
-                </div>
-            """, unsafe_allow_html=True)
-
-            if last['Location'] == 'Finish':
-                st.markdown(f"""
-                    <div style="border: 4px solid #FFD700; border-radius: 15px; background: linear-gradient(135deg, #262730, #444); padding: 30px; text-align: center; color: white; margin-bottom: 20px; box-shadow: 0 0 20px rgba(255, 215, 0, 0.4);">
-                        <div style="font-size: 16px; color: #FFD700; letter-spacing: 2px;">OFFICIAL FINISHER</div>
-                        <h1 style="font-size: 48px; margin: 10px 0; font-family: 'Arial Black', sans-serif;">FINISH!</h1>
-                        <hr style="border: 1px solid #777; width: 60%;">
-                        <div style="font-size: 24px; font-weight: bold; margin-top: 20px;">TIME: {last['Split']}</div>
-                    </div>
-                """, unsafe_allow_html=True)
-            else: show_js_timer(elapsed_km, elapsed_sec, elapsed_split)
+        extra_tids = st.multiselect("タイマーを並べて表示するチーム", [t for t in team_ids_ordered if t != selected_tid],
+                                    format_func=lambda x: team_options[x], key="watch_extra")
 
-            try:
-                last_lap = str(last.get('KM-Lap', '-'))
-                if last_lap and last_lap != "nan":
-                    st.markdown(f"<div style='text-align: center; background-color: #333; padding: 8px; border-radius: 5px; margin-bottom: 10px; margin-top: 10px;'>⏱️ 直近ラップ(P): <span style='font-weight:bold; color:#4bd6ff; font-family: monospace; font-size: 1.1em;'>{last_lap}</span></div>", unsafe_allow_html=True)
-            except: pass
-
-            loc_df = df[(df['Section'] == last['Section']) & (df['Location'] == last['Location'])].copy()
-            if 'SplitSeconds' in loc_df.columns:
-                loc_df = loc_df.sort_values("SplitSeconds").reset_index(drop=True)
-                my_indices = loc_df.index[loc_df['TeamID'].astype(str) == str(selected_tid)].tolist()
-                if my_indices:
-                    my_idx = my_indices[0]
-                    my_split = loc_df.iloc[my_idx]['SplitSeconds']
-                    c_prev, c_next = st.columns(2)
-                    with c_prev:
-                        if my_idx > 0:
-                            prev_row = loc_df.iloc[my_idx - 1]
-                            diff = my_split - prev_row['SplitSeconds']
-                            prev_name = teams_info.get(str(prev_row['TeamID']), prev_row['TeamName'])
-                            st.info(f"⬆️ 前: **{prev_name}**\n\n+{fmt_time(diff)}")
-                        else: st.success("👑 現在トップ！")
-                    with c_next:
-                        if my_idx < len(loc_df) - 1:
-                            next_row = loc_df.iloc[my_idx + 1]
-                            diff = next_row['SplitSeconds'] - my_split
-                            next_name = teams_info.get(str(next_row['TeamID']), next_row['TeamName'])
-                            st.warning(f"⬇️ 後ろ: **{next_name}**\n\n-{fmt_time(diff)}")
-                        else: st.write("（後ろはいません）")
-
-            st.divider()
-            st.write("📝 通過履歴")
-            
-            # --- 履歴テーブル (v2.0.7) ---
-            history_df = t_df[['Section', 'Location', 'Rank', 'Split', 'KM-Lap', 'PrevDiff']].iloc[::-1].copy()
-            def fmt_diff_val(x):
-                if pd.isna(x): return "-"
-                return f"+{fmt_time(x)}"
-            history_df['前との差'] = history_df['PrevDiff'].apply(fmt_diff_val)
-            history_df = history_df.rename(columns={
-                'Section': '区間', 'Location': '地点', 
-                'Rank': '通過順', 'Split': 'タイム', 'KM-Lap': 'P-Lap'
-            })
-            st.dataframe(history_df[['区間', '地点', '通過順', 'タイム', 'P-Lap', '前との差']], use_container_width=True, hide_index=True)
+        # アプリ全体の再実行 (操作・モード切替) では作り直す
+        st.session_state.pop("watch_view", None); st.session_state.pop("watch_parts", None)
+        poll = st.session_state["watch_poll_sec"] = watch_poll_sec(watch_view(selected_tid, tuple(extra_tids)))[0]
+        st.fragment(watch_info_fragment, run_every=poll)(selected_tid, tuple(extra_tids), team_options)
+        st.fragment(watch_gaps_fragment, run_every=poll)(selected_tid, tuple(extra_tids), teams_info)
+        st.fragment(watch_history_fragment, run_every=poll)(selected_tid, tuple(extra_tids))
+        ctx = get_script_run_ctx()
+        get_cpu_meter().add("watch_full", time.thread_time() - RUN_CPU_START, ctx.session_id if ctx else None)
 
     # 📈 分析モード
     elif current_mode == "📈 分析モード":
         st.header("📈 レース分析")
-        if st.button("🔄 データ更新", type="secondary", use_container_width=False): st.cache_data.clear(); st.rerun()
+        if st.button("🔄 データ更新", type="secondary", use_container_width=False): clear_race_cache(); st.rerun()
         if df.empty: st.info("データがありません。")
-        else: render_analysis_dashboard(df, teams_info)
+        else: render_analysis_dashboard(df, teams_info, race_index)
 
     # 🏆 最終結果
     elif current_mode == "🏆 最終結果":
         st.markdown("""<div style="text-align: center; padding: 40px; background: linear-gradient(to right, #000, #434343); border-radius: 20px; color: white; margin-bottom: 30px;"><h1 style="font-size: 50px; margin-bottom: 10px;">🏆 RACE RESULT</h1><p>レース終了！お疲れ様でした！</p></div>""", unsafe_allow_html=True)
-        render_result_list(df)
+        render_result_list(df, race_index)
 
 # ==========================================
 # 📂 過去のレース閲覧
 # ==========================================
 elif current_mode == "📂 過去のレース":
     st.header("📂 過去のレース閲覧")
-    idx_df = load_data(conn, WORKSHEET_INDEX)
+    catalog = get_race_catalog()
     
-    if idx_df.empty:
+    if catalog.frame().empty:
         st.info("アーカイブされたレースはありません")
     else:
-        idx_df = idx_df.sort_values(by="Date", ascending=False)
-        race_options = {row['RaceID']: f"{row['Date']} - {row['RaceName']}" for _, row in idx_df.iterrows()}
+        # 一覧の絞り込み・並べ替えは race_index のメタデータだけで行う (各レースのログは選んだときに読む)
+        f1, f2 = st.columns([3, 1])
+        q = f1.text_input("レース名・IDで絞り込み", key="arc_query")
+        sort_by = f2.selectbox("並び順", ["新しい順", "古い順", "名前順"], key="arc_sort")
+        sort, ascending = {"新しい順": ("Date", False), "古い順": ("Date", True), "名前順": ("RaceName", True)}[sort_by]
+        idx_df = catalog.query(q, sort=sort, ascending=ascending)
+        st.caption(f"{len(idx_df)} / {len(catalog.frame())} レース (うちローカル保存済み {int(catalog.frame()['Local'].sum())})")
+        race_options = dict(zip(idx_df['RaceID'], idx_df['Date'].dt.strftime('%Y-%m-%d %H:%M').fillna("----") + " - " + idx_df['RaceName']))
         selected_rid = st.selectbox("閲覧するレースを選択", list(race_options.keys()), format_func=lambda x: race_options[x])
         
         if selected_rid:
-            target_row = idx_df[idx_df['RaceID'] == selected_rid].iloc[0]
+            target_row = catalog.get(selected_rid)
             log_sheet = target_row['LogSheet']
             conf_sheet = target_row['ConfigSheet']
             
-            old_df = load_data(conn, log_sheet)
-            old_conf = fetch_config_from_sheet(conn, conf_sheet)
+            # ローカルのアーカイブにあればそこから (計算済み)。無ければシートから読んで計算し、次回用に保存しておく
+            archive_store = get_archive_store()
+            try: old_df, old_conf = archive_store.load(selected_rid); old_conf = old_conf.get("config")
+            except Exception:
+                old_df = load_data(storage, log_sheet)
+                try: old_conf = fetch_config_from_sheet(storage, conf_sheet)
+                except QuotaThrottled: old_conf = None
+                if not old_df.empty and old_conf:
+                    try:
+                        archive_store.save(selected_rid, storage.read_log(log_sheet, ttl=CACHE_TTL_SEC), old_df,
+                                           {"RaceName": target_row['RaceName'], "Date": race_options[selected_rid].split(" - ")[0],
+                                            "LogSheet": log_sheet, "ConfigSheet": conf_sheet, "config": old_conf})
+                    except Exception: pass
             
             if old_df.empty or not old_conf:
                 st.error("データの読み込みに失敗しました")
@@ -743,8 +879,9 @@ elif current_mode == "📂 過去のレース":
                 st.divider()
                 st.subheader(f"Archive: {target_row['RaceName']}")
                 v_tab1, v_tab2 = st.tabs(["📊 分析ビュー", "🏆 結果リスト"])
-                with v_tab1: render_analysis_dashboard(old_df, old_teams)
-                with v_tab2: render_result_list(old_df)
+                old_index = RaceIndex(old_df)
+                with v_tab1: render_analysis_dashboard(old_df, old_teams, old_index, key=f"arc_{selected_rid}")
+                with v_tab2: render_result_list(old_df, old_index)
 
 # ==========================================
 # ⚙️ 管理者モード
@@ -755,35 +892,74 @@ elif current_mode == "⚙️ 管理者モード":
     
     if pwd == ADMIN_PASSWORD:
         st.success("認証成功")
-        if st.button("設定データを強制リロード", use_container_width=True): st.session_state["race_config"]=None; st.cache_data.clear(); st.rerun()
+        if st.button("設定データを強制リロード", use_container_width=True): st.session_state["race_config"]=None; clear_race_cache(); st.rerun()
+
+        st.write("### 📊 共有スナップショット")
+        hub_m = get_race_hub().metrics()
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("バージョン", hub_m["version"])
+        m2.metric("視聴セッション(60秒)", hub_m["active_sessions"])
+        m3.metric("共有ヒット", hub_m["hits"])
+        m4.metric("計算回数", hub_m["builds"])
+        st.caption(f"ヒット率 {hub_m['hit_rate']:.0%} / 変更通知 {hub_m['changes']}回 / シート読込 {hub_m['reads']}回"
+                   f" (間隔 {hub_m['ttl']:.0f}秒・観戦 {hub_m['wants']}人の通過予想から / 上限で見送り {hub_m['capped']}回・読込中で見送り {hub_m['shared']}回) / 読込エラー {hub_m['errors']}回 / 記録を読まずに反映 {hub_m['local']}回 / {hub_m['rows']}行"
+                   f" / 除外: 再送の重複 {hub_m['duplicate_rows']}行・二重タップ {hub_m['double_taps']}件")
+        lf = get_log_follower().metrics()
+        st.caption(f"ログの読み込み: 差分 {lf['delta_reads']}回 ({lf['delta_rows']}行) / 全体 {lf['full_reads']}回 ({lf['full_rows']}行)"
+                   f" / 照合 {lf['verifies']}回 / 読み直し {lf['resyncs']}回")
+        wq = get_write_queue().metrics()
+        st.caption(f"書き込みキュー: 未送信 {wq['pending']}行 / 送信 {wq['flushed']}行 ({wq['batches']}回) / 送信エラー {wq['errors']}回"
+                   + (f" (最後のエラー: {wq['last_error']})" if wq['last_error'] else ""))
+        if isinstance(storage, GSheetsStorage):
+            pm = storage.pool.metrics()
+            if pm["actions"]:
+                st.caption(f"Sheets API: 認証 {pm['authorizations']}回 (クライアント使い回し)")
+                st.dataframe(pd.DataFrame([{"操作": k, "回数": v["calls"], "APIリクエスト": v["requests"], "省けた往復": v["saved"]}
+                                           for k, v in pm["actions"].items()]), hide_index=True, use_container_width=True)
+            sm = storage.scheduler.metrics()
+            st.caption(f"API割り当て: 待ち 書き込み {sm['waiting']['urgent']}件 / 読み込み {sm['waiting']['normal']}件"
+                       + (f" / 429 のため {sm['cooldown_sec']:.1f}秒停止中" if sm['cooldown_sec'] > 0 else ""))
+            st.dataframe(pd.DataFrame([{"種類": k, "残り": f"{sm['buckets'][k]['tokens']:.0f}/{sm['buckets'][k]['per_min']}分",
+                                        "リクエスト": v["requests"], "待たせた": v["waited"], "待ち秒": round(v["wait_sec"], 1),
+                                        "諦めた": v["throttled"], "429": v["quota_errors"], "相乗り": v["coalesced"]}
+                                       for k, v in sm["stats"].items()]), hide_index=True, use_container_width=True)
+            if sm["decisions"]:
+                with st.expander("最近の待ち・429"): st.dataframe(pd.DataFrame(sm["decisions"][::-1]), hide_index=True, use_container_width=True)
+        feed = get_standings_feed()
+        if feed:
+            fm = feed.metrics()
+            st.caption(f"順位フィード: ポート {fm['port']} / リクエスト {fm['requests']}回 (304 {fm['not_modified']}回) / JSON作成 {fm['builds']}回"
+                       f" / SSE 接続中 {fm['streams']} (送信 {fm['events']}回・満員で拒否 {fm['rejected']}回)")
+        cm = get_cpu_meter().metrics()
+        if cm["kinds"]:
+            labels = {"watch_full": "全体の再実行", "watch_info": "現在地の部分更新", "watch_gaps": "前後差の部分更新", "watch_history": "履歴の部分更新"}
+            st.caption(f"観戦の CPU: 1人あたり {cm['per_session_ms_per_min']:.1f} ms/分 ({cm['sessions']}人・直近60秒) / "
+                       + " / ".join(f"{labels.get(k, k)} {v['runs']}回 {v['ms_per_run']:.1f} ms" for k, v in cm["kinds"].items()))
+        mem = memory_report(get_race_hub().snapshot.frame)
+        st.caption(f"メモリ: {mem['bytes'] / 1024:.1f} KB ({mem['bytes_per_event']:.0f} bytes/記録)")
 
         st.divider()
         st.write("### 📦 レースのアーカイブ")
         if st.button("📦 レースを終了してアーカイブ", type="primary", use_container_width=True):
             if not config: st.error("configがありません"); st.stop()
             try:
-                gc = get_gspread_client()
-                sh = gc.open_by_url(SHEET_URL)
-                try: ws_idx = sh.worksheet(WORKSHEET_INDEX)
-                except: 
-                    ws_idx = sh.add_worksheet(WORKSHEET_INDEX, 100, 10)
-                    ws_idx.append_row(["RaceID", "RaceName", "Date", "LogSheet", "ConfigSheet", "Note"])
-                
+                if not get_write_queue().flush(): st.error("未送信の記録が残っています。通信を確認してください"); st.stop()
                 ts = datetime.now(JST).strftime('%Y%m%d_%H%M%S')
                 race_id = f"race_{ts}"
                 log_name = f"log_{ts}"
                 conf_name = f"conf_{ts}"
+                race_name, race_date = config.get("RaceName", "Unknown"), datetime.now(JST).strftime('%Y-%m-%d %H:%M')
+                raw_log = storage.read_log()  # archive で最新ログは空になるので先に読んでおく
+                storage.archive(race_id, race_name, race_date, log_name, conf_name)
+                try:
+                    get_archive_store().save(race_id, raw_log, build_race_frame(raw_log),
+                                             {"RaceName": race_name, "Date": race_date, "LogSheet": log_name, "ConfigSheet": conf_name, "config": dict(config)})
+                except Exception as e: st.warning(f"ローカルへの保存に失敗しました (シートには保存済み): {e}")
                 
-                ws_log = sh.worksheet(WORKSHEET_LOG)
-                ws_conf = sh.worksheet(WORKSHEET_CONFIG)
-                ws_log.duplicate(new_sheet_name=log_name)
-                ws_conf.duplicate(new_sheet_name=conf_name)
-                
-                ws_idx.append_row([race_id, config.get("RaceName", "Unknown"), datetime.now(JST).strftime('%Y-%m-%d %H:%M'), log_name, conf_name, ""])
-                ws_log.clear(); ws_log.append_row(["TeamID", "TeamName", "Section", "Location", "Time", "Race"])
-                ws_conf.clear(); ws_conf.append_row(["Key", "Value"])
-                
-                st.cache_data.clear()
+                reset_live_log()
+                clear_my_events()
+                get_race_catalog().invalidate()
+                clear_race_cache()
                 st.session_state["race_config"] = None
                 st.session_state["app_mode"] = "🏁 レース作成"
                 st.success(f"アーカイブ完了！: {race_id}")
@@ -791,72 +967,69 @@ elif current_mode == "⚙️ 管理者モード":
             except Exception as e: st.error(f"アーカイブエラー: {e}")
 
         st.write("#### 🗑️ アーカイブ削除")
-        idx_df = load_data(conn, WORKSHEET_INDEX)
-        if not idx_df.empty and "RaceID" in idx_df.columns:
-            del_targets = st.multiselect("削除するアーカイブを選択", idx_df['RaceID'].tolist())
+        idx_df = get_race_catalog().frame()
+        if not idx_df.empty:
+            del_labels = dict(zip(idx_df['RaceID'], idx_df['RaceID'] + " (" + idx_df['RaceName'] + ")"))
+            del_targets = st.multiselect("削除するアーカイブを選択", list(del_labels.keys()), format_func=lambda x: del_labels[x])
             if del_targets and st.button("選択したアーカイブを削除 (復元不可)", type="secondary"):
-                gc = get_gspread_client()
-                sh = gc.open_by_url(SHEET_URL)
-                ws_idx = sh.worksheet(WORKSHEET_INDEX)
-                for rid in del_targets:
-                    row = idx_df[idx_df['RaceID'] == rid].iloc[0]
-                    try: sh.del_worksheet(sh.worksheet(row['LogSheet']))
-                    except: pass
-                    try: sh.del_worksheet(sh.worksheet(row['ConfigSheet']))
-                    except: pass
-                
-                new_idx_data = idx_df[~idx_df['RaceID'].isin(del_targets)].values.tolist()
-                ws_idx.clear()
-                ws_idx.append_row(["RaceID", "RaceName", "Date", "LogSheet", "ConfigSheet", "Note"])
-                if new_idx_data: ws_idx.append_rows(new_idx_data)
-                st.cache_data.clear(); st.success("削除しました"); st.rerun()
+                storage.delete_archives(del_targets)
+                get_archive_store().delete(del_targets)
+                get_race_catalog().invalidate()
+                clear_race_cache(); st.success("削除しました"); st.rerun()
 
         st.divider()
         st.write("### 🔧 設定(Config)の直接編集")
-        conf_df = load_data(conn, WORKSHEET_CONFIG)
+        try: conf_df = storage.read_config(ttl=CACHE_TTL_SEC)
+        except Exception: conf_df = pd.DataFrame()
         if not conf_df.empty:
             edited_conf = st.data_editor(conf_df, num_rows="dynamic", key="edit_conf")
             if st.button("設定を保存", key="save_conf"):
-                conn.update(spreadsheet=SHEET_URL, worksheet=WORKSHEET_CONFIG, data=edited_conf)
+                storage.write_config(edited_conf)
                 st.session_state["race_config"] = None
-                st.cache_data.clear()
+                clear_race_cache()
                 st.success("更新しました"); st.rerun()
 
         st.write("### 📝 ログデータの直接編集")
         st.warning("時刻(Time)を修正すると、ラップなどは自動再計算されます。")
-        log_df = load_data(conn, WORKSHEET_LOG)
+        # 編集は生ログの有効な記録に対して行う (時刻を読み取れず計算から除外した行も表示・修正できるように)
+        # 保存しても行は書き換えず、取り消し・修正を操作行としてジャーナルに追記する
+        try: log_df = resolve_ops(prepare_log(get_write_queue().overlay(storage.read_log())))
+        except Exception: log_df = pd.DataFrame()
+        bad_rows = get_race_hub().snapshot.bad_rows
+        if bad_rows:
+            st.error(f"時刻を読み取れないため計算から除外している行があります (シート行番号): {', '.join(str(i + 2) for i in bad_rows)}")
         if not log_df.empty:
             column_config = {
                 "Time": st.column_config.TextColumn("Time (HH:MM:SS.f)"),
                 "Split": st.column_config.TextColumn("Split (自動計算)", disabled=True),
                 "KM-Lap": st.column_config.TextColumn("Point-Lap (自動計算)", disabled=True),
                 "Rank": st.column_config.TextColumn("Rank (自動計算)", disabled=True),
+                "EventID": st.column_config.TextColumn("EventID", disabled=True),
             }
-            raw_columns = ["TeamID", "TeamName", "Section", "Location", "Time", "Race"]
-            display_cols = [c for c in raw_columns if c in log_df.columns]
+            display_cols = [c for c in [*RECORD_COLUMNS, "EventID"] if c in log_df.columns]
             
             edited_log = st.data_editor(log_df[display_cols], num_rows="dynamic", column_config=column_config, key="edit_log")
             
             col_save, col_check = st.columns([1, 2])
-            with col_check: confirm_save = st.checkbox("編集内容を反映する（取り消せません）")
+            with col_check: confirm_save = st.checkbox("編集内容を反映する")
             with col_save:
                 if st.button("ログを保存", key="save_log", type="primary", disabled=not confirm_save):
-                    conn.update(spreadsheet=SHEET_URL, worksheet=WORKSHEET_LOG, data=edited_log)
-                    st.cache_data.clear(); st.success("更新しました"); st.rerun()
+                    ops = edit_ops(log_df, edited_log, get_time_str(datetime.now(JST)))
+                    if ops.empty: st.info("変更はありません")
+                    else:
+                        get_write_queue().enqueue(ops.values.tolist())
+                        get_write_queue().flush()
+                        get_race_hub().invalidate()
+                        clear_race_cache(); st.success(f"{len(ops)} 件の操作を記録しました"); st.rerun()
 
         st.divider()
         st.write("### 🚨 プロジェクトリセット")
         if st.button("🗑️ データを全消去してリセット"):
-            gc = get_gspread_client()
-            sh = gc.open_by_url(SHEET_URL)
-            try: 
-                ws_log = sh.worksheet(WORKSHEET_LOG)
-                ws_log.clear()
-                ws_log.append_row(["TeamID", "TeamName", "Section", "Location", "Time", "Race"])
-            except: pass
-            try: sh.worksheet(WORKSHEET_CONFIG).clear()
-            except: pass
-            st.cache_data.clear()
+            get_write_queue().flush()
+            storage.reset()
+            reset_live_log()
+            clear_my_events()
+            clear_race_cache()
             st.session_state["race_config"] = None
             st.session_state["app_mode"] = "🏁 レース作成"
             st.rerun()
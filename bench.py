@@ -0,0 +1,483 @@
+# ==========================================
+# えきでんくん ベンチマーク
+# 使い方:
+#   python bench.py                       パイプライン各段の計測 (bench_baseline.json と比較)
+#   python bench.py --teams 300 --json out.json
+#   python bench.py --save-baseline       現在の結果を基準値として保存 (基準値の更新は専用のコミットで、理由を添えて)
+#   python bench.py --legacy              旧実装 (v2.0.8) との比較・フォーマット一致確認
+#   python bench.py --check               一致確認だけ (フォーマット、追記計算と全再計算。固定シードの分は tests/test_parity.py でも確認)
+# Googleシートには接続しない (擬似レースログを使う)
+# ==========================================
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from race_archive import ArchiveStore, RaceCatalog
+from race_format import fmt_time, fmt_lap, fmt_diff, fmt_time_ms, fmt_lap_ms, fmt_diff_ms
+from standings_feed import build_standings
+from storage import LOG_HEADER, LogFollower, SQLiteStorage
+from race_engine import (JST, CATEGORY_COLUMNS, RaceSnapshot, OP_UNDO, RaceIndex, build_analysis_frame, compute_race, content_version, prepare_log, predict_next_passing,
+                         RaceState, drop_double_taps, parse_time_of_day, resolve_ops, stamp_times, memory_report)
+
+BASE_MS = 9 * 3600 * 1000  # 9:00:00 スタート
+SEGMENT_MS = 225_000       # 1地点間の標準タイム
+BASELINE_PATH = Path(__file__).with_name("bench_baseline.json")
+
+
+def make_race_log(teams, sections, points, seed=0, pace_spread=0.15):
+    """
+    ベンチマーク用の擬似レースログ (TeamID, Section, Location, TimeMs) を時刻順で作る。
+    pace_spread: チームごとの地力の差 (標準ペースに対する ±割合)。大きいほど差が開き、順位が固まる
+    """
+    rng = random.Random(seed)
+    rows = [[str(t), "1区", "Start", BASE_MS] for t in range(1, teams + 1)]
+    for t in range(1, teams + 1):
+        cur = BASE_MS
+        pace = SEGMENT_MS * (1 + rng.uniform(-pace_spread, pace_spread))
+        for s in range(1, sections + 1):
+            runner = pace * rng.uniform(0.9, 1.1)  # 区間ごとの走者の調子
+            for p in range(1, points + 2):
+                cur += int(runner * rng.uniform(0.7, 1.3))
+                loc = f"P{p}" if p <= points else "Finish" if s == sections else "Relay"
+                rows.append([str(t), f"{s}区", loc, cur])
+    df = pd.DataFrame(rows, columns=["TeamID", "Section", "Location", "TimeMs"])
+    return df.sort_values("TimeMs", kind="stable").reset_index(drop=True)
+
+
+def to_time_str(ms):
+    # シートと同じ "HH:MM:SS.f" 形式
+    return f"{ms // 3600000 % 24:02}:{ms // 60000 % 60:02}:{ms // 1000 % 60:02}.{ms // 100 % 10}"
+
+
+def to_sheet_log(log, race="Race_bench"):
+    """make_race_log の結果を、conn.read が返すシートの生ログ (全列文字列) の形にする。"""
+    return pd.DataFrame({
+        "TeamID": log["TeamID"], "TeamName": "チーム" + log["TeamID"], "Section": log["Section"],
+        "Location": log["Location"], "Time": log["TimeMs"].map(to_time_str), "Race": race,
+        "EventID": "e" + pd.Series(range(len(log)), index=log.index).astype(str), "Op": "", "Target": "",
+    })[LOG_HEADER]
+
+
+def make_recorder_ops(sheet, undo_rate=0.02, seed=0, dup_rate=0.02):
+    """
+    記録係が1タップずつ追記していくシート (操作ジャーナル) を作る。1行 = 1タップ。
+    undo_rate: 1回の記録のあと、誤ったチームを押して元に戻す (誤記録 + undo 行を追記する) 確率
+    dup_rate: 1回の記録が二重になる確率 (半分は再送で同じ行がもう1行、半分は0.3秒後の二重タップ)
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(len(sheet)):
+        rows.append(sheet.iloc[i])
+        if rng.random() < dup_rate:
+            again = sheet.iloc[i].copy()
+            if rng.random() < 0.5:
+                again["EventID"] += "-tap"
+                again["Time"] = to_time_str(int(parse_time_of_day(pd.Series([again["Time"]])).iloc[0]) + 300)
+            rows.append(again)
+        if rng.random() < undo_rate:
+            wrong = sheet.iloc[i].copy()
+            wrong["TeamID"] = sheet["TeamID"].iloc[rng.randrange(len(sheet))]
+            wrong["EventID"] = f"noise{i}"
+            undo = wrong.copy()
+            undo["EventID"], undo["Op"], undo["Target"] = f"undo{i}", OP_UNDO, wrong["EventID"]
+            rows += [wrong, undo]
+    return pd.DataFrame(rows).reset_index(drop=True)
+
+
+def legacy_parse_time_str(time_str):
+    # v2.0.8 までの app.parse_time_str (比較用)
+    now = datetime.now(JST)
+    if not isinstance(time_str, str) or not time_str: return now
+    try:
+        if "." in time_str: t = datetime.strptime(time_str + "00000", "%H:%M:%S.%f").time()
+        else: t = datetime.strptime(time_str, "%H:%M:%S").time()
+        return datetime.combine(now.date(), t).replace(tzinfo=JST)
+    except: return now
+
+
+def timeit(fn, repeat=5):
+    # repeat 回の中央値 (1回だけ速い・遅い回に引きずられない)
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+
+def bench_compute_race():
+    print("## compute_race (ベクトル計算エンジン)")
+    print(f"{'rows':>8} {'sec':>9} {'us/row':>8}")
+    # 10区間 x 10地点 = 1チーム111行。チーム数を増やして10万行まで伸ばす
+    for teams in (10, 100, 300, 900):
+        log = make_race_log(teams, 10, 10)
+        sec = timeit(lambda: compute_race(log.copy()))
+        print(f"{len(log):>8} {sec:>9.4f} {sec / len(log) * 1e6:>8.2f}")
+
+
+def bench_incremental():
+    print("## RaceState (追記分だけの計算) vs 全再計算: 末尾に5行追記したときの1回分")
+    print(f"{'rows':>8} {'full sec':>9} {'incr sec':>9}")
+    for teams in (100, 900):
+        log = make_race_log(teams, 10, 10)
+        head, full = log.iloc[:-5], log
+
+        def incr():
+            state = RaceState(lambda raw: raw.rename(columns={"TimeMs": "TimeOfDayMs"}))
+            state.update(head)
+            t0 = time.perf_counter()
+            state.update(full)
+            return time.perf_counter() - t0
+
+        sec_full = timeit(lambda: compute_race(log.copy()))
+        sec_incr = min(incr() for _ in range(3))
+        print(f"{len(log):>8} {sec_full:>9.4f} {sec_incr:>9.4f}")
+
+
+def bench_parse_time():
+    print("## 時刻パース 5万行: 旧 parse_time_str (1行ずつapply) vs parse_time_of_day (一括)")
+    times = make_race_log(450, 10, 10)["TimeMs"].iloc[:50_000].map(to_time_str)
+    sec_old = timeit(lambda: times.apply(legacy_parse_time_str), repeat=1)
+    sec_new = timeit(lambda: stamp_times(pd.DataFrame({"TimeOfDayMs": parse_time_of_day(times)})))
+    print(f"{len(times):>8} rows  legacy {sec_old:.4f}s  bulk {sec_new:.4f}s  x{sec_old / sec_new:.0f}")
+
+
+def legacy_layout(frame):
+    # v2.0.8 までの load_data と同じ列構成 (全列文字列 + dt + 秒の float + 表示用文字列) に戻す
+    old = pd.DataFrame({c: frame[c].astype(str).astype(object) for c in ["TeamID", "TeamName", "Section", "Location", "Race"] if c in frame})
+    old["Time"] = frame["TimeMs"].map(lambda ms: to_time_str(ms % (24 * 3600 * 1000))).astype(object)
+    old["dt"] = pd.to_datetime(frame["TimeMs"], unit="ms", utc=True).dt.tz_convert(JST).astype(object)
+    for col in ["Split", "Point", "Section"]:
+        old[f"{col}Seconds"] = frame[f"{col}Ms"] / 1000
+    for col in ["Split", "KM-Lap", "SEC-Lap"]:
+        old[col] = old["SplitSeconds"].map(lambda s: f"{s:.1f}").astype(object)
+    old["Rank"] = frame["Rank"].astype("int64")
+    old["PrevDiff"] = frame["PrevDiffMs"].astype("float64") / 1000
+    return old
+
+
+def bench_memory():
+    print("## メモリ (1記録あたりのバイト数): 旧レイアウト vs compact")
+    log = make_race_log(100, 10, 10).rename(columns={"TimeMs": "TimeOfDayMs"})
+    log["TeamName"] = "チーム" + log["TeamID"]
+    log["Race"] = "Race_bench"
+    frame = compute_race(stamp_times(log))
+    before, after = memory_report(legacy_layout(frame)), memory_report(frame)
+    print(f"{len(frame):>8} rows  before {before['bytes_per_event']:.0f} B/event  after {after['bytes_per_event']:.0f} B/event")
+
+
+def format_parity_cases(n=200_000, seed=0):
+    # (名前, fmt_*_ms の結果, 1件ずつの fmt_* の結果)。境界 (0〜2秒・100秒刻み) と乱数の n 件
+    rng = np.random.default_rng(seed)
+    edges = np.concatenate([np.arange(0, 2001), np.arange(0, 36 * 3600 * 1000, 100_000)])
+    ms = np.concatenate([edges, rng.integers(0, 36 * 3600 * 1000, n)])
+    signed = np.concatenate([ms, -ms])
+    return [
+        ("fmt_time", fmt_time_ms(ms), [fmt_time(v / 1000) for v in ms]),
+        ("fmt_lap", fmt_lap_ms(ms), [fmt_lap(v / 1000) for v in ms]),
+        ("fmt_diff", fmt_diff_ms(signed), [fmt_diff(v / 1000) for v in signed]),
+        ("fmt_diff(NaN)", fmt_diff_ms([np.nan]), [fmt_diff(float("nan"))]),
+    ]
+
+
+def format_mismatches(got, want):
+    return [(g, w) for g, w in zip(got.tolist(), want) if g != w]
+
+
+def check_format_parity(n=200_000, seed=0):
+    # fmt_*_ms (列まとめ) が 1件ずつの fmt_* と完全に同じ文字列を返すか確認する
+    print("## フォーマット一致確認 (fmt_*_ms vs fmt_*)")
+    ok = True
+    for name, got, want in format_parity_cases(n, seed):
+        diff = format_mismatches(got, want)
+        print(f"{name:>14}: {len(want):>7} 件  不一致 {len(diff)} {diff[:3] if diff else ''}")
+        ok = ok and not diff
+    return ok
+
+
+def incremental_parity_cases(seed=0):
+    # (名前, 記録係のログ, 全行で比べるか)。二重タップが続く並びと、Undo・再送の混じった記録係の再生
+    sheet = to_sheet_log(make_race_log(20, 3, 3, seed))
+    chained = sheet.iloc[:25].copy()  # 二重タップが続く並び: 同じ地点を0秒・8秒・16秒に押す (16秒は別の通過として残る)
+    tap = chained.iloc[-1]
+    base = int(parse_time_of_day(pd.Series([tap["Time"]])).iloc[0])
+    extra = [tap.copy() for _ in range(2)]
+    for k, row in enumerate(extra, 1): row["EventID"], row["Time"] = f"{tap['EventID']}-tap{k}", to_time_str(base + 8000 * k)
+    chained = pd.DataFrame([*chained.to_dict("records"), *extra]).reset_index(drop=True)
+    return [("二重タップの連続", chained, True),
+            ("記録係の再生", make_recorder_ops(sheet, undo_rate=0.05, seed=seed, dup_rate=0.1), False)]
+
+
+def incremental_mismatches(journal, every=20, every_row=False):
+    # 1タップずつ state.update し、every 行ごと (every_row なら毎行) と最後に全再計算と比べる。(state, 合わなかった行数)
+    as_text = lambda f: f.astype({c: str for c in CATEGORY_COLUMNS if c in f.columns})
+    state, bad = RaceState(prepare_log), []
+    for n in range(1, len(journal) + 1):
+        frame = state.update(journal.iloc[:n])
+        if n % every and n != len(journal) and not every_row: continue
+        full = RaceState(prepare_log)
+        if not as_text(frame).equals(as_text(full.update(journal.iloc[:n]))) or state.double_taps != full.double_taps: bad.append(n)
+    return state, bad
+
+
+def check_incremental_parity(seed=0, every=20):
+    # RaceState の1タップずつの追記計算が、同じログの全再計算と同じフレーム・同じ二重タップになるか確認する
+    print("## 追記計算と全再計算の一致確認 (RaceState)")
+    ok = True
+    for name, journal, every_row in incremental_parity_cases(seed):
+        state, bad = incremental_mismatches(journal, every, every_row)
+        print(f"{name:>10}: {len(journal):>5} 行  全再計算 {state.full_rebuilds} 回  二重タップ {len(state.double_taps)} 件  不一致 {bad[:5]}")
+        ok = ok and not bad
+    return ok
+
+
+def bench_format():
+    print("## 表示整形 10万行: Series.apply(fmt_*) vs fmt_*_ms")
+    ms = pd.Series(make_race_log(900, 10, 10)["TimeMs"] - BASE_MS)
+    for name, scalar, vector in (("fmt_time", fmt_time, fmt_time_ms), ("fmt_lap", fmt_lap, fmt_lap_ms)):
+        sec_old = timeit(lambda: (ms / 1000).apply(scalar), repeat=1)
+        sec_new = timeit(lambda: vector(ms))
+        print(f"{name:>9} {len(ms):>8} rows  apply {sec_old:.4f}s  vector {sec_new:.4f}s")
+
+
+def legacy_analysis_frame(df, teams_info):
+    # v2.0.8 までの render_analysis_dashboard の組み立て (地点ごとに絞り込み → 1行ずつ追加)
+    rows = []
+    points_order = df[["Section", "Location"]].drop_duplicates().reset_index(drop=True)
+    points_order = points_order[points_order["Location"] != "Start"]
+    for pt_id, pt in points_order.iterrows():
+        sec, loc = pt["Section"], pt["Location"]
+        p_df = df[(df["Section"] == sec) & (df["Location"] == loc)].copy()
+        p_df["SplitSeconds"] = p_df["SplitMs"] / 1000
+        p_df = p_df.sort_values("SplitSeconds")
+        top_time = p_df.iloc[0]["SplitSeconds"]
+        p_df["TrueRank"] = range(1, len(p_df) + 1)
+        for _, row in p_df.iterrows():
+            tid = row["TeamID"]
+            rows.append({
+                "TeamID": tid, "Team": teams_info.get(tid, tid), "PointLabel": f"{sec} {loc}", "PointID": pt_id,
+                "Rank": row["TrueRank"], "Split": fmt_time(row["SplitSeconds"]), "SplitSeconds": row["SplitSeconds"],
+                "GapSeconds": row["SplitSeconds"] - top_time,
+                "LapStr": fmt_lap(row["SectionMs"] / 1000), "KMLapStr": fmt_lap(row["PointMs"] / 1000),
+            })
+    return pd.DataFrame(rows)
+
+
+def bench_analysis():
+    print("## 分析テーブル 100チーム x 60地点: 旧ループ vs build_analysis_frame")
+    log = make_race_log(100, 6, 9).rename(columns={"TimeMs": "TimeOfDayMs"})
+    frame = compute_race(stamp_times(log))
+    teams = {str(t): f"チーム{t}" for t in range(1, 101)}
+    sec_old = timeit(lambda: legacy_analysis_frame(frame, teams), repeat=1)
+    sec_new = timeit(lambda: build_analysis_frame(frame, teams, RaceIndex(frame)))
+    old, new = legacy_analysis_frame(frame, teams), build_analysis_frame(frame, teams)
+    cols = ["TeamID", "PointID", "Rank", "Split", "LapStr", "KMLapStr"]
+    same = old[cols].astype(str).reset_index(drop=True).equals(new[cols].astype(str).reset_index(drop=True))
+    same = same and np.allclose(old["GapSeconds"], new["GapSeconds"])
+    print(f"{len(new):>8} rows  legacy {sec_old:.4f}s  builder {sec_new:.4f}s  一致: {same}")
+
+
+# ==========================================
+# パイプライン各段の計測 (JSON出力 + 基準値との比較)
+# ==========================================
+def replay_recorder(journal, teams, taps):
+    """
+    記録係の最後の taps 回の操作を再生し、1タップごとの処理時間 (秒) のリストと、
+    そのうち RaceState.update だけの時間のリストを返す (update だけなら load_data と比べられる)。
+    1タップ = シート再読込 → RaceState.update → RaceIndex → 全チームの現在地。誤記録とUndoもそのまま再生する。
+    """
+    state = RaceState(prepare_log)
+    start = max(len(journal) - taps, 1)
+    state.update(journal.iloc[:start])  # それまでの記録は計測前に読み込んでおく
+    rebuilds, times, updates = state.full_rebuilds, [], []
+    for n in range(start + 1, len(journal) + 1):
+        t0 = time.perf_counter()
+        frame = state.update(journal.iloc[:n])
+        t1 = time.perf_counter()
+        index = RaceIndex(frame)
+        for t in teams: index.latest(t)
+        times.append(time.perf_counter() - t0)
+        updates.append(t1 - t0)
+    return times, updates, state.full_rebuilds - rebuilds
+
+
+def run_suite(teams=100, sections=10, points=10, pace_spread=0.15, undo_rate=0.02, taps=200, seed=0, repeat=5, dup_rate=0.02):
+    """擬似レースで各段を計測し、JSONにできる dict を返す (sec は repeat 回の中央値、タップは全タップの中央値)。"""
+    log = make_race_log(teams, sections, points, seed, pace_spread)
+    sheet = to_sheet_log(log)
+    team_ids = [str(t) for t in range(1, teams + 1)]
+    teams_info = {t: f"チーム{t}" for t in team_ids}
+    frame = compute_race(drop_double_taps(stamp_times(resolve_ops(prepare_log(sheet)))))
+    index = RaceIndex(frame)
+
+    stages = {}
+    def stage(name, fn):
+        sec = timeit(fn, repeat)
+        stages[name] = {"sec": sec, "us_per_row": sec / len(sheet) * 1e6}
+
+    # load_data: シートの生ログ → 派生フレーム
+    stage("load_data", lambda: compute_race(drop_double_taps(stamp_times(resolve_ops(prepare_log(sheet))))))
+    stage("race_index", lambda: RaceIndex(frame))
+    stage("team_status", lambda: [index.latest(t) for t in team_ids])
+    # render_analysis_dashboard: キャッシュのキー + 分析テーブル
+    stage("analysis", lambda: (content_version(frame), build_analysis_frame(frame, teams_info, index)))
+    # render_result_list: 完走チームの抽出 + タイム整形
+    stage("result_list", lambda: fmt_time_ms(index.location("Finish")["SplitMs"]))
+    stage("format_history", lambda: (fmt_time_ms(frame["SplitMs"]), fmt_lap_ms(frame["PointMs"])))
+    # 順位フィード: スナップショット1版分の JSON (全クライアントで使い回す)
+    snapshot = RaceSnapshot(1, frame, index, 0.0, ())
+    stage("standings_json", lambda: json.dumps(build_standings(snapshot, {f"TeamName_{t}": n for t, n in teams_info.items()}), ensure_ascii=False))
+    # 観戦の読み直し間隔: レース途中 (記録の半分の時点) で全チームの次の通過を予想する
+    # (地点ごとのスプリットはインデックスに残るので、新しいスナップショットの最初の1回分として毎回作り直す)
+    mid = frame.iloc[:len(frame) // 2]
+
+    def predict_all():
+        mid_index = RaceIndex(mid)
+        return [predict_next_passing(mid_index, t) for t in team_ids]
+    stage("predict_next", predict_all)
+
+    # SQLite バックエンド: 1行ずつの追記 (記録係の1タップ)、全件読み込み、差分読み込み (LogFollower の更新1回分)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteStorage(str(Path(tmp) / "bench.db"))
+        store.append_log(sheet.values.tolist())
+        row, seq = sheet.iloc[-1].tolist(), iter(range(10**9))
+        ev = LOG_HEADER.index("EventID")
+        sec = timeit(lambda: store.append_log([row[:ev] + [f"bench-{next(seq)}"] + row[ev + 1:]]), 20)  # EventID が同じだと追記されない
+        stages["sqlite_append"] = {"sec": sec, "us_per_row": sec * 1e6}  # 1行なので1行あたり = 1回あたり
+        stage("sqlite_read", lambda: store.read_log())
+        follower = LogFollower(store, verify_sec=float("inf"))
+        follower.read()
+        stage("sqlite_delta_read", follower.read)
+        store.db.close()
+
+    # ローカルアーカイブ: 1レースを開く (計算済みフレーム) / 10レース分をまとめて読む
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = ArchiveStore(tmp)
+        for i in range(10): archive.save(f"race_{i}", sheet, frame, {"RaceName": f"bench{i}"})
+        stage("archive_load", lambda: archive.load("race_0"))
+        stage("archive_bulk", lambda: archive.load_many(columns=["TeamID", "Location", "SplitMs"]))
+
+    # アーカイブ一覧: 5000レース分の race_index を型付きにする / 名前と期間で絞り込んで並べる
+    n = 5000
+    index_rows = pd.DataFrame({"RaceID": [f"race_{i}" for i in range(n)], "RaceName": [f"大会{i % 50}" for i in range(n)],
+                               "Date": [f"20{20 + i % 6}-{1 + i % 12:02}-{1 + i % 28:02} 10:00" for i in range(n)],
+                               "LogSheet": [f"log_{i}" for i in range(n)], "ConfigSheet": [f"conf_{i}" for i in range(n)]})
+    catalog = RaceCatalog(lambda: index_rows)
+    stage("catalog_load", lambda: (catalog.invalidate(), catalog.frame()))
+    stage("catalog_query", lambda: catalog.query("大会7", since="2023-01-01", sort="RaceName", ascending=True))
+
+    tap_sec, update_sec, rebuilds = replay_recorder(make_recorder_ops(sheet, undo_rate, seed, dup_rate), team_ids, taps)
+    stages["recorder_tap"] = {
+        "sec": float(np.median(tap_sec)), "p95_sec": float(np.percentile(tap_sec, 95)),
+        "taps": len(tap_sec), "full_rebuilds": rebuilds,
+    }
+    stages["recorder_update"] = {
+        "sec": float(np.median(update_sec)), "p95_sec": float(np.percentile(update_sec, 95)),
+        "taps": len(update_sec), "full_rebuilds": rebuilds,
+    }
+    return {
+        "params": {"teams": teams, "sections": sections, "points": points, "pace_spread": pace_spread,
+                   "undo_rate": undo_rate, "dup_rate": dup_rate, "taps": taps, "seed": seed},
+        "rows": len(sheet),
+        "env": {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+                "machine": platform.machine()},
+        "created": datetime.now(JST).isoformat(timespec="seconds"),
+        "timing": {"stat": "median", "repeat": repeat},
+        "stages": stages,
+    }
+
+
+def compare(result, baseline, tolerance, min_ms=1.0):
+    """
+    基準値より (1 + tolerance) 倍以上、かつ min_ms 以上遅くなった段の名前を返す。
+    1ms に満たない差は計測のぶれとして扱う (sqlite_append などの短い段は比が大きく揺れる)。
+    """
+    if baseline["params"] != result["params"]:
+        print("※ 基準値と条件 (params) が違うため比較しません")
+        return []
+    if baseline.get("timing") != result.get("timing"):
+        print(f"※ 基準値の集計方法 {baseline.get('timing', 'ベスト値')} が今回 {result['timing']} と違います (--save-baseline で取り直し)")
+    slow = []
+    print(f"{'stage':>15} {'base ms':>9} {'now ms':>9} {'ratio':>6}")
+    for name, now in result["stages"].items():
+        base = baseline["stages"].get(name)
+        if base is None: continue
+        ratio = now["sec"] / base["sec"] if base["sec"] else float("inf")
+        mark = " ← 遅くなった" if ratio > 1 + tolerance and (now["sec"] - base["sec"]) * 1000 >= min_ms else ""
+        print(f"{name:>15} {base['sec'] * 1000:>9.2f} {now['sec'] * 1000:>9.2f} {ratio:>6.2f}{mark}")
+        if mark: slow.append(name)
+    return slow
+
+
+def print_suite(result):
+    p = result["params"]
+    print(f"## パイプライン計測: {p['teams']}チーム x {p['sections']}区間 x {p['points']}地点 = {result['rows']}行")
+    for name, st in result["stages"].items():
+        extra = f"  p95 {st['p95_sec'] * 1000:.2f} ms  全再計算 {st['full_rebuilds']}/{st['taps']}タップ" if "taps" in st \
+            else f"  {st['us_per_row']:.2f} us/row"
+        print(f"{name:>15} {st['sec'] * 1000:>9.2f} ms{extra}")
+
+
+def run_legacy():
+    bench_compute_race()
+    bench_incremental()
+    bench_parse_time()
+    bench_memory()
+    bench_format()
+    bench_analysis()
+    run_checks()
+
+
+def run_checks():
+    if not check_format_parity(): raise SystemExit("fmt_*_ms が fmt_* と一致しません")
+    if not check_incremental_parity(): raise SystemExit("RaceState の追記計算が全再計算と一致しません")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="えきでんくん ベンチマーク")
+    ap.add_argument("--teams", type=int, default=100)
+    ap.add_argument("--sections", type=int, default=10)
+    ap.add_argument("--points", type=int, default=10, help="1区間あたりの記録点数")
+    ap.add_argument("--pace-spread", type=float, default=0.15, help="チーム間のペース差 (±割合)")
+    ap.add_argument("--undo-rate", type=float, default=0.02, help="誤記録→Undo の発生確率")
+    ap.add_argument("--dup-rate", type=float, default=0.02, help="二重タップ・再送の発生確率")
+    ap.add_argument("--taps", type=int, default=200, help="記録係の再生タップ数")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--repeat", type=int, default=5, help="各段の計測回数 (中央値をとる)")
+    ap.add_argument("--json", help="結果をJSONで書き出すパス")
+    ap.add_argument("--baseline", default=str(BASELINE_PATH), help="比較する基準値のJSON")
+    ap.add_argument("--save-baseline", action="store_true", help="結果を --baseline に保存する")
+    ap.add_argument("--tolerance", type=float, default=0.5, help="許容する遅れ (0.5 = 1.5倍まで)")
+    ap.add_argument("--min-ms", type=float, default=1.0, help="これより小さい差は遅れとみなさない (ms)")
+    ap.add_argument("--legacy", action="store_true", help="旧実装との比較を実行する")
+    ap.add_argument("--check", action="store_true", help="一致確認だけを実行する")
+    args = ap.parse_args(argv)
+
+    if args.legacy: return run_legacy()
+    if args.check: return run_checks()
+    result = run_suite(args.teams, args.sections, args.points, args.pace_spread, args.undo_rate,
+                       args.taps, args.seed, args.repeat, args.dup_rate)
+    print_suite(result)
+    if args.json: Path(args.json).write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    baseline = Path(args.baseline)
+    if args.save_baseline:
+        baseline.write_text(json.dumps(result, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"基準値を保存しました: {baseline}")
+    elif baseline.exists():
+        slow = compare(result, json.loads(baseline.read_text(encoding="utf-8")), args.tolerance, args.min_ms)
+        if slow: sys.exit(f"基準値より遅くなった段があります: {', '.join(slow)}")
+
+
+if __name__ == "__main__":
+    main()
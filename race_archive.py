@@ -0,0 +1,159 @@
+# ==========================================
+# えきでんくん ローカルアーカイブ
+# 終了したレースを Arrow IPC (Feather v2) の圧縮ファイルにして、読むときはメモリマップで開く。
+#   <race_id>.raw.arrow    : 生ログ (シートの行そのまま。取り消し・二重記録も含む)
+#   <race_id>.result.arrow : 計算済みの派生フレーム (compact) + メタデータ (レース名・日付・設定)
+# 過去のレースを見るときにシートを読み直したり、ラップ・順位を計算し直したりしない。
+# RaceCatalog: アーカイブ一覧 (race_index) だけを型付きで読み、キャッシュする (各レースのログは読まない)
+# Streamlitに依存しない
+# ==========================================
+
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from race_engine import concat_frames
+
+META_KEY = b"ekiden"
+INDEX_COLUMNS = ["RaceID", "RaceName", "Date", "LogSheet", "ConfigSheet", "Note"]  # storage.INDEX_HEADER と同じ
+
+
+class ArchiveStore:
+    """
+    root: 保存先のディレクトリ / compression: "lz4" (読み込みが速い) / "zstd" (小さい) / "uncompressed"
+    圧縮したファイルは読み込み時に展開される。uncompressed ならメモリマップのまま (コピーなしで) 読める。
+    """
+
+    def __init__(self, root, compression="lz4"):
+        self.root = root
+        self.compression = compression
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, race_id, kind):
+        return os.path.join(self.root, f"{race_id}.{kind}.arrow")
+
+    def _write(self, path, table):
+        # 途中で落ちても壊れたファイルが残らないように、一時ファイルに書いてから置き換える
+        tmp = path + ".tmp"
+        feather.write_feather(table, tmp, compression=self.compression)
+        os.replace(tmp, path)
+
+    def save(self, race_id, raw, frame, meta):
+        """
+        レース1件を保存する。raw: 生ログ / frame: 派生フレーム /
+        meta: {"RaceName", "Date", "config": {Key: Value}, ...} (JSON にできるもの)
+        """
+        raw = raw.astype(object).where(raw.notna(), "").astype(str)
+        self._write(self._path(race_id, "raw"), pa.Table.from_pandas(raw, preserve_index=False))
+        table = pa.Table.from_pandas(frame, preserve_index=True)
+        meta = dict(meta, RaceID=race_id)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), META_KEY: json.dumps(meta, ensure_ascii=False).encode()})
+        self._write(self._path(race_id, "result"), table)
+
+    def has(self, race_id):
+        return os.path.exists(self._path(race_id, "result"))
+
+    def race_ids(self):
+        return sorted(f.removesuffix(".result.arrow") for f in os.listdir(self.root) if f.endswith(".result.arrow"))
+
+    def _table(self, race_id, kind, columns=None):
+        return feather.read_table(self._path(race_id, kind), columns=columns, memory_map=True)
+
+    def load(self, race_id):
+        """(派生フレーム, meta) を返す。無ければ KeyError。"""
+        if not self.has(race_id): raise KeyError(race_id)
+        table = self._table(race_id, "result")
+        return table.to_pandas(), json.loads(table.schema.metadata[META_KEY])
+
+    def load_meta(self, race_id):
+        """派生フレームは読まずに meta だけを返す。"""
+        schema = pa.ipc.open_file(pa.memory_map(self._path(race_id, "result"))).schema
+        return json.loads(schema.metadata[META_KEY])
+
+    def load_raw(self, race_id):
+        return self._table(race_id, "raw").to_pandas()
+
+    def load_many(self, race_ids=None, columns=None):
+        """
+        複数レースの派生フレームを RaceID 列付きの1つのフレームにまとめて読む (省略時は全レース)。
+        columns を指定すると、その列だけをファイルから読む。
+        """
+        frames = []
+        for rid in (self.race_ids() if race_ids is None else race_ids):
+            if not self.has(rid): continue
+            df = self._table(rid, "result", columns).to_pandas()
+            frames.append(df.assign(RaceID=pd.Categorical([rid] * len(df))))
+        if not frames: return pd.DataFrame()
+        return concat_frames(frames).reset_index(drop=True)
+
+    def delete(self, race_ids):
+        for rid in race_ids:
+            for kind in ("raw", "result"):
+                try: os.remove(self._path(rid, kind))
+                except FileNotFoundError: pass
+
+
+def parse_race_index(raw):
+    """race_index の生の行 → 型付きの一覧 (Date は datetime64、欠けた列・空欄は ""、RaceID の無い行は除く)。"""
+    df = raw.reindex(columns=INDEX_COLUMNS).astype(object)
+    df = df.where(df.notna(), "").astype(str)
+    df = df[df["RaceID"].str.strip() != ""].reset_index(drop=True)
+    return df.assign(Date=pd.to_datetime(df["Date"], format="mixed", errors="coerce"))
+
+
+class RaceCatalog:
+    """
+    アーカイブ一覧のキャッシュ。一覧が変わるのはアーカイブ・削除のときだけなので、最新ログの更新とは別に
+    invalidate() で捨てる (ttl は別のプロセスでのアーカイブに追いつくための保険)。
+    read: 生の race_index を返す関数 / store: ArchiveStore (ローカルに保存済みかを Local 列に付ける)
+    """
+
+    def __init__(self, read, ttl=300.0, store=None):
+        self.read = read
+        self.ttl = ttl
+        self.store = store
+        self.lock = threading.Lock()
+        self.version = 0
+        self._frame = None
+        self.loaded_at = 0.0
+
+    def invalidate(self):
+        with self.lock:
+            self._frame = None
+            self.version += 1
+
+    def frame(self):
+        """型付きの一覧 (日付の新しい順)。読み込みに失敗したら前回の一覧 (初回は空)。"""
+        with self.lock:
+            if self._frame is not None and time.monotonic() - self.loaded_at < self.ttl: return self._frame
+            try: df = parse_race_index(self.read())
+            except Exception:
+                if self._frame is not None: return self._frame
+                df = parse_race_index(pd.DataFrame(columns=INDEX_COLUMNS))
+            if self.store is not None: df["Local"] = df["RaceID"].isin(self.store.race_ids())
+            self._frame = df.sort_values("Date", ascending=False, na_position="last", kind="stable").reset_index(drop=True)
+            self.loaded_at = time.monotonic()
+            return self._frame
+
+    def query(self, text="", since=None, until=None, sort="Date", ascending=False):
+        """レース名・RaceID の部分一致と日付の範囲で絞り込み、sort 列で並べる。"""
+        df = self.frame()
+        mask = pd.Series(True, index=df.index)
+        if text:
+            mask &= df["RaceName"].str.contains(text, case=False, regex=False) | df["RaceID"].str.contains(text, case=False, regex=False)
+        if since is not None: mask &= df["Date"] >= pd.Timestamp(since)
+        if until is not None: mask &= df["Date"] < pd.Timestamp(until) + pd.Timedelta(days=1)
+        df = df[mask]
+        if sort != "Date" or ascending: df = df.sort_values(sort, ascending=ascending, na_position="last", kind="stable")
+        return df
+
+    def get(self, race_id):
+        """1件分の行 (Series)。無ければ None。"""
+        df = self.frame()
+        hit = df[df["RaceID"] == race_id]
+        return hit.iloc[0] if len(hit) else None
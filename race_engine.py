@@ -0,0 +1,972 @@
+# ==========================================
+# えきでんくん 計算エンジン
+# Streamlitに依存しない純粋な計算処理 (app.py / bench.py から利用)
+# ==========================================
+
+import hashlib
+import re
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+
+from race_format import fmt_time_ms, fmt_lap_ms
+
+JST = ZoneInfo("Asia/Tokyo")
+DAY_MS = 24 * 3600 * 1000
+# レース最初の記録よりこれ以上前の時刻は、日付をまたいだ (翌日の) 記録とみなす
+ROLLOVER_MS = 6 * 3600 * 1000
+TIME_PATTERN = r'\d{1,2}:\d{2}:\d{2}(?:\.\d*)?'
+TIME_RE = re.compile(r'(\d{1,2}):(\d{2}):(\d{2})(?:\.(\d*))?', re.ASCII)  # TIME_PATTERN の各部分 (1件ずつ読む用)
+
+# 区間ラップの基準になる地点 (この地点を通過した時刻から次の区間が始まる)
+ANCHOR_LOCATIONS = ("Start", "Relay")
+POINT_KEYS = ["Section", "Location"]
+
+# 派生フレームの列型 (compact)
+CATEGORY_COLUMNS = ["TeamID", "TeamName", "Section", "Location", "Race"]
+MS_COLUMNS = ["TimeMs", "SplitMs", "PointMs", "SectionMs"]
+DROP_COLUMNS = ["Time", "TimeOfDayMs", "EventID", "Op", "Target"]  # 生の時刻文字列は TimeMs に置き換わる
+
+# 操作ジャーナル: ログは追記だけで、取り消し・やり直しも1行の操作として書く
+#   Op ""     : 通過の記録 / "edit": 管理者が追加・修正した記録
+#   Op "undo" : Target (EventID) の記録を取り消す / "redo": 取り消した記録を戻す (同じ記録への操作は最後のものが有効)
+OP_EDIT, OP_UNDO, OP_REDO = "edit", "undo", "redo"
+CONTROL_OPS = (OP_UNDO, OP_REDO)
+JOURNAL_COLUMNS = ["EventID", "Op", "Target"]
+RECORD_COLUMNS = ["TeamID", "TeamName", "Section", "Location", "Time", "Race"]  # 1件の記録の中身
+
+# 二重記録: 同じ EventID の行 (再送で二重に書かれた行) は最初の1行だけ使う。
+# さらに同じチーム・同じ地点の記録が直前の記録から DOUBLE_TAP_MS 以内なら二重タップとして1件にまとめる
+TAP_KEYS = ["TeamID", "Section", "Location"]
+DOUBLE_TAP_MS = 10_000
+
+
+def parse_time_of_day(times):
+    """
+    "HH:MM:SS" / "HH:MM:SS.f" の列を一括で「その日の0時からのミリ秒」(Int64) に変換する。
+    解釈できない行は <NA> になる (現在時刻で埋めたりはしない)。
+    """
+    if times.empty: return pd.Series(index=times.index, dtype='Int64')
+    t = times.astype(str).str.strip()
+    ok = t.str.fullmatch(TIME_PATTERN).to_numpy(dtype=bool)
+    # "H:MM:SS.fff" の固定桁にそろえ、バイト列から数字を直接読む
+    t = t.where(t.str.find(':') == 2, '0' + t).where(ok, '00:00:00').str.pad(12, side='right', fillchar='0')
+    d = np.frombuffer(t.to_numpy(dtype='S12').tobytes(), dtype=np.uint8).reshape(-1, 12).astype(np.int64) - ord('0')
+    h, m, s = d[:, 0] * 10 + d[:, 1], d[:, 3] * 10 + d[:, 4], d[:, 6] * 10 + d[:, 7]
+    frac = d[:, 9] * 100 + d[:, 10] * 10 + d[:, 11]
+    ok = ok & (h < 24) & (m < 60) & (s < 60)
+    tod = ((h * 60 + m) * 60 + s) * 1000 + frac
+    return pd.Series(tod, index=times.index).where(ok).astype('Int64')
+
+
+def time_of_day_ms(text):
+    """parse_time_of_day の1件版 (追記分の数行用)。解釈できなければ None。"""
+    m = TIME_RE.fullmatch(str(text).strip())
+    if not m: return None
+    h, mi, s = int(m[1]), int(m[2]), int(m[3])
+    if h >= 24 or mi >= 60 or s >= 60: return None
+    return ((h * 60 + mi) * 60 + s) * 1000 + int((m[4] or "").ljust(3, "0")[:3])
+
+
+def prepare_log(raw):
+    """シートの生ログ (全列文字列化・末尾の".0"除去) に TimeOfDayMs を付ける。"""
+    if len(raw) < 200: return _prepare_rows(raw)
+    df = raw.copy()
+    for col in df.columns:
+        df[col] = df[col].astype(str).str.replace(r'\.0$', '', regex=True)
+    # 操作ジャーナルの列 (古いログには無い)。空欄の EventID はシート上の位置で代用する
+    for col in JOURNAL_COLUMNS:
+        df[col] = df[col].replace(["nan", "None", "<NA>"], "") if col in df.columns else ""
+    df['EventID'] = event_ids(df)
+    df['TimeOfDayMs'] = parse_time_of_day(df['Time'])
+    return df
+
+
+def _prepare_rows(raw):
+    # 追記分の数行は1セルずつ (列ごとの pandas 処理は固定費の方が大きい)。結果は prepare_log と同じ
+    cols = {c: [str(v).removesuffix(".0") for v in raw[c].tolist()] for c in raw.columns}
+    for col in JOURNAL_COLUMNS:
+        cols[col] = [("" if v in ("nan", "None", "<NA>") else v) for v in cols[col]] if col in cols else [""] * len(raw)
+    cols['EventID'] = [e or f"#{i}" for e, i in zip(cols['EventID'], raw.index)]
+    data = {c: pd.array(v, dtype=str) for c, v in cols.items()}
+    data['TimeOfDayMs'] = pd.array([time_of_day_ms(t) for t in cols['Time']], dtype='Int64')
+    return pd.DataFrame(data, index=raw.index)
+
+
+def new_event_id():
+    """記録1件ごとの一意なID (端末側で発行する)"""
+    return uuid.uuid4().hex[:16]
+
+
+class EventSequence:
+    """端末ごとの EventID の発行: "<端末ID>-<連番>"。連番は端末内で1から増える (再送しても同じIDのまま)。"""
+
+    def __init__(self, device=None):
+        self.device = device or new_event_id()[:8]
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            self.seq += 1
+            return f"{self.device}-{self.seq}"
+
+
+def event_ids(df):
+    # EventID 列 (空欄・列なしはシート上の位置 "#n" で代用)
+    if 'EventID' not in df.columns: return "#" + pd.Series(df.index.astype(str), index=df.index)
+    ids = df['EventID'].astype(str)
+    blank = (ids == "").to_numpy()
+    if not blank.any(): return ids
+    ids = ids.copy()
+    ids[blank] = "#" + df.index[blank].astype(str)
+    return ids
+
+
+def split_ops(df):
+    """生ログを (記録の行, 取り消し・やり直しの行) に分ける。Op 列の無いログはすべて記録。"""
+    if 'Op' not in df.columns: return df, df.iloc[:0]
+    ctl = df['Op'].isin(CONTROL_OPS).to_numpy()
+    return df[~ctl], df[ctl]
+
+
+def undone_ids(last_ops):
+    """{Target: 最後の操作} から、取り消されたままの EventID の集合"""
+    return {t for t, op in last_ops.items() if op == OP_UNDO}
+
+
+def resolve_ops(df):
+    """
+    操作ジャーナルを解決し、有効な記録の行だけを返す (インデックスはシート上の位置のまま)。
+    同じ EventID の行は最初の1行だけ使い、取り消された記録は除き、やり直された記録は戻す。
+    """
+    rec, ctl = split_ops(df[~event_ids(df).duplicated().to_numpy()])
+    if ctl.empty: return rec
+    return rec[~event_ids(rec).isin(undone_ids(dict(zip(ctl['Target'], ctl['Op']))))]
+
+
+def edit_ops(before, after, time_str, columns=RECORD_COLUMNS):
+    """
+    管理画面での編集 (before → after、どちらも EventID 付き) を、ジャーナルに追記する行に変換する。
+    消した行は undo、変えた行は undo + 新しい記録 (edit)、足した行は新しい記録 (edit)。
+    取り消し行の Time は操作した時刻 (time_str)。戻り値は columns + JOURNAL_COLUMNS の DataFrame。
+    """
+    def text(df):
+        out = df.reindex(columns=columns).astype(object)
+        return out.where(out.notna(), "").astype(str)
+
+    old = text(before).set_index(before['EventID'].astype(str).to_numpy())
+    ids = after['EventID'] if 'EventID' in after else pd.Series("", index=after.index)
+    ids = ids.astype(object).where(ids.notna(), "").astype(str).to_numpy()
+    new = text(after).set_index(ids)
+    known = new.index.isin(old.index) & (new.index != "")
+    kept = new[known]
+    changed = kept.index[(kept != old.loc[kept.index]).any(axis=1)]
+    removed = old.index.difference(kept.index)
+
+    undo = old.loc[removed.append(changed)]
+    undo = undo.assign(Time=time_str, Op=OP_UNDO, Target=undo.index)
+    added = pd.concat([kept.loc[changed], new[~known]])
+    added = added[added.ne("").any(axis=1)].assign(Op=OP_EDIT, Target="")
+    out = pd.concat([undo, added], ignore_index=True)
+    out['EventID'] = [new_event_id() for _ in range(len(out))]
+    return out.reindex(columns=[*columns, *JOURNAL_COLUMNS])
+
+
+def _double_tap_mask(df, window_ms):
+    # 同じチーム・同じ地点で、最後に残した記録から window_ms 以内の記録 (時刻順、同時刻はシート順) を True にする。
+    # 除いた記録とは比べない (0秒・8秒・16秒なら8秒だけ除く)。RaceState の追記計算と同じ規則
+    mask = np.zeros(len(df), dtype=bool)
+    if window_ms <= 0 or len(df) < 2: return mask
+    t = df['TimeMs'].to_numpy(dtype='int64')
+    codes = df.groupby(TAP_KEYS, sort=False, observed=True).ngroup().to_numpy()
+    order = np.lexsort((t, codes))
+    ts = t[order]
+    # 直前の行から window_ms 以内の行だけが候補。候補が続くところだけ順にたどる
+    near = np.zeros(len(df), dtype=bool)
+    near[1:] = (codes[order[1:]] == codes[order[:-1]]) & (np.diff(ts) <= window_ms)
+    kept = None
+    for j in np.flatnonzero(near).tolist():
+        if not near[j - 1]: kept = ts[j - 1]  # 候補でない行は必ず残る
+        if ts[j] - kept <= window_ms: mask[order[j]] = True
+        else: kept = ts[j]
+    return mask
+
+
+def drop_double_taps(df, window_ms=DOUBLE_TAP_MS):
+    """
+    TimeMs 付きの記録から二重タップ (同じチーム・同じ地点で、最後に残した記録から window_ms 以内) を除く。
+    除いた行のインデックスは df.attrs['double_tap_rows'] で返す。window_ms <= 0 なら何もしない。
+    """
+    dup = _double_tap_mask(df, window_ms)
+    out = df[~dup]
+    out.attrs['double_tap_rows'] = df.index[dup].tolist()
+    return out
+
+
+def tap_interval_ms(earlier, later):
+    """時刻文字列 2つの間隔ms (0時をまたいでも正)。読めない時刻があれば None。"""
+    a, b = parse_time_of_day(pd.Series([earlier, later])).tolist()
+    if pd.isna(a) or pd.isna(b): return None
+    return (b - a) % DAY_MS
+
+
+def race_base_ms(origin_tod, now=None):
+    """
+    レース日の0時 (JST) のエポックミリ秒。深夜0時をまたいだ後に開いた場合は前日を基準にする。
+    origin_tod: レース最初の記録の時刻 (0時からのms)
+    """
+    now = now or datetime.now(JST)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    base = int(midnight.timestamp() * 1000)
+    now_tod = int(now.timestamp() * 1000) - base
+    if now_tod < origin_tod - ROLLOVER_MS: base -= DAY_MS
+    return base
+
+
+def to_epoch_ms(tod, origin_tod, base_ms):
+    """0時からのms を、日付またぎを考慮してエポックmsに変換する。"""
+    tod = tod.to_numpy(dtype='int64')
+    return base_ms + tod + np.where(tod < origin_tod - ROLLOVER_MS, DAY_MS, 0)
+
+
+def stamp_times(df, now=None):
+    """
+    TimeOfDayMs 列から TimeMs (エポックms) を付ける。時刻を解釈できない行は除外し、
+    その行のインデックスを df.attrs['bad_time_rows'] で返す。
+    """
+    bad = df['TimeOfDayMs'].isna()
+    out = df[~bad].copy()
+    out.attrs['bad_time_rows'] = df.index[bad].tolist()
+    if out.empty:
+        out['TimeMs'] = pd.Series(dtype='int64')
+        return out
+    origin = int(out['TimeOfDayMs'].iloc[0])
+    out['TimeMs'] = to_epoch_ms(out['TimeOfDayMs'], origin, race_base_ms(origin, now))
+    return out
+
+
+def _ffill_within(values, first):
+    # NaNを直前の値で埋める。ただし first (チームの先頭行) を越えては埋めない
+    pos = np.arange(len(values))
+    keep = ~np.isnan(values) | first
+    idx = np.maximum.accumulate(np.where(keep, pos, 0))
+    return values[idx]
+
+
+def _derive(df, start_ms):
+    """時刻順に並んだログにラップ・順位・前との差を付与する (compute_race / RaceState の再計算の共通部)。"""
+    t = df['TimeMs'].to_numpy(dtype='float64')
+    loc = df['Location'].to_numpy()
+    split_ms = t - start_ms
+
+    # --- チーム単位 (TeamID, 時刻) の並びで計算 ---
+    team_codes, team_uniques = pd.factorize(df['TeamID'])
+    order = np.lexsort((t, team_codes))
+    codes_s, split_s = team_codes[order], split_ms[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = codes_s[1:] != codes_s[:-1]
+
+    # Point Lap (同チームの直前通過との差。最初の通過は0)
+    point_s = np.diff(split_s, prepend=np.nan)
+    point_s[first] = 0.0
+
+    # Section Lap: 直前のStart/Relay通過 (なければ号砲) からの差
+    anchor_s = np.where(np.isin(loc[order], ANCHOR_LOCATIONS), split_s, np.nan)
+    prev_anchor = np.empty_like(anchor_s)
+    prev_anchor[1:] = anchor_s[:-1]
+    prev_anchor[first] = np.nan
+    prev_anchor = _ffill_within(prev_anchor, first)
+    prev_anchor = np.where(np.isnan(prev_anchor), 0.0, prev_anchor)
+    section_s = split_s - prev_anchor
+
+    point_ms, section_ms = np.empty_like(t), np.empty_like(t)
+    point_ms[order], section_ms[order] = point_s, section_s
+
+    # --- 地点単位: 時刻順に並んでいるので通過順は累積カウント、前との差は差分 ---
+    by_point = pd.Series(split_ms, index=df.index).groupby([df['Section'], df['Location']], sort=False, observed=True)
+    rank = by_point.cumcount().to_numpy() + 1
+    prev_diff = by_point.diff().to_numpy()
+
+    df = df.assign(SplitMs=split_ms, PointMs=point_ms, SectionMs=section_ms, Rank=rank, PrevDiffMs=prev_diff)
+    return compact(df)
+
+
+def compact(df):
+    """
+    派生フレームをメモリの小さい列型にそろえる。
+    文字列は category、時刻・時間は int64 ミリ秒、順位は int16。表示用の文字列は持たない (表示時に整形する)。
+    """
+    df = df.drop(columns=[c for c in DROP_COLUMNS if c in df.columns])
+    types = {c: 'category' for c in CATEGORY_COLUMNS if c in df.columns}
+    types.update({c: 'int64' for c in MS_COLUMNS if c in df.columns})
+    types.update({'Rank': 'int16', 'PrevDiffMs': 'Int64'})
+    return df.astype(types)
+
+
+def compact_like(values, index, like):
+    """
+    列ごとの値 (list) から、like (既存のフレーム) と同じ列・列型のフレームを作る。
+    category の中身も like と同じにするので concat_frames でそのまま結合できる。like に無い値があれば compact と同じ。
+    """
+    cols = {}
+    for c, dtype in like.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            codes = dtype.categories.get_indexer(values[c])
+            if (codes < 0).any(): return compact(pd.DataFrame(values, index=index))  # 新しいチーム・地点は category を広げる
+            cols[c] = pd.Categorical.from_codes(codes, dtype=dtype)
+        else:
+            cols[c] = pd.array(values[c], dtype=dtype)
+    return pd.DataFrame(cols, index=index)
+
+
+def empty_frame():
+    """計算結果が無いときの、列と型だけをそろえた空のフレーム"""
+    return compact(pd.DataFrame({c: pd.Series(dtype='object') for c in CATEGORY_COLUMNS}).assign(
+        **{c: pd.Series(dtype='int64') for c in MS_COLUMNS}, Rank=pd.Series(dtype='int16'), PrevDiffMs=pd.Series(dtype='Int64')))
+
+
+def concat_frames(frames):
+    # category の中身をそろえてから結合する (そろえないと object 列に戻ってしまう)
+    frames = [f for f in frames if not f.empty] or frames[:1]
+    if len(frames) == 1: return frames[0]
+    # 型が同じ列 (compact_like で作った追記分など) はそのまま結合できる
+    cats = [c for c, dtype in frames[0].dtypes.items()
+            if isinstance(dtype, pd.CategoricalDtype) and any(f[c].dtype != dtype for f in frames[1:])]
+    for c in cats:
+        union = pd.api.types.union_categoricals([f[c] for f in frames]).categories
+        frames = [f.assign(**{c: f[c].cat.set_categories(union)}) for f in frames]
+    return pd.concat(frames)
+
+
+def memory_report(df):
+    """フレームのメモリ使用量 (列ごとのバイト数と1記録あたりのバイト数)"""
+    usage = df.memory_usage(deep=True)
+    total = int(usage.sum())
+    return {
+        "rows": len(df),
+        "bytes": total,
+        "bytes_per_event": total / len(df) if len(df) else 0.0,
+        "columns": {k: int(v) for k, v in usage.items()},
+    }
+
+
+def _rerank(frame, points):
+    # 指定した地点だけ、通過順と前との差を付け直す (時刻順、同時刻はシート順。compute_race と同じ並び)
+    if not points: return frame
+    at = pd.MultiIndex.from_frame(frame[POINT_KEYS].astype(str)).isin(list(points))
+    sub = frame[at].sort_values('TimeMs', kind='stable')
+    by_point = sub.groupby(POINT_KEYS, sort=False, observed=True)
+    pos = frame.index.get_indexer(sub.index)
+    rank = frame['Rank'].to_numpy(copy=True)
+    prev = frame['PrevDiffMs'].to_numpy(dtype='float64', na_value=np.nan, copy=True)
+    rank[pos] = by_point.cumcount().to_numpy() + 1
+    prev[pos] = by_point['SplitMs'].diff().to_numpy(dtype='float64')
+    return frame.assign(Rank=rank, PrevDiffMs=pd.array(np.where(np.isnan(prev), np.nan, prev)).astype('Int64'))
+
+
+def compute_race(df):
+    """
+    TimeMs (エポックミリ秒) を持つログに、スプリット・ポイントラップ・区間ラップ・順位・前との差を付与する。
+    チーム単位/地点単位の計算はすべてベクトル演算で行い、Pythonの行ループは使わない。
+    戻り値は入力と同じ行順 (シート順) の compact なフレーム。Start の記録が無ければ空。
+    """
+    if df.empty or not (df['Location'] == 'Start').any(): return empty_frame()
+    df = df.sort_values('TimeMs', kind='stable')
+    is_start = (df['Location'] == 'Start').to_numpy()
+    start_ms = df['TimeMs'].to_numpy(dtype='float64')[is_start].min()
+    return _derive(df, start_ms).sort_index()
+
+
+class RaceState:
+    """
+    レースの派生状態 (スプリット・ラップ・順位・前との差) を保持し、
+    ログの末尾に追記された行だけを畳み込んで更新する。
+    Undoや直接編集など追記以外の変更を検知したときだけ全再計算する。
+
+    prepare: 生ログ(シートの行) -> TimeOfDayMs付きのログ へ変換する関数 (新規行にだけ適用)
+    double_tap_ms: 二重タップとしてまとめる時間幅 (drop_double_taps)。0 でまとめない
+
+    取り消し・やり直し (操作ジャーナル) の行が追記されたときは、対象の記録のチームだけを
+    記録から計算し直し、そのチームが通る地点の通過順を付け直す。
+    """
+
+    def __init__(self, prepare, double_tap_ms=DOUBLE_TAP_MS):
+        self.prepare = prepare
+        self.double_tap_ms = double_tap_ms
+        self.full_rebuilds = 0
+        self.incremental_updates = 0
+        self.reset()
+
+    def reset(self):
+        self.raw_len = 0
+        self.tail_key = None
+        self.start_ms = np.nan
+        self.origin_tod = None  # 日付またぎ判定の基準 (最初の記録の時刻)
+        self.base_ms = None     # レース日の0時
+        self.bad_rows = []      # 時刻を解釈できなかった生ログの行
+        self.seen = set()       # 読み込み済みの EventID (記録・操作とも)
+        self.duplicate_rows = []  # EventID が重複していた (再送で二重に書かれた) 生ログの行
+        self.double_taps = set()  # 二重タップとしてまとめた記録の EventID
+        self.passes = {}        # (TeamID, Section, Location) -> 最後の通過時刻ms (二重タップの判定用)
+        self.team_seed = {}   # TeamID -> (最後のスプリットms, 最後のStart/Relayスプリットms)
+        self.team_last_ms = {}  # TeamID -> 最後の通過時刻ms
+        self.point_seed = {}  # (Section, Location) -> (通過数, 最後のスプリットms)
+        self.chunks = []
+        self._frame = empty_frame()
+        self.records = []     # 時刻を付けた記録の行 (取り消されたものも含む)。チーム単位の再計算に使う
+        self.last_ops = {}    # EventID -> その記録への最後の操作 (undo / redo)
+
+    def invalidate(self):
+        """Undo・ログ編集など、追記以外の変更をアプリ側が行ったときに呼ぶ。"""
+        self.reset()
+
+    @property
+    def frame(self):
+        if len(self.chunks) > 1:
+            self.chunks = [concat_frames(self.chunks)]
+            self._frame = self.chunks[0]
+        return self._frame
+
+    def _records(self):
+        if len(self.records) > 1: self.records = [pd.concat(self.records)]
+        return self.records[0] if self.records else pd.DataFrame(columns=['TeamID', 'EventID'])
+
+    @property
+    def undone(self):
+        return undone_ids(self.last_ops)
+
+    def _register(self, recs, ctl):
+        # 記録と操作を覚え、有効・無効が変わった EventID を返す
+        before = self.undone
+        if not recs.empty: self.records.append(recs.drop(columns=[c for c in ('Time', 'TimeOfDayMs', 'Op', 'Target') if c in recs.columns]))
+        if not ctl.empty: self.last_ops.update(zip(ctl['Target'], ctl['Op']))
+        return before ^ self.undone
+
+    @staticmethod
+    def _row_key(raw, i):
+        return tuple(str(raw[c].iat[i]) for c in raw.columns)
+
+    def _is_append(self, raw):
+        if self.raw_len == 0 or len(raw) < self.raw_len: return False
+        return self._row_key(raw, self.raw_len - 1) == self.tail_key
+
+    def _stamp(self, rows):
+        # 前処理 → 読み込み済みの EventID を除外 → 操作の行を分ける → 時刻を解釈できない記録を除外 → エポックmsを付与
+        df = self.prepare(rows)
+        df = df.assign(EventID=event_ids(df))
+        # 追記分は数行なので、行ごとに集合を引く (Series.isin は読み込み済みの全IDを毎回変換してしまう)
+        seen = np.fromiter((e in self.seen for e in df['EventID']), dtype=bool, count=len(df))
+        dup = df['EventID'].duplicated().to_numpy() | seen
+        if dup.any():
+            self.duplicate_rows += df.index[dup].tolist()
+            df = df[~dup]
+        self.seen.update(df['EventID'])
+        df, ctl = split_ops(df)
+        bad = df['TimeOfDayMs'].isna()
+        self.bad_rows += df.index[bad].tolist()
+        df = df[~bad]
+        if df.empty:
+            df['TimeMs'] = pd.Series(dtype='int64')
+            return df, ctl
+        if self.origin_tod is None:
+            self.origin_tod = int(df['TimeOfDayMs'].iloc[0])
+            self.base_ms = race_base_ms(self.origin_tod)
+        df['TimeMs'] = to_epoch_ms(df['TimeOfDayMs'], self.origin_tod, self.base_ms)
+        return df, ctl
+
+    def update(self, raw):
+        """シート全体の生ログを受け取り、派生フレームを返す。"""
+        if raw.empty:
+            if self.raw_len: self.reset()
+            return self.frame
+        if not self._is_append(raw):
+            self._rebuild(raw)
+        elif len(raw) > self.raw_len:
+            new, ctl = self._stamp(raw.iloc[self.raw_len:])
+            if not self._fold(new, ctl): self._rebuild(raw)
+        self.raw_len = len(raw)
+        self.tail_key = self._row_key(raw, len(raw) - 1)
+        return self.frame
+
+    def _rebuild(self, raw):
+        self.reset()
+        self.full_rebuilds += 1
+        recs, ctl = self._stamp(raw)
+        self._register(recs, ctl)
+        active = drop_double_taps(recs[~recs['EventID'].isin(self.undone)], self.double_tap_ms)
+        self.double_taps = set(recs.loc[active.attrs['double_tap_rows'], 'EventID'])
+        df = compute_race(active)
+        if not df.empty:
+            self.start_ms = float(df.loc[df['Location'] == 'Start', 'TimeMs'].min())
+            self._remember(df)
+        self.chunks, self._frame = [df], df
+
+    def _fold(self, new, ctl):
+        # 追記行が既存の通過より前の時刻を含む場合 (記録の遅延など) は順位が入れ替わるので全再計算
+        if new.empty and ctl.empty: return True
+        if np.isnan(self.start_ms) or (new['Location'] == 'Start').any(): return False
+        changed = self._register(new, ctl)
+        teams = []
+        if changed:
+            recs = self._records()
+            hit = recs[recs['EventID'].isin(changed)]
+            if (hit['Location'] == 'Start').any(): return False  # 号砲が変わると全チームに影響する
+            teams = hit['TeamID'].unique().tolist()
+        # 操作の対象になったチームの行は、あとでチームごと計算し直す
+        new = new[~new['EventID'].isin(self.undone) & ~new['TeamID'].isin(teams)]
+        if not new.empty and not self._fold_records(new): return False
+        if teams: self._replay(teams)
+        self.incremental_updates += 1
+        return True
+
+    def _fold_records(self, new):
+        # 追記された記録を時刻順に1行ずつ畳み込む (数行なので pandas の列処理より速い)。
+        # 計算は _derive と同じ: ラップはチームの直前の通過、順位・前との差は地点の直前の通過から
+        rows = sorted(zip(new['TimeMs'].tolist(), range(len(new)), new['TeamID'].tolist(),
+                          new['Section'].tolist(), new['Location'].tolist(), new['EventID'].tolist()))
+        keep, derived = [], []
+        for t, i, tid, sec, loc, eid in rows:
+            if t < self.team_last_ms.get(tid, -np.inf): return False
+            tap = (tid, sec, loc)
+            if self.double_tap_ms > 0 and t - self.passes.get(tap, -np.inf) <= self.double_tap_ms:
+                self.double_taps.add(eid)  # 二重タップ (最後に残した通過と比べる。drop_double_taps と同じ)
+                continue
+            split = t - self.start_ms
+            n, last = self.point_seed.get((sec, loc), (0, np.nan))
+            if split < last: return False
+            prev_split, anchor = self.team_seed.get(tid, (np.nan, np.nan))
+            point = 0.0 if np.isnan(prev_split) else split - prev_split
+            section = split - (0.0 if np.isnan(anchor) else anchor)
+            keep.append(i)
+            derived.append((split, point, section, n + 1, None if np.isnan(last) else split - last))
+            self.team_seed[tid] = (split, split if loc in ANCHOR_LOCATIONS else anchor)
+            self.team_last_ms[tid] = t
+            self.point_seed[(sec, loc)] = (n + 1, split)
+            if self.double_tap_ms > 0: self.passes[tap] = t
+        if not keep: return True
+        order = sorted(range(len(keep)), key=keep.__getitem__)  # シート順に戻す
+        keep, derived = [keep[k] for k in order], [derived[k] for k in order]
+        values = {c: new[c].tolist() for c in new.columns if c not in DROP_COLUMNS}
+        values = {c: [v[i] for i in keep] for c, v in values.items()}
+        values.update(zip(['SplitMs', 'PointMs', 'SectionMs', 'Rank', 'PrevDiffMs'], map(list, zip(*derived))))
+        self.chunks.append(compact_like(values, new.index[keep], self.chunks[0]))
+        self._frame = None
+        return True
+
+    def _replay(self, teams):
+        # teams の有効な記録だけから計算し直し、そのチームが通った (通る) 地点の通過順を付け直す
+        recs = self._records()
+        is_team = recs['TeamID'].isin(teams)
+        mine = drop_double_taps(recs[is_team & ~recs['EventID'].isin(self.undone)], self.double_tap_ms)
+        self.double_taps -= set(recs.loc[is_team, 'EventID'])
+        self.double_taps |= set(recs.loc[mine.attrs['double_tap_rows'], 'EventID'])
+        frame = self.frame
+        is_mine = frame['TeamID'].isin(teams).to_numpy()
+        points = set(zip(frame.loc[is_mine, 'Section'].astype(str), frame.loc[is_mine, 'Location'].astype(str)))
+        points |= set(zip(mine['Section'], mine['Location']))
+        redone = _derive(mine.sort_values('TimeMs', kind='stable'), self.start_ms) if not mine.empty else empty_frame()
+        df = _rerank(concat_frames([frame[~is_mine], redone]).sort_index(), points)
+        self.chunks, self._frame = [df], df
+        self.team_seed, self.team_last_ms, self.point_seed, self.passes = {}, {}, {}, {}
+        self._remember(df)
+
+    def _remember(self, df):
+        # 次回の追記計算に引き継ぐ状態を、今回計算した行から更新する (処理した行数に比例)
+        df = df.sort_values('TimeMs', kind='stable')
+        split_ms = df['TimeMs'].astype('float64') - self.start_ms
+        is_anchor = df['Location'].isin(ANCHOR_LOCATIONS)
+        last_split = split_ms.groupby(df['TeamID'], sort=False, observed=True).last()
+        last_anchor = split_ms[is_anchor].groupby(df.loc[is_anchor, 'TeamID'], sort=False, observed=True).last()
+        for tid, last in last_split.items():
+            prev_anchor = self.team_seed.get(tid, (np.nan, np.nan))[1]
+            self.team_seed[tid] = (last, last_anchor.get(tid, prev_anchor))
+        self.team_last_ms.update(df.groupby('TeamID', sort=False, observed=True)['TimeMs'].max().to_dict())
+        if self.double_tap_ms > 0:
+            self.passes.update(df.groupby(TAP_KEYS, sort=False, observed=True)['TimeMs'].max().to_dict())
+        by_point = split_ms.groupby([df['Section'], df['Location']], sort=False, observed=True)
+        sizes, lasts = by_point.size(), by_point.max()
+        for key, n, last in zip(sizes.index, sizes.to_numpy(), lasts.to_numpy()):
+            self.point_seed[key] = (self.point_seed.get(key, (0, np.nan))[0] + int(n), last)
+
+
+class RaceIndex:
+    """
+    派生フレームの検索用インデックス。スナップショットごとに1回だけ作り、
+    チームの行・チームの最新記録・地点ごとの通過をO(1)で引けるようにする。
+    """
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.start_ms = np.nan
+        self._team, self._point, self._location, self._latest = {}, {}, {}, {}
+        self._splits, self._columns = {}, None
+        self.points = []  # 地点 (Section, Location) をシートに初めて現れた順に
+        if frame.empty: return
+        # チーム: 時刻順の行位置 / 地点: スプリット順の行位置。同時刻はシート順
+        # (記録の修正は undo と修正後の行をシートの末尾に足すので、シートで最後の行が最新とは限らない)
+        t = frame['TimeMs'].to_numpy()
+        self._team = {tid: pos[np.argsort(t[pos], kind='stable')]
+                      for tid, pos in frame.groupby('TeamID', sort=False, observed=True).indices.items()}
+        self._latest = {tid: pos[-1] for tid, pos in self._team.items()}
+        by_split = np.argsort(frame['SplitMs'].to_numpy(), kind='stable')
+        sorted_frame = frame.iloc[by_split]
+        self._point = {k: by_split[v] for k, v in sorted_frame.groupby(POINT_KEYS, sort=False, observed=True).indices.items()}
+        self._location = {k: by_split[v] for k, v in sorted_frame.groupby('Location', sort=False, observed=True).indices.items()}
+        self.points = list(frame[POINT_KEYS].drop_duplicates().itertuples(index=False, name=None))
+        starts = self._location.get('Start')
+        if starts is not None: self.start_ms = frame['TimeMs'].iloc[starts].min()
+
+    def _rows(self, pos):
+        return self.frame.iloc[pos if pos is not None else []]
+
+    def team_ids(self):
+        """記録のあるチーム (シートに初めて現れた順)"""
+        return list(self._team)
+
+    def team(self, tid):
+        """チームの全記録 (時刻順)"""
+        return self._rows(self._team.get(tid))
+
+    def latest(self, tid):
+        """チームの最新記録 = 時刻が最も遅い記録 (なければ None)"""
+        pos = self._latest.get(tid)
+        return None if pos is None else self.frame.iloc[pos]
+
+    def point(self, section, location):
+        """地点の全通過 (スプリット順)"""
+        return self._rows(self._point.get((section, location)))
+
+    def point_splits(self, section, location):
+        """地点の {TeamID: SplitMs}。通過予想で同じ地点を何度も引くので、作ったものを使い回す"""
+        key = (section, location)
+        if key not in self._splits:
+            if self._columns is None:
+                self._columns = (self.frame['TeamID'].to_numpy(dtype=object), self.frame['SplitMs'].to_numpy(dtype='float64', na_value=np.nan))
+            pos = self._point.get(key, [])
+            self._splits[key] = dict(zip(self._columns[0][pos].tolist(), self._columns[1][pos].tolist()))
+        return self._splits[key]
+
+    def location(self, location):
+        """Location (Finish など) の全通過 (スプリット順)"""
+        return self._rows(self._location.get(location))
+
+
+def content_version(frame):
+    """
+    ログの内容バージョン (行数 + 最後の記録のハッシュ + 時刻の合計)。キャッシュのキーに使う。
+    時刻の合計は途中の行の時刻修正を拾うためのもの (ベクトル演算1回)。
+    """
+    if frame.empty: return "0"
+    last = "|".join(str(v) for v in frame.iloc[-1].tolist())
+    digest = hashlib.blake2b(f"{last}|{int(frame['TimeMs'].sum())}".encode(), digest_size=8).hexdigest()
+    return f"{len(frame)}-{digest}"
+
+
+ANALYSIS_COLUMNS = ["TeamID", "Team", "PointLabel", "PointID", "Section", "Location", "Rank",
+                    "Split", "SplitSeconds", "GapSeconds", "GapMs", "LapStr", "KMLapStr"]
+
+
+def build_analysis_frame(frame, teams_info, race_index=None):
+    """
+    分析用のテーブル (チーム × 地点) を1回のグループ演算で作る。
+    PointID は race_index.points の並び順、Rank は地点ごとのスプリット順、GapSeconds はその地点のトップとの差。
+    Start 地点は含めない。
+    """
+    if race_index is None: race_index = RaceIndex(frame)
+    if frame.empty: return pd.DataFrame(columns=ANALYSIS_COLUMNS)
+    df = frame.loc[frame['Location'] != 'Start', ['TeamID', 'Section', 'Location', 'SplitMs', 'SectionMs', 'PointMs']]
+    if df.empty: return pd.DataFrame(columns=ANALYSIS_COLUMNS)
+
+    points = pd.MultiIndex.from_tuples(race_index.points, names=POINT_KEYS)
+    point_id = points.get_indexer(pd.MultiIndex.from_arrays([df['Section'].astype(str), df['Location'].astype(str)]))
+    df = df.assign(PointID=point_id).sort_values(['PointID', 'SplitMs'], kind='stable')
+
+    by_point = df.groupby('PointID', sort=False)
+    gap_ms = df['SplitMs'] - by_point['SplitMs'].transform('first')
+    tid = df['TeamID'].astype(str)
+    out = pd.DataFrame({
+        "TeamID": tid,
+        "Team": tid.map(teams_info).fillna(tid),
+        "PointLabel": df['Section'].astype(str) + " " + df['Location'].astype(str),
+        "PointID": df['PointID'],
+        "Section": df['Section'].astype(str),
+        "Location": df['Location'].astype(str),
+        "Rank": by_point.cumcount() + 1,
+        "Split": fmt_time_ms(df['SplitMs']),
+        "SplitSeconds": df['SplitMs'] / 1000,
+        "GapSeconds": gap_ms / 1000,
+        "GapMs": gap_ms,
+        "LapStr": fmt_lap_ms(df['SectionMs']),
+        "KMLapStr": fmt_lap_ms(df['PointMs']),
+    })
+    return out.reset_index(drop=True)
+
+
+# version: ログが変わるたびに増える番号 / frame: 派生フレーム (読み取り専用として扱う)
+# index: frame の RaceIndex / bad_rows: 時刻を解釈できず計算から除外した生ログの行
+RaceSnapshot = namedtuple("RaceSnapshot", ["version", "frame", "index", "built_at", "bad_rows"])
+
+
+class RaceHub:
+    """
+    プロセス全体で1つだけ持つレースのスナップショット。
+    ログの読み込みと計算はTTLごと・ログが変わったときに1回だけ行い、
+    全セッションは同じスナップショットを参照する (書き換え禁止)。
+    changes: 記録・編集 (apply / mark_stale) と新しいスナップショットのたびに増える変更カウンタ。
+    観戦側はこれを見て、変わったときだけ描き直す (wait で変更を待つこともできる)。
+    読み直す間隔: 観戦中のセッションが want で希望した間隔の最短 (希望が無ければ ttl)。
+    ただし読み込みは min_interval 秒に1回まで (プロセス全体の読み込み回数の上限。読込エラーの再試行も含む。
+    mark_stale の直後の1回は除く)。
+    読み込みは同時に1つだけ。読み込み中はロックを持たないので、is_fresh・wait や他のセッションは待たされない
+    (TTL切れなだけなら読み終わるまで今のスナップショットを返す。mark_stale の後だけは読み終わりを待つ)。
+    """
+
+    def __init__(self, state, ttl, min_interval=0.0, want_window=60.0):
+        self.state = state
+        self.ttl = ttl
+        self.min_interval = min_interval
+        self.want_window = want_window
+        self.wants = {}  # session_id -> (希望する読み直し間隔 秒, 登録した時刻)
+        self.last_read = None
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.read_done = threading.Condition(self.lock)
+        self.reading = False
+        self.stale_gen = 0  # mark_stale / invalidate のたびに増える。読み込み中に増えたらその結果は新しいとみなさない
+        self.state_lock = threading.Lock()  # state の更新と invalidate を分ける
+        self.changes = 0
+        empty = pd.DataFrame()
+        self.snapshot = RaceSnapshot(0, empty, RaceIndex(empty), 0.0, ())
+        self.read_at = None
+        self.stats = {"hits": 0, "reads": 0, "builds": 0, "errors": 0, "capped": 0, "shared": 0, "local": 0}
+        self.sessions = {}  # session_id -> 最終アクセス時刻
+
+    def get(self, read_fn, session_id=None):
+        """read_fn: 生ログを読む関数。TTL内ならスナップショットをそのまま返す。"""
+        with self.lock:
+            if session_id is not None: self.sessions[session_id] = time.monotonic()
+            while True:
+                now = time.monotonic()
+                if self.read_at is not None and now - self.read_at < self._ttl(now):
+                    self.stats["hits"] += 1
+                    return self.snapshot
+                if not self.reading: break
+                if self.read_at is not None:
+                    # 他のスレッドが読み込み中: TTL切れなだけなら今のスナップショットを返す
+                    self.stats["shared"] += 1
+                    return self.snapshot
+                self.read_done.wait()  # mark_stale の後は読み終わりを待って判定し直す
+            if self.last_read is not None and now - self.last_read < self.min_interval:
+                # 読み込み回数の上限: 古いまま返し、次のアクセスで読み直す
+                self.stats["capped"] += 1
+                return self.snapshot
+            self.last_read = now
+            self.reading, gen = True, self.stale_gen
+        # 読み込みと計算はロックの外で (読み込み中は reading で他のスレッドの読み込みを止める)
+        try:
+            raw = read_fn()
+            with self.state_lock:
+                frame = self.state.update(raw)
+                bad_rows = tuple(self.state.bad_rows)
+            index = None if frame is self.snapshot.frame else RaceIndex(frame)
+        except Exception:
+            index = False
+        with self.lock:
+            self.reading = False
+            self.read_done.notify_all()
+            if index is False:
+                self.stats["errors"] += 1
+                return self.snapshot
+            if gen == self.stale_gen: self.read_at = time.monotonic()
+            self.stats["reads"] += 1
+            if index is None:
+                self.stats["hits"] += 1
+            else:
+                self.stats["builds"] += 1
+                self.snapshot = RaceSnapshot(self.snapshot.version + 1, frame, index, time.time(), bad_rows)
+                self._publish()
+            return self.snapshot
+
+    def _publish(self):
+        # self.lock を持った状態で呼ぶ
+        self.changes += 1
+        self.changed.notify_all()
+
+    def apply(self, raw):
+        """
+        手元にある生ログ (読み込み済みのログ + 受け付けた未送信の記録) で、読み直さずにスナップショットを作り直す。
+        記録係の書き込み直後に使う。読み直しの時刻 (TTL) は変えないので、次に保存先を読むのは通常どおり。
+        読み込み中だった結果はこの記録を含まないかもしれないので、その読み込みは新しいとみなさない (次のアクセスで読み直す)。
+        """
+        with self.state_lock:
+            frame = self.state.update(raw)
+            bad_rows = tuple(self.state.bad_rows)
+        index = None if frame is self.snapshot.frame else RaceIndex(frame)
+        with self.lock:
+            if self.reading: self.stale_gen += 1
+            self.stats["local"] += 1
+            if index is not None:
+                self.snapshot = RaceSnapshot(self.snapshot.version + 1, frame, index, time.time(), bad_rows)
+            self._publish()
+            return self.snapshot
+
+    def mark_stale(self):
+        """書き込み直後など、次のアクセスで必ず読み直させる (変更として通知する)。"""
+        with self.lock:
+            # 書き込んだセッションが自分の記録を見られるように、読み込み回数の上限も外す
+            self.read_at = self.last_read = None
+            self.stale_gen += 1
+            self._publish()
+
+    def want(self, session_id, interval):
+        """セッションが希望する読み直し間隔 (秒) を登録する。None なら希望を取り下げる (既定の ttl)。"""
+        with self.lock:
+            if interval is None: self.wants.pop(session_id, None)
+            else: self.wants[session_id] = (interval, time.monotonic())
+
+    def _ttl(self, now):
+        # self.lock を持った状態で呼ぶ。want_window 秒以内に登録された希望だけを数える
+        self.wants = {k: w for k, w in self.wants.items() if now - w[1] < self.want_window}
+        ttl = min((w[0] for w in self.wants.values()), default=self.ttl)
+        return max(ttl, self.min_interval)
+
+    def effective_ttl(self):
+        """いまの読み直し間隔 (秒)"""
+        with self.lock: return self._ttl(time.monotonic())
+
+    def is_fresh(self):
+        """読み直し間隔の内で、読み直さなくてよいか。"""
+        return self.read_at is not None and time.monotonic() - self.read_at < self.effective_ttl()
+
+    def wait(self, changes, timeout):
+        """変更カウンタが changes から変わるか timeout 秒たつまで待ち、そのときのカウンタを返す。"""
+        with self.changed:
+            self.changed.wait_for(lambda: self.changes != changes, timeout)
+            return self.changes
+
+    def invalidate(self):
+        """Undo・ログ編集など追記以外の変更の後に呼ぶ (次回は全再計算)。"""
+        with self.state_lock: self.state.invalidate()
+        with self.lock:
+            self.read_at = None
+            self.stale_gen += 1
+            self._publish()
+
+    def metrics(self, active_window=60.0):
+        now = time.monotonic()
+        with self.lock:
+            self.sessions = {k: t for k, t in self.sessions.items() if now - t < active_window * 10}
+            active = sum(1 for t in self.sessions.values() if now - t < active_window)
+        total = self.stats["hits"] + self.stats["builds"]
+        return {
+            "version": self.snapshot.version,
+            "changes": self.changes,
+            "rows": len(self.snapshot.frame),
+            "active_sessions": active,
+            "ttl": self.effective_ttl(),
+            "wants": len(self.wants),
+            "hit_rate": self.stats["hits"] / total if total else 0.0,
+            "duplicate_rows": len(self.state.duplicate_rows),
+            "double_taps": len(self.state.double_taps),
+            **self.stats,
+        }
+
+
+def predict_next_passing(race_index, tid, recent=3):
+    """
+    チームの次の通過の予想。(次の地点 (Section, Location) または None, 予想時刻 TimeMs) を返す。分からなければ None。
+    地点間の所要時間 (コースの距離・起伏) は先に通過したチームの記録の中央値から求め、
+    このチームの直近 recent 地点間のペース (先行チームとの比。次を走る走者のものを優先) で補正する。
+    先に通過したチームがいない (先頭) ときは、このチームの直近のポイントラップの中央値を使う。
+    """
+    last = race_index.latest(tid)
+    if last is None: return None
+    here = (last['Section'], last['Location'])
+    if last['Location'] == 'Finish' or here not in race_index.points: return None
+    i = race_index.points.index(here)
+    nxt = race_index.points[i + 1] if i + 1 < len(race_index.points) else None
+    splits = lambda point: race_index.point_splits(*point)
+
+    # 直近 recent 地点間の、このチームのラップと、先行チームのラップ (中央値) との比。
+    # 次の地点までを走る走者の区間 (中継所の次は次の区間の走者) のものを分けておく
+    runner = nxt[0] if nxt is not None else here[0]
+    mine, ratios, same_runner = [], [], []
+    for a, b in zip(race_index.points[max(0, i - recent):i], race_index.points[max(1, i - recent + 1):i + 1]):
+        sa, sb = splits(a), splits(b)
+        if tid not in sa or tid not in sb: continue
+        lap = sb[tid] - sa[tid]
+        field = [sb[t] - sa[t] for t in sb if t in sa and t != tid]
+        mine.append(lap)
+        if not field or np.median(field) <= 0: continue
+        ratios.append(lap / np.median(field))
+        if b[0] == runner: same_runner.append(ratios[-1])
+    # 同じ走者のペースがあればそれを、無ければ (走り出した直後) 前の走者のペースを使う
+    ratios = same_runner or ratios
+    if nxt is not None:
+        here_s, next_s = splits(here), splits(nxt)
+        field = [next_s[t] - here_s[t] for t in next_s if t in here_s]
+        if field:
+            pace = float(np.median(ratios)) if ratios else 1.0
+            return nxt, float(last['TimeMs']) + float(np.median(field)) * pace
+    if not mine: return None
+    return nxt, float(last['TimeMs']) + float(np.median(mine))
+
+
+def refresh_interval(eta_ms, now_ms, min_sec=2.0, max_sec=60.0, lead_sec=60.0):
+    """
+    次の通過の予想時刻 eta_ms までの残りから、読み直す間隔 (秒) を決める。
+    予想の lead_sec 秒前から、予想を lead_sec × 3 過ぎるまでは min_sec。それより前は残りの 1/4 (max_sec まで)。
+    大きく遅れている (記録漏れなど) ときや予想できないときは None (既定の間隔)。
+    """
+    if eta_ms is None: return None
+    left = (eta_ms - now_ms) / 1000
+    if left < -lead_sec * 3: return None
+    if left <= lead_sec: return min_sec
+    return float(min(max(left / 4, min_sec), max_sec))
+
+
+class CpuMeter:
+    """
+    描画にかかったサーバーの CPU 時間を種類 (全体の再実行・部分更新など) ごとに集計する。
+    スレッドごとの CPU 時間で測るので、同時に動いている他のセッションの分は入らない。
+    """
+
+    def __init__(self, window=60.0):
+        self.window = window
+        self.lock = threading.Lock()
+        self.totals = {}  # kind -> [回数, CPU秒]
+        self.recent = deque()  # (時刻, session_id, CPU秒)
+
+    def add(self, kind, cpu_sec, session_id=None):
+        now = time.monotonic()
+        with self.lock:
+            total = self.totals.setdefault(kind, [0, 0.0])
+            total[0] += 1
+            total[1] += cpu_sec
+            self.recent.append((now, session_id, cpu_sec))
+            while self.recent and now - self.recent[0][0] > self.window: self.recent.popleft()
+
+    @contextmanager
+    def measure(self, kind, session_id=None):
+        start = time.thread_time()
+        try: yield
+        finally: self.add(kind, time.thread_time() - start, session_id)
+
+    def metrics(self):
+        """kinds: 種類ごとの回数と1回あたりの CPU ミリ秒 / per_session_ms_per_min: 直近 window 秒の1セッションあたり CPU ミリ秒 (1分換算)"""
+        now = time.monotonic()
+        with self.lock:
+            recent = [(sid, sec) for t, sid, sec in self.recent if now - t <= self.window]
+            kinds = {k: {"runs": n, "ms_per_run": sec / n * 1000 if n else 0.0} for k, (n, sec) in self.totals.items()}
+        sessions = {sid for sid, _ in recent}
+        cpu_ms = sum(sec for _, sec in recent) * 1000
+        return {"kinds": kinds, "sessions": len(sessions),
+                "per_session_ms_per_min": cpu_ms / len(sessions) * 60 / self.window if sessions else 0.0}
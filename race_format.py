@@ -0,0 +1,91 @@
+# ==========================================
+# えきでんくん 表示用フォーマット
+# 1件ずつの fmt_* と、列をまとめて整形する fmt_*_ms (表示する行だけに使う)
+# ==========================================
+
+import math
+
+import numpy as np
+import pandas as pd
+
+
+def fmt_time(sec):
+    sec = math.ceil(sec)
+    m, s = divmod(int(sec), 60)
+    h, m = divmod(m, 60)
+    return f"{h:01}:{m:02}:{s:02}"
+
+
+def fmt_lap(sec):
+    total_tenths = math.ceil(sec * 10)
+    rem_tenths = total_tenths % 10
+    total_sec = total_tenths // 10
+    m, s = divmod(total_sec, 60)
+    return f"{m:02}:{s:02}.{rem_tenths}"
+
+
+def fmt_diff(sec):
+    if sec is None or math.isnan(sec): return "-"
+    sign = "+" if sec > 0 else "-" if sec < 0 else "±"
+    return f"{sign}{fmt_time(abs(sec))}"
+
+
+# --- 列をまとめて整形 (ミリ秒の整数演算。切り上げは fmt_time / fmt_lap と同じ) ---
+
+# 数字→文字列の変換表 (1件ずつ f-string を作らずに配列の添字で引く)
+_NUM = np.array([str(i) for i in range(1000)], dtype=object)
+_PAD2 = np.array([f"{i:02}" for i in range(1000)], dtype=object)
+
+
+def _as_ms(ms):
+    # Series / ndarray / list を受け取り、(整数ms, 欠損マスク, index) にそろえる
+    s = ms if isinstance(ms, pd.Series) else pd.Series(ms)
+    f = s.astype('float64')
+    na = f.isna().to_numpy()
+    return f.fillna(0).round().to_numpy(dtype='int64'), na, s.index
+
+
+def _text(values, table):
+    if len(values) == 0 or (values.min() >= 0 and values.max() < len(table)): return table[values]
+    width = len(table[0])
+    return np.array([f"{v:0{width}}" for v in values], dtype=object)
+
+
+def _join(parts, na, index, missing="-"):
+    if na.any(): parts = np.where(na, missing, parts)
+    return pd.Series(parts, index=index, dtype=object)
+
+
+def _time_parts(ms):
+    sec = -(-ms // 1000)  # 秒に切り上げ
+    m, s = np.divmod(sec, 60)
+    h, m = np.divmod(m, 60)
+    return _text(h, _NUM) + ":" + _PAD2[m] + ":" + _PAD2[s]
+
+
+def fmt_time_ms(ms):
+    """ミリ秒の列 → "H:MM:SS" (秒に切り上げ)。欠損は "-"。"""
+    ms, na, index = _as_ms(ms)
+    return _join(_time_parts(ms), na, index)
+
+
+def fmt_lap_ms(ms):
+    """ミリ秒の列 → "MM:SS.t" (0.1秒に切り上げ)。欠損は "-"。"""
+    ms, na, index = _as_ms(ms)
+    tenths = -(-ms // 100)
+    total_sec, rem = np.divmod(tenths, 10)
+    m, s = np.divmod(total_sec, 60)
+    return _join(_text(m, _PAD2) + ":" + _PAD2[s] + "." + _NUM[rem], na, index)
+
+
+def fmt_diff_ms(ms):
+    """ミリ秒の列 → "+H:MM:SS" / "-H:MM:SS" / "±0:00:00" (fmt_diff と同じ)。欠損は "-"。"""
+    ms, na, index = _as_ms(ms)
+    sign = np.where(ms > 0, "+", np.where(ms < 0, "-", "±")).astype(object)
+    return _join(sign + _time_parts(np.abs(ms)), na, index)
+
+
+def fmt_gap_ms(ms):
+    """前との差・トップ差の表示: "+H:MM:SS"。欠損は "-"。"""
+    ms, na, index = _as_ms(ms)
+    return _join("+" + _time_parts(ms), na, index)
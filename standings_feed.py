@@ -0,0 +1,234 @@
+# ==========================================
+# えきでんくん 順位フィード (読み取り専用 HTTP)
+# 観戦画面と同じ共有スナップショット (RaceHub) から、チームの現在地・地点ごとの順位と差・完走チームを JSON で返す。
+# 電光掲示板・会場スクリーン・LINE bot などが Streamlit の画面を読みに来なくて済むようにする。
+#   GET /standings        : JSON。ETag を付け、If-None-Match が同じなら 304 (本文なし)
+#   GET /standings/events : Server-Sent Events。変更があるたびに standings を送る (変わらなければ keepalive だけ)
+#   GET /healthz          : 動作確認
+# 本文はスナップショットの版ごとに1回だけ作り、全クライアントで使い回す。
+# Streamlitに依存しない (app.py から別スレッドで起動する。単体でも SQLite の保存先に対して動かせる)
+#   python standings_feed.py --sqlite ekiden.db --port 8502 [--host 0.0.0.0]
+# 認証は無いので、既定では 127.0.0.1 (同じマシン) でだけ待ち受ける。app.py からは EKIDEN_FEED_PORT を設定したときだけ起動する
+# ==========================================
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from race_format import fmt_time
+
+FINISH = "Finish"
+
+
+def _ms(v):
+    return None if pd.isna(v) else int(v)
+
+
+def _ms_list(values):
+    # 列 → int / None のリスト (地点ごとの全通過をまとめて変換する)
+    a = pd.Series(values).to_numpy(dtype='float64', na_value=float('nan'))
+    return [None if v != v else int(v) for v in a.tolist()]
+
+
+def _split(ms):
+    return None if ms is None else fmt_time(ms / 1000)
+
+
+def team_names(config):
+    """config の TeamName_<ID> → {TeamID: チーム名} (設定の順)"""
+    return {k.replace("TeamName_", ""): v for k, v in (config or {}).items() if k.startswith("TeamName_")}
+
+
+def build_standings(snapshot, config):
+    """
+    スナップショット → JSON にできる dict。
+    teams: チームごとの現在地 (最後の通過) / points: 地点ごとの通過順・トップとの差・前との差 / finishers: 完走順
+    行ごとの iloc は遅いので、列をまとめてリストにしてから組み立てる。
+    """
+    frame, index, names = snapshot.frame, snapshot.index, team_names(config)
+    teams, points, finishers = [], [], []
+    if not frame.empty:
+        # 地点ごと・スプリット順 (RaceIndex.point と同じ並び)
+        order = np.argsort(frame['SplitMs'].to_numpy(dtype='float64'), kind='stable')
+        f = frame.iloc[order]
+        col = {c: f[c].tolist() for c in ("TeamID", "TeamName", "Section", "Location", "Rank")}
+        col.update({c: _ms_list(f[c]) for c in ("SplitMs", "PointMs", "PrevDiffMs")})
+        row = lambda i: {"rank": col["Rank"][i], "team_id": col["TeamID"][i], "team_name": names.get(col["TeamID"][i], col["TeamName"][i]),
+                         "split_ms": col["SplitMs"][i], "prev_diff_ms": col["PrevDiffMs"][i]}
+        by_point = f.reset_index(drop=True).groupby(["Section", "Location"], sort=False, observed=True).indices
+        for section, location in index.points:
+            pos = by_point.get((section, location), [])
+            head = col["SplitMs"][pos[0]] if len(pos) else None
+            results = [row(i) for i in pos]
+            for r in results: r["gap_ms"] = None if r["split_ms"] is None or head is None else r["split_ms"] - head
+            points.append({"section": section, "location": location, "results": results})
+            if location == FINISH: finishers += [{**r, "split": _split(r["split_ms"])} for r in results]
+        # チームの最新記録 = f (時刻順、同時刻はシート順) で最後の行 (RaceIndex.latest と同じ)
+        latest = dict(zip(col["TeamID"], range(len(f))))
+    for tid in list(names) + [t for t in index.team_ids() if t not in names]:
+        entry = {"team_id": tid, "team_name": names.get(tid, tid)}
+        if not frame.empty and tid in latest:
+            i = latest[tid]
+            entry.update(section=col["Section"][i], location=col["Location"][i], rank=col["Rank"][i],
+                         split_ms=col["SplitMs"][i], split=_split(col["SplitMs"][i]), point_lap_ms=col["PointMs"][i],
+                         prev_diff_ms=col["PrevDiffMs"][i], finished=col["Location"][i] == FINISH)
+        teams.append(entry)
+    finishers.sort(key=lambda r: (r["split_ms"] is None, r["split_ms"] or 0))
+    for i, r in enumerate(finishers): r["rank"] = i + 1
+    return {"race": (config or {}).get("RaceName"), "version": snapshot.version,
+            "built_at": snapshot.built_at or None, "start_ms": _ms(index.start_ms),
+            "teams": teams, "points": points, "finishers": finishers}
+
+
+class StandingsFeed:
+    """
+    hub: RaceHub / read: 生ログを読む関数 (hub.get に渡す) / config: 設定 dict を返す関数 (config_ttl 秒ごとに呼ぶ)
+    keepalive_sec: SSE で変更が無いときに keepalive を送る間隔 / max_streams: 同時に開ける SSE の数
+    """
+
+    def __init__(self, hub, read, config, config_ttl=60.0, keepalive_sec=15.0, max_streams=50):
+        self.hub = hub
+        self.read = read
+        self.config = config
+        self.config_ttl = config_ttl
+        self.keepalive_sec = keepalive_sec
+        self.max_streams = max_streams
+        self.lock = threading.Lock()
+        self._config, self._config_at = None, None
+        self._key, self._body, self._etag = None, b"", '""'
+        self.server = None
+        self.stats = {"requests": 0, "not_modified": 0, "builds": 0, "streams": 0, "events": 0, "rejected": 0}
+
+    def _count(self, key, n=1):
+        with self.lock: self.stats[key] += n
+
+    def current(self):
+        """(ETag, JSON本文) を返す。スナップショットと設定が前回と同じなら作り直さない。"""
+        snapshot = self.hub.get(self.read)
+        with self.lock:
+            now = time.monotonic()
+            if self._config_at is None or now - self._config_at >= self.config_ttl:
+                try: self._config = self.config() or {}
+                except Exception: self._config = self._config or {}
+                self._config_at = now
+            key = (snapshot.version, tuple(self._config.items()))
+            if key != self._key:
+                self._body = json.dumps(build_standings(snapshot, self._config), ensure_ascii=False).encode()
+                # 再起動で版番号が戻っても取り違えないように、中身のハッシュを ETag にする
+                self._etag = '"' + hashlib.blake2b(self._body, digest_size=8).hexdigest() + '"'
+                self._key = key
+                self.stats["builds"] += 1
+            return self._etag, self._body
+
+    def stream(self, write, last_id=None):
+        """
+        切断されるまで SSE を送り続ける (同時接続が max_streams を超えていたら False)。
+        write: bytes を送る関数 (切断されたら例外) / last_id: Last-Event-ID (同じ中身なら最初の送信を省く)
+        """
+        with self.lock:
+            if self.stats["streams"] >= self.max_streams:
+                self.stats["rejected"] += 1
+                return False
+            self.stats["streams"] += 1
+        try:
+            write(b"retry: 3000\n\n")
+            sent, written = last_id, time.monotonic()
+            changes = self.hub.changes
+            while True:
+                etag, body = self.current()
+                if etag != sent:
+                    write(b"event: standings\nid: " + etag.encode() + b"\ndata: " + body + b"\n\n")
+                    sent, written = etag, time.monotonic()
+                    self._count("events")
+                elif time.monotonic() - written >= self.keepalive_sec:
+                    write(b": keepalive\n\n")
+                    written = time.monotonic()
+                # 記録があれば通知で起きる。無くても TTL ごとに読み直す (他のプロセスからの書き込みに追いつく)
+                changes = self.hub.wait(changes, min(self.keepalive_sec, self.hub.effective_ttl()))
+        except (BrokenPipeError, ConnectionResetError): pass
+        finally: self._count("streams", -1)
+        return True
+
+    def handler(self):
+        feed = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args): pass
+
+            def _headers(self, status, ctype=None, length=None, etag=None):
+                self.send_response(status)
+                if ctype: self.send_header("Content-Type", ctype)
+                if length is not None: self.send_header("Content-Length", str(length))
+                if etag: self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.end_headers()
+
+            def do_GET(self):
+                feed._count("requests")
+                path = self.path.split("?")[0].rstrip("/")
+                if path == "/healthz":
+                    self._headers(200, "text/plain", 2); self.wfile.write(b"ok")
+                elif path == "/standings":
+                    etag, body = feed.current()
+                    if etag in [t.strip() for t in self.headers.get("If-None-Match", "").split(",")]:
+                        feed._count("not_modified")
+                        self._headers(304, etag=etag)
+                    else:
+                        self._headers(200, "application/json; charset=utf-8", len(body), etag); self.wfile.write(body)
+                elif path == "/standings/events":
+                    def write(b): self.wfile.write(b); self.wfile.flush()
+                    self.close_connection = True
+                    self.send_response(200)
+                    for k, v in [("Content-Type", "text/event-stream; charset=utf-8"), ("Cache-Control", "no-cache"),
+                                 ("Connection", "close"), ("Access-Control-Allow-Origin", "*")]: self.send_header(k, v)
+                    self.end_headers()
+                    if not feed.stream(write, self.headers.get("Last-Event-ID")): write(b"event: busy\ndata: {}\n\n")
+                else:
+                    self._headers(404, "text/plain", 9); self.wfile.write(b"not found")
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=8502):
+        """別スレッドで HTTP サーバーを起動する (ポートが使えなければ OSError)。"""
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="standings-feed", daemon=True).start()
+        return self.server
+
+    def metrics(self):
+        with self.lock: return {"port": self.server.server_address[1] if self.server else None, **self.stats}
+
+
+def main():
+    from race_engine import RaceHub, RaceState, prepare_log
+    from storage import LogFollower, SQLiteStorage
+
+    p = argparse.ArgumentParser(description="えきでんくん 順位フィード (SQLite の保存先から)")
+    p.add_argument("--sqlite", default="ekiden.db")
+    p.add_argument("--host", default="127.0.0.1", help="待ち受けるアドレス (他の端末から読むなら 0.0.0.0)")
+    p.add_argument("--port", type=int, default=8502)
+    p.add_argument("--ttl", type=float, default=5.0, help="ログを読み直す間隔 (秒)")
+    args = p.parse_args()
+
+    storage = SQLiteStorage(args.sqlite)
+    hub, follower = RaceHub(RaceState(prepare_log), args.ttl), LogFollower(storage)
+    config = lambda: dict(zip(*(storage.read_config()[c].astype(str) for c in ("Key", "Value"))))
+    feed = StandingsFeed(hub, follower.read, config)
+    feed.serve(args.host, args.port)
+    print(f"http://{args.host}:{args.port}/standings")
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt: pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,854 @@
+# ==========================================
+# えきでんくん ストレージ
+# ログ・設定(config)・アーカイブ一覧(race_index) の読み書きをまとめる。
+#   GSheetsStorage: Googleスプレッドシート (従来どおり)
+#   SQLiteStorage : ローカルの SQLite ファイル (オフライン・1台のPCで大会を運営する用)
+# Streamlitに依存しない (接続オブジェクトは app.py から渡す)
+# ==========================================
+
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import gspread
+import pandas as pd
+
+# EventID / Op / Target は操作ジャーナルの列 (取り消し・やり直しも追記で表す。race_engine.resolve_ops 参照)
+LOG_HEADER = ["TeamID", "TeamName", "Section", "Location", "Time", "Race", "EventID", "Op", "Target"]
+CONFIG_HEADER = ["Key", "Value"]
+INDEX_HEADER = ["RaceID", "RaceName", "Date", "LogSheet", "ConfigSheet", "Note"]
+
+EVENT_COL = LOG_HEADER.index("EventID")
+TIME_COL = LOG_HEADER.index("Time")
+
+WORKSHEET_LOG = "latest-log"
+WORKSHEET_CONFIG = "config"
+WORKSHEET_INDEX = "race_index"
+
+
+def _row_key(row):
+    # シート読み込みでは数値が "1.0" になることがあるので prepare_log と同じく ".0" を落として比べる
+    row = list(row) + [""] * (len(LOG_HEADER) - len(row))
+    return tuple(str(v).removesuffix(".0") for v in row)
+
+
+def _col(i):
+    # 0始まりの列番号 → シートの列名 (LOG_HEADER は26列未満)
+    return chr(ord("A") + i)
+
+
+def _cell(v):
+    return "" if v is None or (not isinstance(v, str) and pd.isna(v)) else str(v).removesuffix(".0")
+
+
+def normalize_log(df):
+    """読み込んだログを LOG_HEADER の列・文字列 (空欄は ""、数値の ".0" は落とす) にそろえる。"""
+    df = df.reindex(columns=LOG_HEADER)
+    if len(df) < 200:  # 差分読み込みの数行は1セルずつ (列ごとの pandas 処理は固定費の方が大きい)
+        return pd.DataFrame([[_cell(v) for v in r] for r in df.itertuples(index=False)],
+                            columns=LOG_HEADER, index=df.index, dtype=str)
+    df = df.astype(object)
+    df = df.where(df.notna(), "").astype(str)
+    return df.apply(lambda c: c.str.replace(r"\.0$", "", regex=True))
+
+
+def log_fingerprint(times, ids):
+    """ログの (行数, Time と EventID 列のハッシュ)。行の削除・並べ替え・時刻の修正を、全列を読まずに見つけるのに使う。"""
+    times, ids = list(times), list(ids)
+    n = max(len(times), len(ids))
+    times, ids = times + [""] * (n - len(times)), ids + [""] * (n - len(ids))
+    h = hashlib.blake2b(digest_size=8)
+    for t, e in zip(times, ids): h.update(f"{_cell(t)}\t{_cell(e)}\n".encode())
+    return n, h.hexdigest()
+
+
+class Storage:
+    """
+    ストレージの共通インターフェース。シート名 (sheet) は Googleスプレッドシートのワークシート名に相当し、
+    省略時は最新ログ / 最新設定を指す。読み込みは全列文字列の DataFrame を返す。
+    ttl: 読み込みキャッシュの秒数 (キャッシュを持たないバックエンドでは無視)
+    """
+    name = "base"
+
+    # --- ログ ---
+    def read_log(self, sheet=None, start=0, ttl=0):
+        """ログの start 行目 (0始まり、ヘッダ除く) 以降を読む。"""
+        raise NotImplementedError
+
+    def log_fingerprint(self):
+        """最新ログの log_fingerprint。既定は全体を読む (バックエンドは必要な列だけ読む)。"""
+        df = normalize_log(self.read_log())
+        return log_fingerprint(df["Time"], df["EventID"])
+
+    def append_log(self, rows):
+        """
+        最新ログの末尾に行 (LOG_HEADER 順のリスト) を追加し、書き込んだ位置 (0始まり、ヘッダ除く) のリストを返す。
+        位置が分からないときは None。EventID が既にログにある行は追加しない (再送しても二重にならない)。
+        """
+        raise NotImplementedError
+
+    # --- 設定 ---
+    def read_config(self, sheet=None, ttl=0):
+        raise NotImplementedError
+
+    def write_config(self, df):
+        raise NotImplementedError
+
+    # --- レースの作成・アーカイブ ---
+    def read_index(self, ttl=0):
+        raise NotImplementedError
+
+    def start_race(self, config_rows):
+        """最新ログを空にし、設定を config_rows ([Key, Value] のリスト) で作り直す。"""
+        raise NotImplementedError
+
+    def archive(self, race_id, race_name, date, log_name, conf_name):
+        """最新ログ・設定を log_name / conf_name に複製して一覧に登録し、最新側を空にする。"""
+        raise NotImplementedError
+
+    def delete_archives(self, race_ids):
+        raise NotImplementedError
+
+    def reset(self):
+        """最新ログと設定を全消去する。"""
+        raise NotImplementedError
+
+    def clear_cache(self):
+        """読み込みキャッシュを捨てる (書き込みの直後など)。"""
+
+
+# ==========================================
+# Sheets API の割り当て (1分あたりのリクエスト数)
+# ==========================================
+class QuotaThrottled(Exception):
+    """割り当てを使い切っていて、待てる時間内にリクエストを出せなかった。"""
+
+
+def _is_quota_error(e):
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    return status == 429 or "RESOURCE_EXHAUSTED" in str(e) or "Quota exceeded" in str(e)
+
+
+class TokenBucket:
+    """1分あたり per_min 回。burst 回までは続けて出せる。"""
+
+    def __init__(self, per_min, burst=None):
+        self.per_min = per_min
+        self.rate = per_min / 60.0
+        self.capacity = burst or max(1.0, per_min / 6)  # 既定は10秒分
+        self.tokens = self.capacity
+        self.at = time.monotonic()
+
+    def take(self, now):
+        """1回分を取る。取れたら 0、足りなければ次の1回までの秒数を返す (取らない)。"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.at) * self.rate)
+        self.at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class ApiScheduler:
+    """
+    Sheets API のリクエストを1か所で順番待ちさせる。割り当ての種類 (read / write) ごとにトークンバケットを持つ。
+    ・記録係の書き込み (urgent) が待っている間は、観戦側の読み込みを出さない
+    ・429 (割り当て超過) はジッター付きの指数バックオフで待ってやり直し、その間は全体を止める
+    ・同じ読み込みが同時に来たら、1回のリクエストの結果を全員で使う (read)
+    観戦側の読み込みは read_wait 秒より長く待つなら諦めて QuotaThrottled を出す (前回の結果を表示し続ける)。
+    """
+
+    def __init__(self, read_per_min=60, write_per_min=60, read_wait=2.0, write_wait=30.0,
+                 retries=5, backoff=1.0, backoff_max=32.0):
+        self.buckets = {"read": TokenBucket(read_per_min), "write": TokenBucket(write_per_min)}
+        self.read_wait, self.write_wait = read_wait, write_wait
+        self.retries, self.backoff, self.backoff_max = retries, backoff, backoff_max
+        self.cond = threading.Condition()
+        self.cooldown_until = 0.0  # 429 の後、この時刻までは誰もリクエストを出さない
+        self.waiting = {"urgent": 0, "normal": 0}
+        self.inflight = {}   # 読み込みの key -> 実行中のリクエストの結果を待つための Event
+        self.stats = {k: {"requests": 0, "waited": 0, "wait_sec": 0.0, "throttled": 0, "quota_errors": 0, "coalesced": 0}
+                      for k in self.buckets}
+        self.decisions = deque(maxlen=30)  # 直近の待たせた・諦めた・やり直した記録
+
+    def _note(self, kind, decision, detail=""):
+        self.decisions.append({"time": time.strftime("%H:%M:%S"), "kind": kind, "decision": decision, "detail": detail})
+
+    def _acquire(self, kind, urgent):
+        lane = "urgent" if urgent else "normal"
+        start = time.monotonic()
+        deadline = start + (self.write_wait if urgent else self.read_wait)
+        with self.cond:
+            self.waiting[lane] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self.cooldown_until - now
+                    if wait <= 0 and not urgent and self.waiting["urgent"]: wait = 0.05  # 書き込みに譲る
+                    elif wait <= 0: wait = self.buckets[kind].take(now)
+                    if wait <= 0: break
+                    if now + wait > deadline:
+                        self.stats[kind]["throttled"] += 1
+                        self._note(kind, "諦めた", f"あと{wait:.1f}秒待つ必要あり ({lane})")
+                        raise QuotaThrottled(f"Sheets API の割り当て ({kind}) を使い切っています")
+                    self.cond.wait(wait)
+            finally:
+                self.waiting[lane] -= 1
+                self.cond.notify_all()
+            waited = time.monotonic() - start
+            st = self.stats[kind]
+            st["requests"] += 1
+            if waited > 0.01:
+                st["waited"] += 1
+                st["wait_sec"] += waited
+                self._note(kind, "待たせた", f"{waited:.2f}秒 ({lane})")
+
+    def call(self, kind, fn, urgent=False):
+        """割り当て kind ("read" / "write") を1回分取ってから fn() を呼ぶ。429 はバックオフしてやり直す。"""
+        for attempt in range(self.retries + 1):
+            self._acquire(kind, urgent)
+            try: return fn()
+            except Exception as e:
+                if not _is_quota_error(e) or attempt == self.retries: raise
+                delay = min(self.backoff_max, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                with self.cond:
+                    self.stats[kind]["quota_errors"] += 1
+                    self.cooldown_until = max(self.cooldown_until, time.monotonic() + delay)
+                    self._note(kind, "429", f"{delay:.1f}秒止めてやり直し ({attempt + 1}回目)")
+
+    def read(self, key, fn, urgent=False):
+        """観戦側の読み込み。同じ key の読み込みが実行中なら、新たに出さずにその結果を使う。urgent は call と同じ。"""
+        with self.cond:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader: flight = self.inflight[key] = {"done": threading.Event(), "result": None, "error": None}
+            else: self.stats["read"]["coalesced"] += 1
+        if not leader:
+            flight["done"].wait()
+            if flight["error"] is not None: raise flight["error"]
+            return flight["result"]
+        try:
+            flight["result"] = self.call("read", fn, urgent)
+            return flight["result"]
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self.cond: self.inflight.pop(key, None)
+            flight["done"].set()
+
+    def metrics(self):
+        with self.cond:
+            now = time.monotonic()
+            return {
+                "waiting": dict(self.waiting),
+                "cooldown_sec": max(0.0, self.cooldown_until - now),
+                "buckets": {k: {"per_min": b.per_min, "tokens": min(b.capacity, b.tokens + (now - b.at) * b.rate)}
+                            for k, b in self.buckets.items()},
+                "stats": {k: dict(v) for k, v in self.stats.items()},
+                "decisions": list(self.decisions),
+            }
+
+
+# ==========================================
+# Googleスプレッドシート
+# ==========================================
+class SheetsClientPool:
+    """
+    gspread のクライアントをプロセスで1つだけ作り (認証1回・HTTPセッションは keep-alive で共有)、
+    Spreadsheet / Worksheet の取得結果も使い回す。アクセストークンの更新はクライアントのセッションが自動で行う。
+    action() の中で発生したAPIリクエスト数と、使い回しで省けた往復数を操作ごとに数える。
+
+    authorize: gspread クライアントを作る関数 / url: スプレッドシートのURL
+    scheduler: ApiScheduler。書き込み側の操作のリクエストは優先 (urgent) で出す (action(..., urgent=False) は観戦側の読み込み)
+    """
+
+    def __init__(self, authorize, url, scheduler=None):
+        self.authorize = authorize
+        self.url = url
+        self.scheduler = scheduler
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.client = None
+        self.book = None
+        self.sheets = {}  # ワークシート名 -> Worksheet
+        self.stats = {}   # 操作名 -> {"calls", "requests", "saved"}
+        self.authorizations = 0
+
+    def _count(self, key, n=1):
+        name = getattr(self.local, "action", None) or "other"
+        with self.lock:
+            st = self.stats.setdefault(name, {"calls": 0, "requests": 0, "saved": 0})
+            st[key] += n
+
+    def _instrument(self, client):
+        # gspread 5 は Client.request、6 以降は Client.http_client.request が全APIリクエストの入口
+        target = getattr(client, "http_client", client)
+        send = target.request
+        def request(method, *args, **kwargs):
+            self._count("requests")
+            if self.scheduler is None: return send(method, *args, **kwargs)
+            kind = "read" if str(method).lower() == "get" else "write"
+            urgent = getattr(self.local, "urgent", True)
+            return self.scheduler.call(kind, lambda: send(method, *args, **kwargs), urgent=urgent)
+        target.request = request
+        return client
+
+    @contextmanager
+    def action(self, name, urgent=True):
+        """この中で行ったAPIリクエストを name の操作として数える。"""
+        outer = getattr(self.local, "action", None)
+        self.local.action = outer or name
+        if outer is None:
+            self.local.first = True  # この操作で最初の Spreadsheet 取得か (省けた往復の数え方)
+            self.local.urgent = urgent
+            self._count("calls")
+        try: yield
+        finally:
+            self.local.action = outer
+            if outer is None: self.local.urgent = True
+
+    def _open(self):
+        # 使い回さなければ、操作ごとに 認証 (トークン取得) + open_by_url の往復が1回ずつ要る
+        first, self.local.first = getattr(self.local, "first", True), False
+        if self.book is not None:
+            if first: self._count("saved", 2)
+            return self.book
+        if self.client is None:
+            self.client = self._instrument(self.authorize())
+            self.authorizations += 1
+        elif first: self._count("saved")
+        self.book = self.client.open_by_url(self.url)
+        return self.book
+
+    def spreadsheet(self):
+        with self.lock: return self._open()
+
+    def worksheet(self, name):
+        with self.lock:
+            book, ws = self._open(), self.sheets.get(name)
+            if ws is not None:
+                self._count("saved")  # worksheet(name) のメタデータ取得
+                return ws
+            ws = self.sheets[name] = book.worksheet(name)
+            return ws
+
+    def forget(self, name=None):
+        """ワークシートの削除・作成後や、古い情報でエラーになったときに取得結果を捨てる。"""
+        with self.lock:
+            if name is None: self.book, self.sheets = None, {}
+            else: self.sheets.pop(name, None)
+
+    def metrics(self):
+        with self.lock:
+            return {"authorizations": self.authorizations, "actions": {k: dict(v) for k, v in self.stats.items()}}
+
+
+class GSheetsStorage(Storage):
+    """
+    読み込みは st.connection (GSheetsConnection)、書き込みは gspread で行う。
+    読み込み結果は ttl 秒だけ自前で使い回し、API を呼ぶときは scheduler (ApiScheduler) を通す。
+    conn: GSheetsConnection / pool: SheetsClientPool / url: スプレッドシートのURL
+    """
+    name = "gsheets"
+
+    def __init__(self, conn, pool, url, scheduler=None):
+        self.conn = conn
+        self.pool = pool
+        self.url = url
+        self.scheduler = scheduler or pool.scheduler or ApiScheduler()
+        self.reads = {}  # ワークシート名 -> (読み込んだ時刻, DataFrame)
+        self.header_ok = False
+        self.unsure = False  # 前回の追記が届いたか分からない (タイムアウトなど) → 次の追記の前に EventID を確かめる
+
+    def _book(self):
+        return self.pool.spreadsheet()
+
+    def _sheet(self, name):
+        return self.pool.worksheet(name)
+
+    def _call(self, action, fn, urgent=True):
+        # 使い回したハンドルが古くなっていた (シートの削除・作り直しなど) ときは取り直して1回だけやり直す。
+        # 書き込みが届いたか分からないエラー (タイムアウトなど) はやり直さない
+        with self.pool.action(action, urgent):
+            try: return fn()
+            except (gspread.exceptions.WorksheetNotFound, gspread.exceptions.APIError) as e:
+                if isinstance(e, gspread.exceptions.APIError) and e.response.status_code not in (400, 404): raise
+                self.pool.forget()
+                return fn()
+
+    def _read(self, sheet, ttl, urgent=False):
+        hit = self.reads.get(sheet)
+        if hit is not None and time.monotonic() - hit[0] < ttl: return hit[1]
+        df = self.scheduler.read(sheet, lambda: self.conn.read(spreadsheet=self.url, worksheet=sheet, ttl=0), urgent)
+        self.reads[sheet] = (time.monotonic(), df)
+        return df
+
+    def clear_cache(self):
+        self.reads.clear()
+
+    @staticmethod
+    def _clear(ws, header):
+        ws.clear()
+        ws.append_row(header)
+
+    def _index_sheet(self, sh):
+        try: return self._sheet(WORKSHEET_INDEX)
+        except Exception:
+            ws = sh.add_worksheet(title=WORKSHEET_INDEX, rows=100, cols=10)
+            ws.append_row(INDEX_HEADER)
+            self.pool.forget()
+            return ws
+
+    def read_log(self, sheet=None, start=0, ttl=0):
+        if not start: return self._read(sheet or WORKSHEET_LOG, ttl)
+        # 途中からは範囲指定で必要な行だけ読む (キャッシュしない)
+        rng = f"A{start + 2}:{_col(len(LOG_HEADER) - 1)}"
+        rows = self._call("read_log_tail", lambda: self._sheet(sheet or WORKSHEET_LOG).get(rng), urgent=False)
+        rows = [list(r) + [""] * (len(LOG_HEADER) - len(r)) for r in rows or []]
+        df = pd.DataFrame([r[:len(LOG_HEADER)] for r in rows], columns=LOG_HEADER, dtype=str)
+        df.index += start
+        return df
+
+    def log_fingerprint(self):
+        cols = [f"{_col(i)}2:{_col(i)}" for i in (TIME_COL, EVENT_COL)]
+        times, ids = self._call("log_fingerprint", lambda: self._sheet(WORKSHEET_LOG).batch_get(cols), urgent=False)
+        return log_fingerprint((r[0] if r else "" for r in times), (r[0] if r else "" for r in ids))
+
+    def _upgrade_header(self, ws):
+        # 操作ジャーナルの列が無い古いログは、ヘッダ行だけ書き足す (プロセスで1回だけ確認)
+        if self.header_ok: return
+        if ws.row_values(1)[:len(LOG_HEADER)] != LOG_HEADER: ws.update("A1", [LOG_HEADER])
+        self.header_ok = True
+
+    def append_log(self, rows):
+        # 毎回シートを読んで確かめると往復が倍になるので、EventID の確認は前回の追記が失敗したときだけ行う
+        sent = rows
+        def append():
+            nonlocal sent
+            ws = self._sheet(WORKSHEET_LOG)
+            self._upgrade_header(ws)
+            if self.unsure:
+                have = set(ws.col_values(EVENT_COL + 1)[1:])
+                sent = [r for r in rows if len(r) <= EVENT_COL or not r[EVENT_COL] or r[EVENT_COL] not in have]
+                self.unsure = False
+            return ws.append_rows(sent) if sent else None
+        try: res = self._call("append_log", append)
+        except Exception:
+            self.unsure = True
+            raise
+        if len(sent) != len(rows): return None
+        # 応答の updatedRange ("'latest-log'!A18:F19" など) から書き込んだ行番号が分かる
+        m = re.search(r"![A-Z]+(\d+)", str((res or {}).get("updates", {}).get("updatedRange", "")))
+        return list(range(int(m.group(1)) - 2, int(m.group(1)) - 2 + len(rows))) if m else None
+
+    def read_config(self, sheet=None, ttl=0):
+        # 設定が読めないとアプリはレース作成へ進んでしまう。割り当て待ちで読めなければ前回読んだ設定を返し、
+        # まだ一度も読んでいなければ書き込みと同じだけ待つ (それでも読めなければ QuotaThrottled)
+        sheet = sheet or WORKSHEET_CONFIG
+        try: return self._read(sheet, ttl)
+        except QuotaThrottled:
+            hit = self.reads.get(sheet)
+            return hit[1] if hit is not None else self._read(sheet, ttl, urgent=True)
+
+    def write_config(self, df):
+        self.scheduler.call("write", lambda: self.conn.update(spreadsheet=self.url, worksheet=WORKSHEET_CONFIG, data=df), urgent=True)
+        self.reads.pop(WORKSHEET_CONFIG, None)
+
+    def read_index(self, ttl=0):
+        return self._read(WORKSHEET_INDEX, ttl)
+
+    def start_race(self, config_rows):
+        def start():
+            self._index_sheet(self._book())
+            try: self._clear(self._sheet(WORKSHEET_LOG), LOG_HEADER)
+            except Exception: pass
+            ws_conf = self._sheet(WORKSHEET_CONFIG)
+            self._clear(ws_conf, CONFIG_HEADER)
+            ws_conf.append_rows(config_rows)
+        self._call("start_race", start)
+
+    def archive(self, race_id, race_name, date, log_name, conf_name):
+        with self.pool.action("archive"):
+            ws_idx = self._index_sheet(self._book())
+            ws_log, ws_conf = self._sheet(WORKSHEET_LOG), self._sheet(WORKSHEET_CONFIG)
+            ws_log.duplicate(new_sheet_name=log_name)
+            ws_conf.duplicate(new_sheet_name=conf_name)
+            self.pool.forget()  # シートの一覧が変わったので Spreadsheet を取り直す
+            ws_idx.append_row([race_id, race_name, date, log_name, conf_name, ""])
+            self._clear(ws_log, LOG_HEADER)
+            self._clear(ws_conf, CONFIG_HEADER)
+
+    def delete_archives(self, race_ids):
+        with self.pool.action("delete_archives"):
+            idx_df = self.read_index()
+            sh = self._book()
+            ws_idx = self._sheet(WORKSHEET_INDEX)
+            for _, row in idx_df[idx_df['RaceID'].isin(race_ids)].iterrows():
+                for name in (row['LogSheet'], row['ConfigSheet']):
+                    try: sh.del_worksheet(sh.worksheet(name))
+                    except Exception: pass
+                    self.pool.forget(name)
+            rest = idx_df[~idx_df['RaceID'].isin(race_ids)].values.tolist()
+            self._clear(ws_idx, INDEX_HEADER)
+            if rest: ws_idx.append_rows(rest)
+
+    def reset(self):
+        with self.pool.action("reset"):
+            try: self._clear(self._sheet(WORKSHEET_LOG), LOG_HEADER)
+            except Exception: pass
+            try: self._sheet(WORKSHEET_CONFIG).clear()
+            except Exception: pass
+
+
+# ==========================================
+# SQLite (ローカル)
+# ==========================================
+class SQLiteStorage(Storage):
+    """
+    1ファイルの SQLite にシート相当のテーブルを持つ。ログは (sheet, seq) を主キーにして
+    追記・範囲読み込みをインデックスだけで行う。WAL モードで読み書きを並行させる。
+    """
+    name = "sqlite"
+
+    SCHEMA = f"""
+        CREATE TABLE IF NOT EXISTS log (
+            sheet TEXT NOT NULL, seq INTEGER NOT NULL, {", ".join(f"{c} TEXT" for c in LOG_HEADER)},
+            PRIMARY KEY (sheet, seq)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS config (
+            sheet TEXT NOT NULL, seq INTEGER NOT NULL, Key TEXT, Value TEXT,
+            PRIMARY KEY (sheet, seq)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS race_index (
+            seq INTEGER PRIMARY KEY, {", ".join(f"{c} TEXT" for c in INDEX_HEADER)});
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Streamlit は実行ごとに別スレッドなので、1接続をロックで共有する
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        # 古いファイルに後から増えた列を足す
+        have = {r[1] for r in self.db.execute("PRAGMA table_info(log)")}
+        for c in LOG_HEADER:
+            if c not in have: self.db.execute(f"ALTER TABLE log ADD COLUMN {c} TEXT NOT NULL DEFAULT ''")
+        self.db.execute("CREATE INDEX IF NOT EXISTS log_event ON log (sheet, EventID)")
+
+    def _query(self, sql, params, columns):
+        with self.lock: rows = self.db.execute(sql, params).fetchall()
+        return pd.DataFrame(rows, columns=columns, dtype=str)
+
+    def _write(self, fn):
+        # 1回の操作を1トランザクションで (途中で失敗したら全部取り消す)
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try: fn(self.db)
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    @staticmethod
+    def _rows(values, width):
+        # シートと同じく、空欄は "" として文字列で保存する
+        return [[("" if pd.isna(v) else str(v)) for v in list(row)[:width]] + [""] * (width - len(row)) for row in values]
+
+    @staticmethod
+    def _insert_log(db, sheet, rows, first=0):
+        db.executemany(f"INSERT INTO log VALUES (?, ?, {', '.join('?' * len(LOG_HEADER))})",
+                       [(sheet, first + i, *r) for i, r in enumerate(SQLiteStorage._rows(rows, len(LOG_HEADER)))])
+
+    @staticmethod
+    def _insert_config(db, sheet, rows):
+        db.executemany("INSERT INTO config VALUES (?, ?, ?, ?)",
+                       [(sheet, i, *r) for i, r in enumerate(SQLiteStorage._rows(rows, 2))])
+
+    @staticmethod
+    def _copy(db, table, src, dst):
+        db.execute(f"DELETE FROM {table} WHERE sheet = ?", (dst,))
+        cols = ", ".join(["seq"] + (LOG_HEADER if table == "log" else CONFIG_HEADER))
+        db.execute(f"INSERT INTO {table} SELECT ?, {cols} FROM {table} WHERE sheet = ?", (dst, src))
+
+    def read_log(self, sheet=None, start=0, ttl=0):
+        df = self._query(f"SELECT {', '.join(LOG_HEADER)} FROM log WHERE sheet = ? AND seq >= ? ORDER BY seq",
+                         (sheet or WORKSHEET_LOG, start), LOG_HEADER)
+        df.index += start
+        return df
+
+    def log_fingerprint(self):
+        with self.lock: rows = self.db.execute("SELECT Time, EventID FROM log WHERE sheet = ? ORDER BY seq", (WORKSHEET_LOG,)).fetchall()
+        return log_fingerprint((r[0] for r in rows), (r[1] for r in rows))
+
+    def append_log(self, rows):
+        rows = self._rows(rows, len(LOG_HEADER))
+        pos = []
+        def append(db):
+            # 既にある EventID (再送) は書かずに、その位置を返す。同じ呼び出しの中の重複も1行にする
+            ids = list({r[EVENT_COL] for r in rows if r[EVENT_COL]})
+            have = {}
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                have.update(db.execute(f"SELECT EventID, seq FROM log WHERE sheet = ? AND EventID IN ({', '.join('?' * len(chunk))})",
+                                       (WORKSHEET_LOG, *chunk)).fetchall())
+            seq = db.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM log WHERE sheet = ?", (WORKSHEET_LOG,)).fetchone()[0]
+            new = []
+            for r in rows:
+                eid = r[EVENT_COL]
+                if eid and eid in have: pos.append(have[eid]); continue
+                if eid: have[eid] = seq + len(new)
+                pos.append(seq + len(new))
+                new.append(r)
+            self._insert_log(db, WORKSHEET_LOG, new, seq)
+        self._write(append)
+        return pos
+
+    def read_config(self, sheet=None, ttl=0):
+        return self._query("SELECT Key, Value FROM config WHERE sheet = ? ORDER BY seq", (sheet or WORKSHEET_CONFIG,), CONFIG_HEADER)
+
+    def write_config(self, df):
+        def write(db):
+            db.execute("DELETE FROM config WHERE sheet = ?", (WORKSHEET_CONFIG,))
+            self._insert_config(db, WORKSHEET_CONFIG, df.reindex(columns=CONFIG_HEADER).values.tolist())
+        self._write(write)
+
+    def read_index(self, ttl=0):
+        return self._query(f"SELECT {', '.join(INDEX_HEADER)} FROM race_index ORDER BY seq", (), INDEX_HEADER)
+
+    def start_race(self, config_rows):
+        def start(db):
+            db.execute("DELETE FROM log WHERE sheet = ?", (WORKSHEET_LOG,))
+            db.execute("DELETE FROM config WHERE sheet = ?", (WORKSHEET_CONFIG,))
+            self._insert_config(db, WORKSHEET_CONFIG, config_rows)
+        self._write(start)
+
+    def archive(self, race_id, race_name, date, log_name, conf_name):
+        def archive(db):
+            self._copy(db, "log", WORKSHEET_LOG, log_name)
+            self._copy(db, "config", WORKSHEET_CONFIG, conf_name)
+            db.execute(f"INSERT INTO race_index ({', '.join(INDEX_HEADER)}) VALUES (?, ?, ?, ?, ?, ?)",
+                       (race_id, race_name, date, log_name, conf_name, ""))
+            db.execute("DELETE FROM log WHERE sheet = ?", (WORKSHEET_LOG,))
+            db.execute("DELETE FROM config WHERE sheet = ?", (WORKSHEET_CONFIG,))
+        self._write(archive)
+
+    def delete_archives(self, race_ids):
+        def delete(db):
+            for rid in race_ids:
+                for log_name, conf_name in db.execute("SELECT LogSheet, ConfigSheet FROM race_index WHERE RaceID = ?", (rid,)).fetchall():
+                    db.execute("DELETE FROM log WHERE sheet = ?", (log_name,))
+                    db.execute("DELETE FROM config WHERE sheet = ?", (conf_name,))
+                db.execute("DELETE FROM race_index WHERE RaceID = ?", (rid,))
+        self._write(delete)
+
+    def reset(self):
+        def reset(db):
+            db.execute("DELETE FROM log WHERE sheet = ?", (WORKSHEET_LOG,))
+            db.execute("DELETE FROM config WHERE sheet = ?", (WORKSHEET_CONFIG,))
+        self._write(reset)
+
+
+# ==========================================
+# 最新ログの差分読み込み
+# ==========================================
+class LogFollower:
+    """
+    最新ログを差分で読む。読み込み済みの行数を覚えておき、最後の1行 (変わっていないかの確認用) から後ろだけを読む。
+    最後の1行が変わっていた・行が減っていたとき、および verify_sec ごとの照合 (行数と Time・EventID 列のハッシュ)
+    が合わないときは全体を読み直す (resync)。読み直したときは on_resync() を呼ぶ (派生状態の全再計算用)。
+    """
+
+    def __init__(self, storage, verify_sec=60.0, on_resync=None):
+        self.storage = storage
+        self.verify_sec = verify_sec
+        self.on_resync = on_resync
+        self.lock = threading.Lock()
+        self.raw = None
+        self.verify_at = 0.0
+        self.stats = {"full_reads": 0, "full_rows": 0, "delta_reads": 0, "delta_rows": 0, "verifies": 0, "resyncs": 0}
+
+    def _full(self, resync=False):
+        self.raw = normalize_log(self.storage.read_log())
+        self.verify_at = time.monotonic() + self.verify_sec
+        self.stats["full_reads"] += 1
+        self.stats["full_rows"] += len(self.raw)
+        if resync:
+            self.stats["resyncs"] += 1
+            if self.on_resync: self.on_resync()
+        return self.raw
+
+    def _verified(self):
+        self.verify_at = time.monotonic() + self.verify_sec
+        self.stats["verifies"] += 1
+        return self.storage.log_fingerprint() == log_fingerprint(self.raw["Time"], self.raw["EventID"])
+
+    def read(self):
+        """最新ログ全体 (normalize_log 済み) を返す。返した DataFrame は書き換えないこと。"""
+        with self.lock:
+            if self.raw is None or self.raw.empty: return self._full()
+            if time.monotonic() >= self.verify_at and not self._verified(): return self._full(resync=True)
+            n = len(self.raw)
+            tail = normalize_log(self.storage.read_log(start=n - 1))
+            self.stats["delta_reads"] += 1
+            self.stats["delta_rows"] += len(tail)
+            if tail.empty or _row_key(tail.iloc[0]) != _row_key(self.raw.iloc[-1]): return self._full(resync=True)
+            if len(tail) > 1: self.raw = pd.concat([self.raw, tail.iloc[1:]])
+            return self.raw
+
+    def cached(self):
+        """最後に読んだ最新ログ (normalize_log 済み。保存先は読まない)。まだ読んでいなければ None。"""
+        with self.lock: return self.raw
+
+    def reset(self):
+        """レースの作成・アーカイブ・リセットの後に呼ぶ (次回は全体を読む)。"""
+        with self.lock: self.raw = None
+
+    def metrics(self):
+        with self.lock: return dict(self.stats, rows=0 if self.raw is None else len(self.raw))
+
+
+# ==========================================
+# 書き込みの後回しキュー (write-behind)
+# ==========================================
+class WriteBehindQueue:
+    """
+    記録係のタップを即座に受け付け、裏のスレッドでまとめて storage.append_log する。
+    受け付けた行はまずジャーナル (JSON Lines) に書くので、反映前にプロセスが落ちても次回起動時に送り直す。
+    まだ反映されていない行は overlay() で読み込み結果の末尾に足して見せる。
+
+    ジャーナルの1行: {"op": "add", "id": n, "row": [...]} / {"op": "ack", "ids": [...]}
+    """
+
+    def __init__(self, storage, journal_path, flush_sec=1.0, batch_max=100):
+        self.storage = storage
+        self.journal_path = journal_path
+        self.flush_sec = flush_sec
+        self.batch_max = batch_max
+        self.lock = threading.Condition()
+        self.send_lock = threading.Lock()  # 裏スレッドと flush() が同じ行を二重に送らないように
+        self.pending = []   # [(id, row)] 未反映 (送信中を含む)
+        self.inflight = 0   # pending の先頭から何件を送信中か
+        self.recent = []    # 反映済みだが、まだ読み込み結果で確認できていない行
+        self.next_id = 0
+        self.stats = {"queued": 0, "flushed": 0, "batches": 0, "errors": 0, "last_error": None}
+        self._recover()
+        self.worker = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self.worker.start()
+
+    # --- ジャーナル ---
+    def _journal(self, *records):
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            for rec in records: f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _recover(self):
+        if not os.path.exists(self.journal_path): return
+        rows, done = {}, set()
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try: rec = json.loads(line)
+                except ValueError: continue  # 書きかけの最終行
+                if rec["op"] == "add": rows[rec["id"]] = rec["row"]
+                elif rec["op"] == "ack": done.update(rec["ids"])
+                elif rec["op"] == "drop": done.add(rec["id"])  # 以前の版 (未送信の行を Undo で外していた) のジャーナル
+        self.next_id = max(rows, default=-1) + 1
+        self.pending = [(i, r) for i, r in sorted(rows.items()) if i not in done]
+        if not self.pending:
+            os.remove(self.journal_path)
+            return
+        # 送信済みだが ack を書く前に落ちた行は、保存先に既にあるので送り直さない
+        try: seen = self._tail_keys(self.storage.read_log(), len(self.pending))
+        except Exception: seen = set()
+        stale = [i for i, r in self.pending if _row_key(r) in seen]
+        if stale:
+            self.pending = [(i, r) for i, r in self.pending if i not in stale]
+            self._journal({"op": "ack", "ids": stale})
+
+    @staticmethod
+    def _tail_keys(raw, n):
+        tail = raw.iloc[-(n + 50):][[c for c in LOG_HEADER if c in raw.columns]]
+        return {_row_key(r) for r in tail.itertuples(index=False)}
+
+    # --- 受け付け ---
+    def enqueue(self, rows):
+        """行 (LOG_HEADER 順のリスト) を受け付ける。ジャーナルに書いた時点で、行の id のリストを返す。"""
+        with self.lock:
+            items = [(self.next_id + k, [str(v) for v in row]) for k, row in enumerate(rows)]
+            self.next_id += len(items)
+            self._journal(*({"op": "add", "id": i, "row": r} for i, r in items))
+            self.pending += items
+            self.stats["queued"] += len(items)
+            self.lock.notify()
+            return [i for i, _ in items]
+
+    # --- 送信 ---
+    def _send(self):
+        with self.send_lock: return self._send_batch()
+
+    def _send_batch(self):
+        with self.lock:
+            batch = self.pending[:self.batch_max]
+            self.inflight = len(batch)
+        if not batch: return True
+        try: self.storage.append_log([r for _, r in batch])
+        except Exception as e:
+            with self.lock:
+                self.inflight = 0
+                self.stats["errors"] += 1
+                self.stats["last_error"] = str(e)
+            return False
+        with self.lock:
+            self._journal({"op": "ack", "ids": [i for i, _ in batch]})
+            del self.pending[:len(batch)]
+            self.inflight = 0
+            self.recent += [r for _, r in batch]
+            self.stats["flushed"] += len(batch)
+            self.stats["batches"] += 1
+            if not self.pending: open(self.journal_path, "w").close()  # 全部反映したらジャーナルを空に
+        return True
+
+    def _run(self):
+        backoff = self.flush_sec
+        while True:
+            with self.lock:
+                while not self.pending: self.lock.wait()
+            time.sleep(self.flush_sec)  # 同時に押されたタップを1回の送信にまとめる
+            if self._send(): backoff = self.flush_sec
+            else:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def flush(self, timeout=30.0):
+        """未反映の行がなくなるまで待つ (アーカイブ・リセットなどの前に呼ぶ)。反映しきれたら True。"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if not self.pending: return True
+            if not self._send(): time.sleep(0.5)
+        return False
+
+    # --- 読み込み側 ---
+    def overlay(self, raw):
+        """保存先から読んだ生ログに、まだ読み込み結果に現れていない受け付け済みの行を足す。"""
+        with self.lock:
+            waiting = self.recent + [r for _, r in self.pending]
+            if not waiting: return raw
+            seen = self._tail_keys(raw, len(waiting)) if not raw.empty else set()
+            self.recent = [r for r in self.recent if _row_key(r) not in seen]
+            missing = [r for r in waiting if _row_key(r) not in seen]
+        if not missing: return raw
+        # 保存先から読み戻した行と同じ形 (normalize_log) にそろえる。そろえないと送信後に末尾の行が
+        # 別物に見え (時刻の ".0" など)、RaceState が追記と判定できずに全再計算になる
+        return pd.concat([raw, normalize_log(pd.DataFrame(missing, columns=LOG_HEADER))], ignore_index=True)
+
+    def metrics(self):
+        with self.lock: return dict(self.stats, pending=len(self.pending))
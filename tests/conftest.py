@@ -0,0 +1,5 @@
+# テストからリポジトリ直下のモジュール (race_engine・bench など) を import できるようにする
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,26 @@
+# ==========================================
+# 一致確認 (bench.py --check と同じケースを固定のシードで)
+#   fmt_*_ms (列まとめ) と 1件ずつの fmt_* / RaceState の追記計算と全再計算
+# ==========================================
+
+import pytest
+
+import bench
+
+SEEDS = [0, 1]
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_format_parity(seed):
+    for name, got, want in bench.format_parity_cases(n=20_000, seed=seed):
+        assert bench.format_mismatches(got, want)[:3] == [], name
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("case", [0, 1], ids=["chained_double_taps", "recorder_replay"])
+def test_incremental_parity(seed, case):
+    name, journal, every_row = bench.incremental_parity_cases(seed)[case]
+    state, bad = bench.incremental_mismatches(journal, every=20, every_row=every_row)
+    assert bad[:5] == [], name
+    # 二重タップをまとめる経路も通っていること
+    assert state.double_taps, name